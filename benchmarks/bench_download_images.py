@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# mangascraper/extensions/benchmarks/bench_download_images.py
+
+"""
+Benchmark for the page download path of extensions (download_gallery_hook).
+
+Starts local HTTP "mirrors" serving synthetic images, optionally injecting latency, 429s, connection resets
+and bandwidth limits, then downloads the pages as one gallery through each extension / download engine combination.
+Prints one JSON report per run (pages/s, MB/s, page completion time percentiles, retries).
+
+Needs a working manga-scraper install (the extensions import mangascraper.core), with dry run off.
+
+Examples:
+    python3 benchmarks/bench_download_images.py
+    python3 benchmarks/bench_download_images.py --extension suwayomi --engine asyncio --scenario throttled --concurrency 32
+    python3 benchmarks/bench_download_images.py --set HEDGED_REQUESTS=True --output bench_output.txt
+"""
+
+import os, sys, ast, time, json, math, random, shutil, socket, tempfile, threading, argparse, importlib.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+####################################################################################################################
+# Scenarios
+####################################################################################################################
+
+# Each scenario is a list of mirror profiles, tried in order by the extension.
+#   latency: seconds before response headers are sent.
+#   throttle: share of requests answered with 429 + Retry-After.
+#   reset: share of requests whose connection is dropped halfway through the body (resumed with a Range request).
+#   bandwidth: body bytes per second (None = unlimited).
+SCENARIOS = {
+    "clean": [
+        {"latency": 0.0, "throttle": 0.0, "reset": 0.0, "bandwidth": None},
+        {"latency": 0.0, "throttle": 0.0, "reset": 0.0, "bandwidth": None},
+    ],
+    "latency": [
+        {"latency": 0.15, "throttle": 0.0, "reset": 0.0, "bandwidth": None},
+        {"latency": 0.05, "throttle": 0.0, "reset": 0.0, "bandwidth": None},
+    ],
+    "throttled": [
+        {"latency": 0.01, "throttle": 0.2, "reset": 0.0, "bandwidth": None},
+        {"latency": 0.01, "throttle": 0.05, "reset": 0.0, "bandwidth": None},
+    ],
+    "resets": [
+        {"latency": 0.01, "throttle": 0.0, "reset": 0.15, "bandwidth": None},
+        {"latency": 0.01, "throttle": 0.0, "reset": 0.15, "bandwidth": None},
+    ],
+    "slow-mirror": [
+        {"latency": 0.5, "throttle": 0.0, "reset": 0.0, "bandwidth": 256 * 1024},
+        {"latency": 0.02, "throttle": 0.0, "reset": 0.0, "bandwidth": None},
+    ],
+}
+
+####################################################################################################################
+# Stand-in mirror server
+####################################################################################################################
+
+def synthetic_image(page: int, size: int) -> bytes:
+    """Deterministic JPEG-shaped body (valid magic bytes and end marker) of roughly "size" bytes."""
+    body = random.Random(page).randbytes(max(0, size - 6))
+    return b"\xff\xd8\xff\xe0" + body + b"\xff\xd9"
+
+class MirrorServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, profile: dict, page_size: int, seed: int):
+        super().__init__(("127.0.0.1", 0), MirrorHandler)
+        self.profile = profile
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.images = {}
+        self.stats = {"requests": 0, "ok": 0, "partial": 0, "throttled": 0, "reset": 0, "bytes": 0}
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, key: str, amount: int = 1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def roll(self, chance: float) -> bool:
+        with self.lock:
+            return self.random.random() < chance
+
+    def image(self, page: int) -> bytes:
+        with self.lock:
+            if page not in self.images:
+                self.images[page] = synthetic_image(page, self.page_size)
+            return self.images[page]
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        profile = server.profile
+        server.count("requests")
+
+        try:
+            page = int(os.path.splitext(os.path.basename(self.path))[0])
+        except ValueError:
+            self.send_error(404)
+            return
+
+        if profile["latency"]:
+            time.sleep(profile["latency"])
+
+        if server.roll(profile["throttle"]):
+            server.count("throttled")
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = server.image(page)
+        start = 0
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes="):
+            start = int(range_header[6:].split("-")[0] or 0)
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+            server.count("partial")
+        else:
+            self.send_response(200)
+            server.count("ok")
+        payload = body[start:]
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+        if server.roll(profile["reset"]):
+            # Send half the body, then drop the connection. A FIN rather than an RST, so the half that was sent
+            # reaches the client (an RST discards whatever it has not read yet) and the retry resumes from it.
+            server.count("reset")
+            self.wfile.write(payload[:len(payload) // 2])
+            self.wfile.flush()
+            server.count("bytes", len(payload) // 2)
+            self.connection.shutdown(socket.SHUT_WR)
+            self.close_connection = True
+            return
+
+        bandwidth = profile["bandwidth"]
+        step = 64 * 1024
+        for offset in range(0, len(payload), step):
+            chunk = payload[offset:offset + step]
+            self.wfile.write(chunk)
+            server.count("bytes", len(chunk))
+            if bandwidth:
+                time.sleep(len(chunk) / bandwidth)
+
+def start_mirrors(profiles: list, page_size: int, seed: int) -> list:
+    mirrors = []
+    for index, profile in enumerate(profiles):
+        server = MirrorServer(profile, page_size, seed + index)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        mirrors.append(server)
+    return mirrors
+
+####################################################################################################################
+# Runner
+####################################################################################################################
+
+def load_extension(name: str):
+    """
+    Import a fresh copy of an extension module and of its engine, so download state (rate limiter, scoreboards)
+    starts clean. "name" is an extension folder in this repo or a path to a *__msext.py file.
+    """
+
+    path = name if name.endswith(".py") else os.path.join(REPO_ROOT, name, f"{name}__msext.py")
+    folder = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    importlib.reload(importlib.import_module(f"mangascraper.extensions.{folder}.engine"))
+    module_name = f"bench_{os.path.splitext(os.path.basename(path))[0]}_{time.monotonic_ns()}"
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def parse_override(value: str):
+    """Parse "NAME=VALUE", reading VALUE as a Python literal (True, 0.5, "text") and falling back to a plain string."""
+    name, _, raw = value.partition("=")
+    try:
+        return name, ast.literal_eval(raw)
+    except (ValueError, SyntaxError):
+        return name, raw
+
+def close_extension(ext):
+    for name in ("_async_engine", "_tor_pool", "_page_store"):
+        resource = getattr(ext.engine, name, None)
+        if resource is not None:
+            resource.close()
+
+class PageClock:
+    """
+    Stand-in progress bar. The engine sets a "Creator: ..." postfix each time a page finishes downloading, which is
+    recorded as seconds since the gallery started.
+    """
+
+    def __init__(self):
+        self.started = None
+        self.done = []
+        self._lock = threading.Lock()
+
+    def set_postfix_str(self, text: str):
+        if text.startswith("Creator:"):
+            with self._lock:
+                self.done.append(time.perf_counter() - self.started)
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return round(ordered[index], 4)
+
+def run_once(extension: str, engine: str, scenario: str, args) -> dict:
+    ext = load_extension(extension)
+    for name, value in args.set:
+        # Download engine settings live in the extension's engine.py, anything else is an extension setting.
+        target = ext.engine if hasattr(ext.engine, name) else ext
+        if not hasattr(target, name):
+            raise SystemExit(f"{extension} has no setting '{name}'")
+        setattr(target, name, value)
+    ext.engine.DOWNLOAD_ENGINE = engine
+    ext.orchestrator.refresh_globals()
+    if ext.orchestrator.dry_run:
+        raise SystemExit("Dry run is enabled in the manga-scraper config, nothing would be downloaded.")
+    if ext.orchestrator.use_tor:
+        raise SystemExit("Tor is enabled in the manga-scraper config, the local mirrors are unreachable through it.")
+
+    mirrors = start_mirrors(SCENARIOS[scenario], args.page_size, args.seed)
+    workdir = tempfile.mkdtemp(prefix="msext-bench-")
+    if ext.engine.PAGE_STORE:
+        ext.engine.PAGE_STORE_PATH = os.path.join(workdir, ".page_store")
+    session = ext.requests.Session()
+    adapter = ext.requests.adapters.HTTPAdapter(pool_connections=len(mirrors), pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+
+    pages = [
+        (
+            page,
+            [f"{mirror.base_url}/galleries/{args.gallery}/{page}.jpg" for mirror in mirrors],
+            os.path.join(workdir, str(args.gallery), f"{page}.jpg"),
+        )
+        for page in range(1, args.pages + 1)
+    ]
+    clock = PageClock()
+
+    try:
+        clock.started = time.perf_counter()
+        results = ext.download_gallery_hook(
+            args.gallery, pages, session, pbar=clock, creator="bench", max_in_flight=args.concurrency
+        )
+        elapsed = time.perf_counter() - clock.started
+        pages_ok = sum(1 for ok in results.values() if ok)
+        bytes_on_disk = sum(
+            entry.stat().st_size for entry in os.scandir(os.path.join(workdir, str(args.gallery))) if entry.is_file()
+        ) if os.path.isdir(os.path.join(workdir, str(args.gallery))) else 0
+    finally:
+        close_extension(ext)
+        session.close()
+        for mirror in mirrors:
+            mirror.shutdown()
+            mirror.server_close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    mirror_stats = [dict(mirror.stats, profile=mirror.profile) for mirror in mirrors]
+    requests_made = sum(stats["requests"] for stats in mirror_stats)
+    return {
+        "extension": extension,
+        "engine": engine,
+        "scenario": scenario,
+        "concurrency": args.concurrency,
+        "pages": args.pages,
+        "page_size": args.page_size,
+        "pages_ok": pages_ok,
+        "pages_failed": args.pages - pages_ok,
+        "seconds": round(elapsed, 4),
+        "pages_per_second": round(pages_ok / elapsed, 2) if elapsed else None,
+        "mb_per_second": round(bytes_on_disk / elapsed / 1e6, 2) if elapsed else None,
+        "page_done_p50": percentile(clock.done, 50),
+        "page_done_p95": percentile(clock.done, 95),
+        "page_done_p99": percentile(clock.done, 99),
+        "requests": requests_made,
+        "retries": max(0, requests_made - pages_ok), # Every request beyond one per finished page.
+        "throttled": sum(stats["throttled"] for stats in mirror_stats),
+        "resets": sum(stats["reset"] for stats in mirror_stats),
+        "resumed": sum(stats["partial"] for stats in mirror_stats),
+        "overrides": dict(args.set),
+        "mirrors": mirror_stats,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark download_gallery_hook against local stand-in mirrors.")
+    parser.add_argument("--extension", action="append", help="Extension folder or *__msext.py path (repeatable). Default: skeleton and suwayomi.")
+    parser.add_argument("--engine", action="append", help="DOWNLOAD_ENGINE value (repeatable). Default: threaded and asyncio.")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Mirror scenario (repeatable). Default: all.")
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--page-size", type=int, default=512 * 1024, help="Bytes per synthetic page.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Pages downloaded at once (max_in_flight).")
+    parser.add_argument("--gallery", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0, help="Seed for injected failures.")
+    parser.add_argument("--set", action="append", type=parse_override, default=[], metavar="NAME=VALUE", help="Override an extension setting (repeatable).")
+    parser.add_argument("--output", help="Also append the JSON reports to this file.")
+    args = parser.parse_args(argv)
+
+    reports = []
+    for extension in args.extension or ["skeleton", "suwayomi"]:
+        for engine in args.engine or ["threaded", "asyncio"]:
+            for scenario in args.scenario or list(SCENARIOS):
+                report = run_once(extension, engine, scenario, args)
+                print(json.dumps(report), flush=True)
+                reports.append(report)
+
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            for report in reports:
+                f.write(json.dumps(report) + "\n")
+    return reports
+
+if __name__ == "__main__":
+    sys.exit(0 if all(report["pages_failed"] == 0 for report in main()) else 1)
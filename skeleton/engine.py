@@ -0,0 +1,3020 @@
+#!/usr/bin/env python3
+# mangascraper/extensions/skeleton/engine.py
+
+import os, io, time, json, requests, select, math, shutil, re, threading, asyncio, secrets, hashlib, sqlite3, atexit
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait as futures_wait
+from concurrent.futures.process import BrokenProcessPool
+from pickle import PicklingError
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, urlunsplit
+
+try:
+    import aiohttp # Optional, only needed for the "asyncio" download engine.
+except ImportError:
+    aiohttp = None
+
+try:
+    from aiohttp_socks import ProxyConnector # Optional, lets the "asyncio" download engine use Tor.
+except ImportError:
+    ProxyConnector = None
+
+try:
+    from PIL import Image # Optional, only needed for cover thumbnails.
+except ImportError:
+    Image = None
+
+from mangascraper.core import orchestrator
+from mangascraper.core.orchestrator import *
+from mangascraper.core.api import *
+from mangascraper.core import database as scraperdb
+from mangascraper.extensions.extension_manager import (
+    build_gallery_metadata_summary,
+    find_latest_cover_id,
+    parse_gallery_id,
+)
+
+# Download engine, archiver and library index. Extensions are installed one at a time, so each one ships its own copy
+# of this file, copied from skeleton/engine.py. Keep the copies identical (tests/test_engine.py checks).
+# An extension calls configure() with its name and download path, then forwards its core hooks to the functions
+# under HOOK HELPERS.
+# Settings below are module globals, change them here (or with engine.NAME = value) rather than in an extension.
+
+# ALL FUNCTIONS MUST BE THREAD SAFE. IF A FUNCTION MANIPULATES A GLOBAL VARIABLE, STORE AND UPDATE IT LOCALLY IF POSSIBLE. 
+
+####################################################################################################################
+# Global variables
+####################################################################################################################
+
+# Set by configure().
+EXTENSION_NAME = None
+EXTENSION_REFERRER = None
+DEDICATED_DOWNLOAD_PATH = None
+
+ARCHIVE_WAIT_SECONDS = 120
+ARCHIVE_POLL_INTERVAL = 0.5
+
+# Page download engine.
+# "threaded": download_images_hook downloads one page per call on the caller's thread.
+# "asyncio": download_gallery_hook fetches a whole gallery on one shared event loop (requires aiohttp, and aiohttp-socks for Tor).
+DOWNLOAD_ENGINE = "threaded"
+ASYNC_MAX_IN_FLIGHT = 16 # Max concurrent page requests per gallery.
+ASYNC_POOL_SIZE = 100 # Max open connections in the shared connection pool.
+
+# Per-host adaptive rate limiting shared by all download workers (AIMD token bucket).
+RATE_LIMIT_INITIAL_RATE = 5.0 # Requests per second allowed to a new host.
+RATE_LIMIT_MIN_RATE = 0.2
+RATE_LIMIT_MAX_RATE = 50.0
+RATE_LIMIT_BURST = 10 # Requests that can be sent at once before the rate applies.
+RATE_LIMIT_INCREASE = 0.5 # Roughly how many req/s the rate grows per second of successful requests.
+RATE_LIMIT_DECREASE = 0.5 # Rate is multiplied by this on a 429 / 503.
+RATE_LIMIT_MAX_RETRY_AFTER = 300 # Cap on how long a Retry-After header can pause a host (seconds).
+
+# Mirror ranking. Mirrors are tried fastest first, scored on rolling latency, throughput and error rate.
+MIRROR_EWMA_ALPHA = 0.2 # Weight of the newest sample in the rolling averages.
+MIRROR_ERROR_PENALTY = 4.0 # A mirror failing every request scores (1 + this) times slower.
+MIRROR_LATENCY_SAMPLES = 200 # Recent response times kept per mirror for the p95.
+
+# Hedged requests. If a mirror has not responded by its p95 response time, also ask the next mirror and keep whichever answers first.
+HEDGED_REQUESTS = False
+HEDGE_MIN_SAMPLES = 20 # Response times needed before a mirror's own p95 is trusted.
+HEDGE_DEFAULT_DEADLINE = 5.0 # Seconds to wait before hedging when there are too few samples.
+HEDGE_DEADLINE_MULTIPLIER = 1.0 # Multiplier applied to the p95.
+HEDGE_MAX_WORKERS = 32 # Threads available for hedged requests in the threaded engine.
+
+# Pages are written to "<page><PART_FILE_SUFFIX>" and renamed into place once complete. Leftover .part files are resumed with HTTP Range requests.
+PART_FILE_SUFFIX = ".part"
+
+# Circuit breaker per mirror host, shared by all download workers.
+CIRCUIT_BREAKER_THRESHOLD = 5 # Consecutive failures before every worker skips the host.
+CIRCUIT_BREAKER_COOLDOWN = 30 # Seconds before a skipped host gets a single trial request.
+
+# Pool of pre-warmed Tor sessions, each on its own circuit (Tor isolates circuits by SOCKS username / password).
+# Used instead of rebuilding the downloader's Tor session inline when a page fails on every mirror.
+TOR_SESSION_POOL = False
+TOR_POOL_SIZE = 4 # Sessions handed out round-robin to download workers.
+TOR_POOL_SPARES = 2 # Warmed sessions kept ready to replace failing ones.
+TOR_SOCKS_PROXY = "socks5h://127.0.0.1:9050" # Used when the downloader session has no SOCKS proxy of its own.
+TOR_POOL_HEALTH_URL = "https://check.torproject.org/api/ip" # Fetched through each session to warm and health-check it.
+TOR_POOL_HEALTH_INTERVAL = 60 # Seconds between background health checks.
+TOR_POOL_HEALTH_TIMEOUT = 30
+
+# Content-addressed page store. Pages are hashed while they download and identical pages are hardlinked to one stored copy.
+# Pages whose source URL was downloaded before are linked in without touching the network.
+PAGE_STORE = False
+PAGE_STORE_PATH = None # Defaults to ".<extension>_page_store" next to the download path. Must be on the same filesystem.
+
+# Validate pages while they download. Anything that is not an image (HTML error pages, JSON) or does not match
+# its Content-Length is dropped and the next mirror is tried.
+VALIDATE_PAGES = True
+VALIDATE_PAGE_END_MARKERS = False # Also require JPEG / PNG / GIF end markers, catching truncated bodies without a Content-Length.
+
+PAGE_WRITE_BUFFER_SIZE = 256 * 1024 # Bytes read from the socket and written to disk per call.
+PAGE_PREALLOCATE = True # Reserve the full page on disk (posix_fallocate) when Content-Length is known.
+PAGE_FADVISE_DONTNEED = False # Drop written pages from the page cache. Only helps when pages are not read back soon (no archiving).
+
+# Archiving ("zip" / "cbz" gallery formats). Galleries are compressed on a process pool so downloads and compression overlap.
+ARCHIVE_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1)) # Archiver processes. 0 archives inline on the calling thread.
+ARCHIVE_QUEUE_SIZE = 8 # Max archive jobs queued or running. Further galleries wait for a free slot.
+# Already compressed image formats are stored as-is, deflating them costs CPU for next to no space.
+ARCHIVE_STORED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".avif", ".heic", ".heif", ".jxl"}
+ARCHIVE_COMPRESSION_LEVELS = {"zip": 6, "cbz": 6} # Deflate level (0-9) per GALLERY_FORMAT, for everything else (metadata, text).
+# Append finished pages straight into the gallery's archive instead of a gallery folder, halving write I/O.
+# Pages are held in memory until complete, so interrupted pages are not resumed and the page store is bypassed.
+ARCHIVE_STREAMING = False
+
+GALLERY_INDEX_PATH = None # Gallery ID -> location index. Defaults to ".<extension>_gallery_index.json" next to the download path.
+COVER_STATE_PATH = None # Latest cover per creator. Defaults to ".<extension>_cover_state.json" next to the download path.
+# Store a gallery credited to several creators once. The other creator folders get hardlinks (archives) or symlinks (folders).
+# Opt-in: their own copies are deleted, and cleanup_hook deletes symlinks whose canonical copy is gone.
+SINGLE_COPY_GALLERIES = False
+GALLERY_LINKS_PATH = None # Canonical copy -> links index. Defaults to ".<extension>_gallery_links.json" next to the download path.
+
+# Gallery metadata is written to the database in the background, every DB_FLUSH_EVERY galleries or DB_FLUSH_INTERVAL seconds.
+DB_WRITE_BEHIND = True
+DB_FLUSH_EVERY = 50
+DB_FLUSH_INTERVAL = 10 # Seconds.
+
+# Point creator covers at downscaled thumbnails (cached in .covers/.thumbs) instead of full-size pages. Needs Pillow.
+COVER_THUMBNAILS = False
+COVER_THUMBNAIL_SIZE = (350, 500) # Max width, height in pixels.
+COVER_THUMBNAIL_QUALITY = 85 # JPEG / WebP quality.
+COVER_THUMBNAIL_WORKERS = 2 # Thumbnailer processes. 0 resizes inline on the calling thread.
+
+####################################################################################################################
+# CONFIGURATION
+####################################################################################################################
+
+def configure(extension_name: str, extension_referrer: str, download_path: str):
+    """
+    Points the engine at an extension's download path. Called on import and whenever the extension recomputes its
+    download path, so library state files and the page store land next to the right library.
+    """
+    
+    global EXTENSION_NAME, EXTENSION_REFERRER, DEDICATED_DOWNLOAD_PATH
+    
+    EXTENSION_NAME = extension_name
+    EXTENSION_REFERRER = extension_referrer
+    DEDICATED_DOWNLOAD_PATH = download_path
+
+####################################################################################################################
+# DOWNLOAD ENGINE (thread-safe)
+####################################################################################################################
+
+def _shutdown_requested() -> bool:
+    """
+    Return True if the downloader has asked all workers to stop.
+    """
+    
+    try:
+        from mangascraper.core.downloader import _shutdown_event
+    except ImportError:
+        _shutdown_event = None
+    return bool(_shutdown_event and _shutdown_event.is_set())
+
+def _check_page_before_download(gallery, page, urls, path, pbar=None, creator=None):
+    """
+    Run the checks shared by every engine before a page is fetched.
+    Returns True / False if the page is already settled, or None if it still needs downloading.
+    """
+    
+    if _shutdown_requested():
+        logger.warning("Shutdown event detected, aborting image download.")
+        return False
+
+    if not urls:
+        logger.warning(f"Gallery {gallery}: Page {page}: No URLs, skipping")
+        if pbar and creator:
+            pbar.set_postfix_str(f"Skipped Creator: {creator}")
+        return False
+
+    if os.path.exists(path):
+        log(f"Already exists, skipping: {path}", "debug")
+        if pbar and creator:
+            pbar.set_postfix_str(f"Creator: {creator}")
+        return True
+
+    if orchestrator.dry_run:
+        logger.info(f"[DRY RUN] Gallery {gallery}: Would download {urls[0]} -> {path}")
+        if pbar and creator:
+            pbar.set_postfix_str(f"Creator: {creator}")
+        return True
+
+    archive = _streaming_archive_for(path) # Opened only now, a dry run must not create anything.
+    if archive is not None and archive.has(os.path.basename(path)):
+        log(f"Already archived, skipping: {path}", "debug")
+        if pbar and creator:
+            pbar.set_postfix_str(f"Creator: {creator}")
+        return True
+
+    if PAGE_STORE and _page_store.link_known(urls, path):
+        log(f"Linked Gallery {gallery}: Page {page} from page store -> {path}", "debug")
+        if pbar and creator:
+            pbar.set_postfix_str(f"Creator: {creator}")
+        return True
+
+    return None
+
+def _mirror_host(url: str) -> str:
+    """
+    Return the host part of a mirror URL, used to key per-host download state.
+    """
+    
+    return urlsplit(url).netloc.lower()
+
+def _parse_retry_after(value) -> float | None:
+    """
+    Parse a Retry-After header (delay in seconds or an HTTP date) into seconds from now.
+    """
+    
+    if not value:
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+class _HostRateLimiter:
+    """
+    Token bucket per mirror host, shared by every download worker.
+    The refill rate grows additively on success and is cut multiplicatively on 429 / 503 (AIMD),
+    and a Retry-After header pauses the whole host instead of just the worker that received it.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _state(self, host: str, now: float) -> dict:
+        state = self._hosts.get(host)
+        if state is None:
+            state = {
+                "rate": RATE_LIMIT_INITIAL_RATE,
+                "tokens": float(RATE_LIMIT_BURST),
+                "updated": now,
+                "blocked_until": 0.0,
+                "last_decrease": 0.0,
+            }
+            self._hosts[host] = state
+        else:
+            elapsed = now - state["updated"]
+            state["tokens"] = min(float(RATE_LIMIT_BURST), state["tokens"] + elapsed * state["rate"])
+            state["updated"] = now
+        return state
+
+    def reserve(self, host: str) -> float:
+        """
+        Take a token for a request to "host" and return how many seconds to wait before sending it.
+        """
+        
+        with self._lock:
+            now = time.monotonic()
+            state = self._state(host, now)
+            state["tokens"] -= 1.0
+            wait = -state["tokens"] / state["rate"] if state["tokens"] < 0 else 0.0
+            return max(wait, state["blocked_until"] - now)
+
+    def feedback(self, host: str, status_code: int, retry_after=None):
+        """
+        Adjust the host's rate from a response status code and its Retry-After header.
+        """
+        
+        with self._lock:
+            now = time.monotonic()
+            state = self._state(host, now)
+            if status_code in (429, 503):
+                # Only back off once per window, a burst of 429s is one congestion signal.
+                if now - state["last_decrease"] >= 1.0 / state["rate"]:
+                    state["rate"] = max(RATE_LIMIT_MIN_RATE, state["rate"] * RATE_LIMIT_DECREASE)
+                    state["last_decrease"] = now
+                    log(f"Rate limiter: {host} returned {status_code}, slowing down to {state['rate']:.2f} req/s", "debug")
+                state["tokens"] = min(state["tokens"], 0.0)
+                delay = _parse_retry_after(retry_after)
+                if delay is not None:
+                    state["blocked_until"] = max(state["blocked_until"], now + min(delay, RATE_LIMIT_MAX_RETRY_AFTER))
+            elif status_code < 400:
+                state["rate"] = min(RATE_LIMIT_MAX_RATE, state["rate"] + RATE_LIMIT_INCREASE / state["rate"])
+
+_rate_limiter = _HostRateLimiter()
+
+def _sleep_unless_shutdown(seconds: float):
+    """
+    Sleep for "seconds", waking up early if the downloader is shutting down.
+    """
+    
+    if seconds <= 0:
+        return
+    try:
+        from mangascraper.core.downloader import _shutdown_event
+    except ImportError:
+        _shutdown_event = None
+    if _shutdown_event:
+        _shutdown_event.wait(seconds)
+    else:
+        time.sleep(seconds)
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class _PageStore:
+    """
+    Content-addressed store of page files, keyed by the hash computed while each page downloads.
+    Pages with identical content become hardlinks to one stored blob, and an index of source URL -> hash
+    lets a page whose URL was downloaded before be linked in without touching the network.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn = None
+        self._root = None
+
+    def root(self) -> str:
+        if PAGE_STORE_PATH:
+            return PAGE_STORE_PATH
+        # Next to the download path (so hardlinks stay on one filesystem) but outside the library itself.
+        parent = os.path.dirname(os.path.normpath(DEDICATED_DOWNLOAD_PATH))
+        return os.path.join(parent, f".{EXTENSION_NAME}_page_store")
+
+    def _db(self):
+        root = self.root()
+        if self._conn is None or self._root != root:
+            if self._conn is not None:
+                self._conn.close()
+            os.makedirs(root, exist_ok=True)
+            self._conn = sqlite3.connect(os.path.join(root, "index.sqlite3"), check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT NOT NULL, ext TEXT NOT NULL)")
+            self._root = root
+        return self._conn
+
+    def blob_path(self, digest: str, ext: str) -> str:
+        return os.path.join(self.root(), digest[:2], f"{digest}{ext}")
+
+    @staticmethod
+    def _link_into(blob: str, path: str):
+        """Hardlink "blob" to "path", replacing anything already there."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_link = f"{path}.link"
+        try:
+            os.unlink(temp_link)
+        except FileNotFoundError:
+            pass
+        os.link(blob, temp_link)
+        os.replace(temp_link, path)
+
+    def link_known(self, urls: list, path: str) -> bool:
+        """
+        Link "path" to a stored blob if any of "urls" was downloaded before. Returns True if it was.
+        """
+        
+        try:
+            with self._lock:
+                db = self._db()
+                for url in urls:
+                    row = db.execute("SELECT digest, ext FROM urls WHERE url=?", (url,)).fetchone()
+                    if not row:
+                        continue
+                    blob = self.blob_path(*row)
+                    if os.path.exists(blob):
+                        self._link_into(blob, path)
+                        return True
+                    db.execute("DELETE FROM urls WHERE url=?", (url,))
+                    db.commit()
+        except (OSError, sqlite3.Error) as e:
+            log(f"Page store: Could not link known page for {path}: {e}", "debug")
+        return False
+
+    def commit(self, part_path: str, path: str, digest: str, source_url: str = None):
+        """
+        Move a finished .part file into place, storing it as a blob or hardlinking to the existing identical blob.
+        """
+        
+        ext = os.path.splitext(path)[1].lower()
+        blob = self.blob_path(digest, ext)
+        try:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(part_path, blob)
+                os.replace(part_path, path)
+            except FileExistsError:
+                self._link_into(blob, path)
+                os.unlink(part_path)
+                log(f"Page store: {path} is a duplicate of {blob}, hardlinked.", "debug")
+        except OSError as e:
+            # Store on another filesystem or links not supported, keep the page as a plain file.
+            log(f"Page store: Could not store {path}: {e}", "debug")
+            if os.path.exists(part_path):
+                os.replace(part_path, path)
+            return
+
+        if source_url:
+            try:
+                with self._lock:
+                    db = self._db()
+                    db.execute("INSERT OR REPLACE INTO urls (url, digest, ext) VALUES (?, ?, ?)", (source_url, digest, ext))
+                    db.commit()
+            except sqlite3.Error as e:
+                log(f"Page store: Could not index {source_url}: {e}", "debug")
+
+    def sweep(self):
+        """
+        Delete blobs no page links to any more (st_nlink == 1), e.g. after their gallery was archived or removed,
+        along with the URL index rows pointing at them. Only safe while no downloads are running.
+        """
+        
+        root = self.root()
+        if not os.path.isdir(root):
+            return
+        removed, freed = set(), 0
+        for shard in os.scandir(root):
+            if not shard.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                    if stat.st_nlink != 1 or not entry.is_file(follow_symlinks=False):
+                        continue
+                    os.unlink(entry.path)
+                except OSError:
+                    continue
+                removed.add(os.path.splitext(entry.name)[0])
+                freed += stat.st_size
+        if not removed:
+            return
+        try:
+            with self._lock:
+                db = self._db()
+                db.executemany("DELETE FROM urls WHERE digest=?", ((digest,) for digest in removed))
+                db.commit()
+        except sqlite3.Error as e:
+            log(f"Page store: Could not prune the URL index: {e}", "debug")
+        log(f"Page store: Removed {len(removed)} unreferenced blobs ({freed / 1024 / 1024:.1f} MiB).", "debug")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+_page_store = _PageStore()
+
+class _InvalidPageError(Exception):
+    """A mirror sent something that is not a valid image. The mirror is skipped instead of retried."""
+
+_IMAGE_EDGE_BYTES = 16 # Bytes kept from the start and end of a page body for validation.
+_IMAGE_END_MARKERS = {"jpeg": b"\xff\xd9", "png": b"IEND\xaeB`\x82", "gif": b"\x3b"}
+
+def _sniff_image_format(head: bytes):
+    """
+    Return the image format a page body starts with, or None if it does not look like an image.
+    """
+    
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp":
+        return "avif" # AVIF / HEIF family
+    if head.startswith(b"\xff\x0a") or head.startswith(b"\x00\x00\x00\x0cJXL "):
+        return "jxl"
+    if head.startswith(b"BM"):
+        return "bmp"
+    return None
+
+_write_buffers = threading.local()
+
+def _thread_write_buffer() -> memoryview:
+    """Reusable PAGE_WRITE_BUFFER_SIZE buffer for the calling thread, so page bodies are read without per-chunk allocations."""
+    view = getattr(_write_buffers, "view", None)
+    if view is None or len(view) != PAGE_WRITE_BUFFER_SIZE:
+        view = _write_buffers.view = memoryview(bytearray(PAGE_WRITE_BUFFER_SIZE))
+    return view
+
+class _PageWriter:
+    """
+    Streams a page body into "<path>.part" and atomically renames it to "path" once the length checks out.
+    A .part file left behind by an interrupted download is resumed with an HTTP Range request.
+    With VALIDATE_PAGES on, bodies that are not images (or are truncated) raise _InvalidPageError and are dropped.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.part_path = f"{path}{PART_FILE_SUFFIX}"
+        # Preallocated downloads go here first. Its size says nothing about progress, so it is only renamed
+        # to .part (truncated to what was written) on a clean close, and dropped if a crash left it behind.
+        self.alloc_path = f"{path}.alloc{PART_FILE_SUFFIX}"
+        self.expected = None # Full page size in bytes, if the server told us.
+        self.written = 0 # Bytes in the .part file, including any resumed prefix.
+        self.received = 0 # Bytes received from the current response.
+        self._file = None
+        self._hash = None # Streaming content hash for the page store, only kept for downloads started from byte 0.
+        self._head = b"" # First bytes of the page, for magic byte sniffing.
+        self._tail = b"" # Last bytes of the page, for end marker checks.
+        self.format = None
+        self._identity = True # Body has no Content-Encoding, so it can be read straight off the socket.
+        self._preallocated = False
+        self._pending = None # Coalesces small async chunks into PAGE_WRITE_BUFFER_SIZE writes.
+        self.archive = _streaming_archive_for(path) # Pages are kept in memory and added to this archive on commit.
+        self.offset = 0
+        if self.archive is not None:
+            return
+        try:
+            os.unlink(self.alloc_path)
+        except FileNotFoundError:
+            pass
+        try:
+            self.offset = os.path.getsize(self.part_path)
+        except OSError:
+            pass
+
+    def request_headers(self) -> dict:
+        return {"Range": f"bytes={self.offset}-"} if self.offset else {}
+
+    def discard(self):
+        """Drop the .part file so the next attempt starts from scratch."""
+        self.close()
+        if self.archive is not None:
+            return
+        try:
+            os.unlink(self.part_path)
+        except FileNotFoundError:
+            pass
+        self.offset = 0
+
+    def invalid(self, reason: str):
+        """Drop the .part file and raise _InvalidPageError."""
+        self.discard()
+        raise _InvalidPageError(reason)
+
+    def _read_existing_edges(self):
+        """Load head / tail bytes from a .part file being resumed, so validation covers the whole page."""
+        with open(self.part_path, "rb") as f:
+            self._head = f.read(_IMAGE_EDGE_BYTES)
+            f.seek(max(0, self.offset - _IMAGE_EDGE_BYTES))
+            self._tail = f.read(_IMAGE_EDGE_BYTES)
+        self.format = _sniff_image_format(self._head)
+        if self.format is None and len(self._head) >= 12:
+            self.invalid("resumed .part file is not an image")
+
+    def settle_unsatisfiable(self, headers) -> bool:
+        """
+        Handle a 416 reply to a Range request. Returns True if the .part file was already complete and got committed.
+        """
+        
+        match = re.match(r"bytes \*/(\d+)", headers.get("Content-Range", ""))
+        if match and self.offset and int(match.group(1)) == self.offset:
+            self.written = self.expected = self.offset
+            if VALIDATE_PAGES:
+                self._read_existing_edges()
+            self.commit()
+            return True
+        self.discard()
+        return False
+
+    def begin(self, status_code: int, headers):
+        """
+        Open the .part file for a successful response, appending if the server honoured our Range request.
+        """
+        
+        content_type = headers.get("Content-Type", "").lower()
+        if VALIDATE_PAGES and content_type.startswith(("text/", "application/json", "application/xml")):
+            raise _InvalidPageError(f"mirror sent '{content_type}' instead of an image")
+
+        encoding = headers.get("Content-Encoding", "identity").lower()
+        length = headers.get("Content-Length", "")
+        # Content-Length counts encoded bytes, so it can only be checked against identity bodies.
+        self._identity = encoding in ("", "identity")
+        length = int(length) if length.isdigit() and self._identity else None
+
+        if status_code == 206 and self.offset:
+            match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", headers.get("Content-Range", ""))
+            if not match or int(match.group(1)) != self.offset:
+                self.discard()
+                raise ValueError(f"Unexpected Content-Range '{headers.get('Content-Range')}' for resumed download")
+            total = match.group(2)
+            self.expected = int(total) if total.isdigit() else (self.offset + length if length is not None else None)
+            mode = "ab"
+        else:
+            # Server ignored the Range header (or there was nothing to resume), start over.
+            self.offset = 0
+            self.expected = length
+            mode = "wb"
+
+        if self.archive is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            _gallery_index.add(os.path.dirname(self.path))
+        if self.archive is not None:
+            self._file = io.BytesIO()
+        elif mode == "wb" and PAGE_PREALLOCATE and self.expected and hasattr(os, "posix_fallocate"):
+            # Reserve the whole page up front, so the filesystem can lay it out in one extent.
+            self._file = open(self.alloc_path, "wb", buffering=0)
+            self._preallocated = True
+            try:
+                os.posix_fallocate(self._file.fileno(), 0, self.expected)
+            except OSError:
+                pass
+        else:
+            self._file = open(self.part_path, mode, buffering=0)
+        self.written = self.offset
+        self.received = 0
+        self._hash = hashlib.blake2b(digest_size=32) if PAGE_STORE and mode == "wb" and self.archive is None else None
+        self._head, self._tail, self.format = b"", b"", None
+        if VALIDATE_PAGES and mode == "ab":
+            self._read_existing_edges()
+
+    def write(self, chunk):
+        if VALIDATE_PAGES:
+            if self.format is None and len(self._head) < _IMAGE_EDGE_BYTES:
+                self._head += chunk[:_IMAGE_EDGE_BYTES - len(self._head)]
+                if len(self._head) >= 12:
+                    self.format = _sniff_image_format(self._head)
+                    if self.format is None:
+                        self.invalid(f"body starts with {self._head[:12]!r}, not an image")
+            self._tail = (self._tail + chunk[-_IMAGE_EDGE_BYTES:])[-_IMAGE_EDGE_BYTES:]
+        self._write_all(chunk)
+        if self._hash is not None:
+            self._hash.update(chunk)
+        self.written += len(chunk)
+        self.received += len(chunk)
+
+    def _write_all(self, chunk):
+        """The file is unbuffered and FileIO.write may take only part of a chunk, so keep writing until all of it is down."""
+        view = memoryview(chunk)
+        while view:
+            n = self._file.write(view)
+            if not n:
+                raise OSError(f"Could not write to '{self.part_path}'")
+            view = view[n:]
+
+    def write_from(self, r):
+        """
+        Stream a requests response body into the page.
+        Identity bodies are read straight into this thread's reusable buffer, one write per PAGE_WRITE_BUFFER_SIZE.
+        """
+        
+        if not self._identity or not hasattr(r.raw, "readinto"):
+            for chunk in r.iter_content(chunk_size=PAGE_WRITE_BUFFER_SIZE):
+                if chunk:
+                    self.write(chunk)
+            return
+        view = _thread_write_buffer()
+        while True:
+            n = r.raw.readinto(view)
+            if not n:
+                break
+            self.write(view[:n])
+
+    def buffer(self, chunk) -> bool:
+        """
+        Collect a chunk without touching the disk. Returns True when flush() is due: PAGE_WRITE_BUFFER_SIZE bytes are
+        pending, or the head still needs validating (so bad pages are rejected early).
+        aiohttp hands out whatever the socket had, which is often only a few KiB.
+        """
+        
+        if self._pending is None:
+            self._pending = bytearray()
+        self._pending += chunk
+        return len(self._pending) >= PAGE_WRITE_BUFFER_SIZE or (VALIDATE_PAGES and self.format is None)
+
+    def flush(self):
+        if self._pending:
+            self.write(self._pending)
+            self._pending.clear()
+
+    def close(self):
+        self._pending = None
+        if self._file is not None:
+            if self._preallocated:
+                self._file.truncate(self.written)
+            if PAGE_FADVISE_DONTNEED and self.archive is None and hasattr(os, "posix_fadvise"):
+                try:
+                    os.posix_fadvise(self._file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                except OSError:
+                    pass
+            self._file.close()
+            self._file = None
+        if self._preallocated:
+            self._preallocated = False
+            os.replace(self.alloc_path, self.part_path)
+
+    def _validate_complete(self):
+        if self.format is None:
+            self.format = _sniff_image_format(self._head)
+            if self.format is None:
+                self.invalid(f"{self.written} byte body is not an image")
+        marker = _IMAGE_END_MARKERS.get(self.format)
+        if VALIDATE_PAGE_END_MARKERS and marker and not self._tail.rstrip(b"\x00\r\n ").endswith(marker):
+            self.invalid(f"{self.format} is missing its end marker (truncated)")
+
+    def commit(self, source_url: str = None):
+        """
+        Verify the page length and move the .part file into place (through the page store if enabled).
+        A short file is kept for resuming, an oversized one is discarded.
+        """
+        
+        self.flush()
+        body = self._file.getvalue() if self.archive is not None and self._file is not None else None
+        self.close()
+        if self.expected is not None and self.written != self.expected:
+            if self.written > self.expected:
+                self.discard()
+            raise ValueError(f"Incomplete page: got {self.written} of {self.expected} bytes")
+        if VALIDATE_PAGES:
+            self._validate_complete()
+        if self.archive is not None:
+            self.archive.add(os.path.basename(self.path), body or b"")
+        elif PAGE_STORE:
+            digest = self._hash.hexdigest() if self._hash is not None else _hash_file(self.part_path)
+            _page_store.commit(self.part_path, self.path, digest, source_url)
+        else:
+            os.replace(self.part_path, self.path)
+
+class _MirrorScoreboard:
+    """
+    Rolling latency, throughput and error rate per mirror host, shared by every download worker.
+    Used to try the fastest healthy mirror first and to derive hedging deadlines.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _state(self, host: str) -> dict:
+        state = self._hosts.get(host)
+        if state is None:
+            state = {
+                "ttfb": None, # Seconds until response headers arrive.
+                "throughput": None, # Body bytes per second.
+                "size": None, # Body bytes per page.
+                "errors": 0.0, # Share of recent requests that failed.
+                "samples": deque(maxlen=MIRROR_LATENCY_SAMPLES),
+            }
+            self._hosts[host] = state
+        return state
+
+    @staticmethod
+    def _ewma(previous, sample):
+        return sample if previous is None else previous + MIRROR_EWMA_ALPHA * (sample - previous)
+
+    def record_success(self, host: str, ttfb: float, body_seconds: float, nbytes: int):
+        with self._lock:
+            state = self._state(host)
+            state["ttfb"] = self._ewma(state["ttfb"], ttfb)
+            state["samples"].append(ttfb)
+            state["size"] = self._ewma(state["size"], nbytes)
+            state["throughput"] = self._ewma(state["throughput"], nbytes / max(body_seconds, 1e-3))
+            state["errors"] = self._ewma(state["errors"], 0.0)
+
+    def record_failure(self, host: str):
+        with self._lock:
+            state = self._state(host)
+            state["errors"] = self._ewma(state["errors"], 1.0)
+
+    def score(self, host: str) -> float:
+        """
+        Expected seconds to fetch a page from "host", inflated by its error rate.
+        Mirrors never tried score 0 so each gets explored once; mirrors that only ever failed score infinity.
+        """
+        
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                return 0.0
+            if state["ttfb"] is None:
+                return 0.0 if state["errors"] == 0 else math.inf
+            expected = state["ttfb"] + state["size"] / max(state["throughput"], 1.0)
+            return expected * (1 + MIRROR_ERROR_PENALTY * state["errors"])
+
+    def rank(self, urls: list) -> list:
+        """
+        Return "urls" ordered best mirror first, keeping the given order between equal scores.
+        """
+        
+        scored = [(self.score(_mirror_host(url)), index, url) for index, url in enumerate(urls)]
+        return [url for _, _, url in sorted(scored)]
+
+    def hedge_deadline(self, host: str) -> float:
+        """
+        Seconds to wait for "host" to respond before firing a hedged request at the next mirror.
+        """
+        
+        with self._lock:
+            state = self._hosts.get(host)
+            samples = sorted(state["samples"]) if state else []
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DEADLINE
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        return p95 * HEDGE_DEADLINE_MULTIPLIER
+
+_mirror_scoreboard = _MirrorScoreboard()
+
+class _MirrorCircuitBreaker:
+    """
+    Process-wide circuit breaker per mirror host.
+    Opens after CIRCUIT_BREAKER_THRESHOLD consecutive failures so every worker skips the host at once,
+    then lets a single trial request through (half-open) every CIRCUIT_BREAKER_COOLDOWN seconds until one succeeds.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _state(self, host: str) -> dict:
+        return self._hosts.setdefault(host, {"failures": 0, "opened_at": None, "probing": False})
+
+    def is_open(self, host: str) -> bool:
+        """Check without claiming the half-open trial request."""
+        with self._lock:
+            state = self._hosts.get(host)
+            return bool(state and state["opened_at"] is not None)
+
+    def allow(self, host: str) -> bool:
+        """
+        Return True if a request to "host" may be sent now.
+        """
+        
+        with self._lock:
+            state = self._state(host)
+            if state["opened_at"] is None:
+                return True
+            if state["probing"] or time.monotonic() - state["opened_at"] < CIRCUIT_BREAKER_COOLDOWN:
+                return False
+            state["probing"] = True # Half-open: this caller gets the one trial request.
+            return True
+
+    def record_success(self, host: str):
+        """Host answered, close its circuit."""
+        with self._lock:
+            state = self._state(host)
+            if state["opened_at"] is not None:
+                logger.info(f"Mirror host {host} is responding again, resuming downloads from it.")
+            state.update(failures=0, opened_at=None, probing=False)
+
+    def release(self, host: str):
+        """Give back an unused half-open trial (e.g. a hedged request won on another host) and keep the circuit open."""
+        with self._lock:
+            state = self._state(host)
+            if state["probing"]:
+                state.update(opened_at=time.monotonic(), probing=False)
+
+    def record_failure(self, host: str):
+        with self._lock:
+            state = self._state(host)
+            state["failures"] += 1
+            if state["probing"]:
+                state.update(opened_at=time.monotonic(), probing=False)
+            elif state["opened_at"] is None and state["failures"] >= CIRCUIT_BREAKER_THRESHOLD:
+                state["opened_at"] = time.monotonic()
+                logger.warning(
+                    f"Mirror host {host} failed {state['failures']} times in a row, skipping it for {CIRCUIT_BREAKER_COOLDOWN}s."
+                )
+
+_circuit_breaker = _MirrorCircuitBreaker()
+
+def _hedge_backup(mirrors: list, index: int, attempt: int):
+    """
+    Return the mirror to hedge the first attempt at mirrors[index] with, if hedging applies.
+    """
+    
+    if not HEDGED_REQUESTS or attempt != 1:
+        return None
+    for backup in mirrors[index + 1:]:
+        if not _circuit_breaker.is_open(_mirror_host(backup)):
+            return backup
+    return None
+
+def _timed_get(session, url: str, headers: dict = None):
+    """
+    Send a streaming GET through the shared rate limiter.
+    Returns (url, response, started, ttfb) where ttfb is the time until the response headers arrived.
+    """
+    
+    _sleep_unless_shutdown(_rate_limiter.reserve(_mirror_host(url)))
+    return _send_timed(session, url, headers)
+
+def _send_timed(session, url: str, headers: dict = None):
+    """
+    The request half of _timed_get, for callers that already waited for the rate limiter.
+    """
+    
+    started = time.monotonic()
+    r = session.get(url, headers=headers, timeout=(60, 60), stream=True)
+    _rate_limiter.feedback(_mirror_host(url), r.status_code, r.headers.get("Retry-After"))
+    return url, r, started, time.monotonic() - started
+
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+def _hedge_executor() -> ThreadPoolExecutor:
+    """The hedged request pool, created on first use so its threads carry the configured extension name."""
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(
+                max_workers=HEDGE_MAX_WORKERS, thread_name_prefix=f"{EXTENSION_NAME}-hedge"
+            )
+        return _hedge_pool
+
+def _close_hedged_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result()[1].close()
+
+def _record_hedged_failure(url: str, status_code: int = None):
+    """
+    Count a hedged request that failed against its mirror. The caller only sees the response it gets back,
+    so failures of the other request would otherwise be lost.
+    """
+    
+    host = _mirror_host(url)
+    _mirror_scoreboard.record_failure(host)
+    if status_code not in (429, 503): # Throttled, but the host is up.
+        _circuit_breaker.record_failure(host)
+
+def _settle_hedged_failures(futures: list, urls: dict):
+    """Record and close hedged requests that failed and are not handed back to the caller."""
+    for future in futures:
+        if future.exception() is not None:
+            _record_hedged_failure(urls[future])
+        else:
+            _record_hedged_failure(urls[future], future.result()[1].status_code)
+            future.result()[1].close()
+
+def _hedged_get(session, primary: str, backup: str, headers: dict = None):
+    """
+    Request "primary" and, if it has not responded by its p95 deadline, race "backup" against it.
+    The deadline is counted from when the rate limiter lets the primary through.
+    Returns the _send_timed result of the first mirror to answer with a usable status; the loser is closed.
+    """
+    
+    host = _mirror_host(primary)
+    _sleep_unless_shutdown(_rate_limiter.reserve(host))
+    deadline = _mirror_scoreboard.hedge_deadline(host)
+    urls = {_hedge_executor().submit(_send_timed, session, primary, headers): primary}
+    done, pending = futures_wait(set(urls), timeout=deadline)
+    if not done:
+        log(f"Hedging: {primary} has not responded after {deadline:.2f}s, also requesting {backup}", "debug")
+        future = _hedge_executor().submit(_timed_get, session, backup, headers)
+        urls[future] = backup
+        pending.add(future)
+
+    failed = []
+    while True:
+        for future in done:
+            if future.exception() is None and future.result()[1].status_code < 400:
+                for other in pending:
+                    other.cancel()
+                    other.add_done_callback(_close_hedged_response)
+                _settle_hedged_failures(failed, urls)
+                return future.result()
+            failed.append(future)
+        if not pending:
+            break
+        done, pending = futures_wait(pending, return_when=FIRST_COMPLETED)
+
+    # Nothing usable, hand back the first failure so the caller's retry handling applies.
+    _settle_hedged_failures(failed[1:], urls)
+    return failed[0].result()
+
+def _isolated_proxy(base_proxy: str, username: str, password: str) -> str:
+    """
+    Return "base_proxy" with SOCKS credentials set. Tor puts streams with different credentials on different circuits.
+    """
+    
+    parts = urlsplit(base_proxy)
+    host_port = parts.netloc.rsplit("@", 1)[-1]
+    return urlunsplit((parts.scheme, f"{username}:{password}@{host_port}", parts.path, "", ""))
+
+class _TorSessionPool:
+    """
+    Pool of requests sessions, each on its own isolated Tor circuit, warmed up and health-checked in the background.
+    Workers get sessions round-robin; a failing session is swapped for a hot spare instead of being rebuilt inline.
+    Checked out sessions are held until released, a retired session is only closed once nothing holds it.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = []
+        self._spares = []
+        self._next = 0
+        self._base_proxy = None
+        self._headers = {}
+        self._seeded = False # Set once the proxy and headers come from the downloader's own session.
+        self._generation = 0 # Bumped on reseed, so sessions warmed on the old proxy are dropped.
+        self._holds = {} # Session -> number of workers holding it.
+        self._retired = set() # Sessions out of the pool, closed when their last holder releases them.
+        self._stop = threading.Event()
+        self._refilling = threading.Lock()
+        self._thread = None
+
+    @property
+    def started(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _build_session(self):
+        session = requests.Session()
+        session.headers.update(self._headers)
+        proxy = _isolated_proxy(self._base_proxy, secrets.token_hex(8), secrets.token_hex(8))
+        session.proxies = {"http": proxy, "https": proxy}
+        return session
+
+    def _is_healthy(self, session) -> bool:
+        try:
+            return session.get(TOR_POOL_HEALTH_URL, timeout=TOR_POOL_HEALTH_TIMEOUT).ok
+        except Exception:
+            return False
+
+    def _warm_session(self):
+        """Build sessions until one passes a health check (a new circuit is built on its first request)."""
+        for _ in range(3):
+            session = self._build_session()
+            if self._is_healthy(session):
+                return session
+            session.close()
+        logger.warning(f"{EXTENSION_REFERRER}: Could not warm up a Tor session through {self._base_proxy}.")
+        return None
+
+    def _top_up(self):
+        """Warm sessions until the pool has TOR_POOL_SIZE active sessions and TOR_POOL_SPARES spares."""
+        if not self._refilling.acquire(blocking=False):
+            return # Another thread is already refilling.
+        try:
+            self._fill()
+        finally:
+            self._refilling.release()
+
+    def _fill(self):
+        while not self._stop.is_set():
+            with self._lock:
+                missing = TOR_POOL_SIZE - len(self._active) + TOR_POOL_SPARES - len(self._spares)
+                generation = self._generation
+            if missing <= 0:
+                return
+            with ThreadPoolExecutor(max_workers=missing) as pool:
+                warmed = [s for s in pool.map(lambda _: self._warm_session(), range(missing)) if s is not None]
+            if not warmed:
+                return
+            with self._lock:
+                stale = self._generation != generation or self._stop.is_set()
+                if not stale:
+                    for session in warmed:
+                        if len(self._active) < TOR_POOL_SIZE:
+                            self._active.append(session)
+                        else:
+                            self._spares.append(session)
+            if stale:
+                for session in warmed:
+                    session.close() # Warmed on a proxy that has since been replaced.
+                continue
+            log(f"{EXTENSION_REFERRER}: Tor pool has {len(self._active)} active and {len(self._spares)} spare sessions.", "debug")
+
+    def _health_loop(self):
+        self._top_up()
+        while not self._stop.wait(TOR_POOL_HEALTH_INTERVAL):
+            with self._lock:
+                sessions = list(self._active) + list(self._spares)
+            for session in sessions:
+                if not self._stop.is_set() and not self._is_healthy(session):
+                    log(f"{EXTENSION_REFERRER}: Tor session failed its health check, swapping it out.", "debug")
+                    self._retire(session)
+            self._top_up()
+
+    def _close_session(self, session):
+        _async_engine.discard(_session_proxy(session))
+        session.close()
+
+    def _retire(self, session):
+        """Remove a pooled session, promoting a spare into its active slot. Returns the promoted spare, if any."""
+        with self._lock:
+            replacement = None
+            if session in self._spares:
+                self._spares.remove(session)
+            elif session in self._active:
+                index = self._active.index(session)
+                if self._spares:
+                    replacement = self._active[index] = self._spares.pop(0)
+                else:
+                    del self._active[index]
+            else:
+                return None
+            if self._holds.get(session):
+                self._retired.add(session) # Still in use, its last holder closes it.
+                return replacement
+        self._close_session(session)
+        return replacement
+
+    def _seed(self, downloader_session):
+        proxy = _session_proxy(downloader_session)
+        self._base_proxy = proxy if proxy and proxy.startswith("socks") else TOR_SOCKS_PROXY
+        self._headers = dict(getattr(downloader_session, "headers", {}) or {})
+        self._seeded = downloader_session is not None
+        self._generation += 1
+
+    def start(self, downloader_session=None):
+        """
+        Start warming sessions in the background. Uses the downloader session's SOCKS proxy and headers if it has them.
+        A pool started without a session (from pre_run_hook) is rebuilt from the first downloader session it sees.
+        """
+        
+        with self._lock:
+            if not self.started:
+                self._seed(downloader_session)
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._health_loop, name=f"{EXTENSION_NAME}-tor-pool", daemon=True)
+                self._thread.start()
+                return
+            if downloader_session is None or self._seeded:
+                return
+            # Warmed before the downloader's session existed, so on the default proxy without its headers.
+            stale = self._active + self._spares
+            self._active, self._spares = [], []
+            self._seed(downloader_session)
+            held = {session for session in stale if self._holds.get(session)}
+            self._retired.update(held)
+        log(f"{EXTENSION_REFERRER}: Rebuilding the Tor pool on the downloader session's proxy and headers.", "debug")
+        for session in stale:
+            if session not in held:
+                self._close_session(session)
+        threading.Thread(target=self._top_up, name=f"{EXTENSION_NAME}-tor-pool-refill", daemon=True).start()
+
+    def _hold(self, session):
+        self._holds[session] = self._holds.get(session, 0) + 1
+        return session
+
+    def checkout(self, fallback):
+        """
+        Return the next warmed session round-robin, or "fallback" while the pool is still warming up.
+        Pooled sessions are held until passed to release().
+        """
+        with self._lock:
+            if not self._active:
+                return fallback
+            session = self._active[self._next % len(self._active)]
+            self._next += 1
+            return self._hold(session)
+
+    def release(self, session):
+        """Drop a hold taken by checkout() or replace(), closing the session if it was retired meanwhile."""
+        with self._lock:
+            count = self._holds.get(session)
+            if not count:
+                return # Not a pooled session (the fallback, or the pool was closed).
+            if count > 1:
+                self._holds[session] = count - 1
+                return
+            del self._holds[session]
+            if session not in self._retired:
+                return
+            self._retired.discard(session)
+        self._close_session(session)
+
+    def replace(self, failed):
+        """
+        Swap a failed session for a hot spare and return the replacement, held until passed to release().
+        Falls back to a fresh, not yet warmed session if no spare is ready.
+        """
+        
+        replacement = self._retire(failed)
+        with self._lock:
+            if replacement is None and self._spares:
+                replacement = self._spares.pop(0)
+                if len(self._active) < TOR_POOL_SIZE:
+                    self._active.append(replacement)
+                else:
+                    self._retired.add(replacement) # "failed" was not pooled and the pool is full.
+            if replacement is None:
+                replacement = self._build_session()
+                self._retired.add(replacement) # Never pooled, closed on release.
+            self._hold(replacement)
+        if self.started:
+            threading.Thread(target=self._top_up, name=f"{EXTENSION_NAME}-tor-pool-refill", daemon=True).start()
+        return replacement
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            sessions = self._active + self._spares + list(self._retired)
+            self._active, self._spares = [], []
+            self._holds.clear()
+            self._retired.clear()
+            self._seeded = False
+            self._thread = None
+        for session in sessions:
+            session.close()
+
+_tor_pool = _TorSessionPool()
+
+def _rotate_tor_session(downloader_session):
+    """
+    Return a session on a fresh Tor circuit: a hot spare from the pool if it is running, otherwise an inline rebuild.
+    Pass it to _tor_pool.release() when done.
+    """
+    
+    if TOR_SESSION_POOL and _tor_pool.started and isinstance(downloader_session, requests.Session):
+        return _tor_pool.replace(downloader_session)
+    return APIGet.session(referrer=f"{EXTENSION_NAME}", status="rebuild")
+
+def _download_page_threaded(gallery, page, urls, path, downloader_session, pbar=None, creator=None):
+    """
+    Blocking single page download used by the "threaded" engine.
+    Tries mirrors in order until one succeeds, with retries per mirror.
+    """
+    
+    if not isinstance(downloader_session, requests.Session):
+        downloader_session = requests.Session()
+
+    def try_download(session, mirrors, retries, tor_rotate=False):
+        """Try downloading with a given session and retry count."""
+        mirrors = _mirror_scoreboard.rank(mirrors)
+        for index, url in enumerate(mirrors):
+            host = _mirror_host(url)
+            for attempt in range(1, retries + 1):
+                if not _circuit_breaker.allow(host):
+                    log(f"Gallery {gallery}: Page {page}: Mirror host {host} is unavailable, skipping {url}", "debug")
+                    break
+                used_url = url
+                writer = _PageWriter(path)
+                try:
+                    backup = _hedge_backup(mirrors, index, attempt)
+                    if backup:
+                        used_url, r, started, ttfb = _hedged_get(session, url, backup, writer.request_headers())
+                    else:
+                        used_url, r, started, ttfb = _timed_get(session, url, writer.request_headers())
+                    used_host = _mirror_host(used_url)
+                    if used_host != host:
+                        _circuit_breaker.release(host) # Hedge won elsewhere, hand back any half-open trial.
+                    if r.status_code in (429, 503):
+                        # The shared limiter now holds every worker back, so just queue up again.
+                        _circuit_breaker.record_success(used_host) # Throttled, but the host is up.
+                        _mirror_scoreboard.record_failure(used_host)
+                        logger.warning(f"{r.status_code} rate limit hit for {used_url}, backing off {used_host}")
+                        r.close()
+                        continue
+                    if r.status_code == 416:
+                        r.close()
+                        if not writer.settle_unsatisfiable(r.headers):
+                            raise ValueError("Server rejected resume range, restarting page")
+                    else:
+                        r.raise_for_status()
+                        try:
+                            writer.begin(r.status_code, r.headers)
+                            writer.write_from(r)
+                            writer.commit(used_url)
+                        finally:
+                            writer.close()
+                        _mirror_scoreboard.record_success(used_host, ttfb, time.monotonic() - started - ttfb, writer.received)
+
+                    _circuit_breaker.record_success(used_host)
+                    log(f"Downloaded Gallery {gallery}: Page {page} -> {path}", "debug")
+                    if pbar and creator:
+                        pbar.set_postfix_str(f"Creator: {creator}")
+                    return True
+
+                except _InvalidPageError as e:
+                    _mirror_scoreboard.record_failure(_mirror_host(used_url))
+                    _circuit_breaker.record_failure(_mirror_host(used_url))
+                    log_clarification()
+                    logger.warning(f"Gallery {gallery}: Page {page}: Mirror {used_url} sent an invalid page ({e}), trying next mirror")
+                    break
+
+                except Exception as e:
+                    _mirror_scoreboard.record_failure(_mirror_host(used_url))
+                    _circuit_breaker.record_failure(_mirror_host(used_url))
+                    wait = dynamic_sleep("image", attempt=attempt)
+                    log_clarification()
+                    logger.warning(
+                        f"Gallery {gallery}: Page {page}: Mirror {used_url}, attempt {attempt} failed: {e}, retrying in {wait:.2f}s"
+                    )
+                    _sleep_unless_shutdown(wait)
+                    if _shutdown_requested():
+                        return False
+
+            else:
+                logger.warning(
+                    f"Gallery {gallery}: Page {page}: Mirror {url} failed after {retries} attempts, trying next mirror"
+                )
+        return False
+
+    # First attempt: normal retries
+    success = try_download(downloader_session, urls, orchestrator.max_retries)
+
+    # If still failed, rebuild Tor session once and retry
+    if not success and orchestrator.use_tor and not _shutdown_requested():
+        logger.warning(
+            f"Gallery {gallery}: Page {page}: All retries failed, rotating Tor node and retrying once more..."
+        )
+        rotated = _rotate_tor_session(downloader_session)
+        try:
+            success = try_download(rotated, urls, 1, tor_rotate=True)
+        finally:
+            _tor_pool.release(rotated)
+
+    if not success:
+        log_clarification()
+        logger.error(
+            f"Gallery {gallery}: Page {page}: All mirrors failed after Tor rotate too: {urls}"
+        )
+        if pbar and creator:
+            pbar.set_postfix_str(f"Failed Creator: {creator}")
+
+    return success
+
+def _session_proxy(downloader_session):
+    """
+    Return the proxy URL a requests session sends image traffic through, if any.
+    """
+    
+    proxies = getattr(downloader_session, "proxies", None) or {}
+    return proxies.get("https") or proxies.get("http")
+
+def _async_engine_usable(downloader_session) -> bool:
+    """
+    Check if the asyncio engine is enabled and can reach the mirrors the same way the session does.
+    """
+    
+    if str(DOWNLOAD_ENGINE).lower() != "asyncio":
+        return False
+    if aiohttp is None:
+        logger.warning(f"{EXTENSION_REFERRER}: DOWNLOAD_ENGINE is 'asyncio' but aiohttp is not installed, using threaded downloads.")
+        return False
+    proxy = _session_proxy(downloader_session)
+    if proxy and proxy.startswith("socks") and ProxyConnector is None:
+        logger.warning(f"{EXTENSION_REFERRER}: aiohttp-socks is not installed, cannot use SOCKS proxy '{proxy}' with asyncio, using threaded downloads.")
+        return False
+    return True
+
+class _AsyncDownloadEngine:
+    """
+    One background event loop shared by every downloader thread.
+    Keeps a pooled aiohttp session per proxy so galleries reuse open connections.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._sessions = {} # Only touched from the event loop thread.
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None or not self._thread.is_alive():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name=f"{EXTENSION_NAME}-async-downloads", daemon=True
+                )
+                self._thread.start()
+            return self._loop
+
+    def run(self, coro):
+        """Run a coroutine on the shared loop and block the calling thread until it finishes."""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop()).result()
+
+    def session_for(self, proxy):
+        """Return the pooled session for a proxy. Must be called from the event loop thread."""
+        session = self._sessions.get(proxy)
+        if session is None or session.closed:
+            if proxy and proxy.startswith("socks"):
+                connector = ProxyConnector.from_url(proxy, limit=ASYNC_POOL_SIZE)
+            else:
+                connector = aiohttp.TCPConnector(limit=ASYNC_POOL_SIZE)
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(sock_connect=60, sock_read=60),
+            )
+            self._sessions[proxy] = session
+        return session
+
+    async def _close_sessions(self):
+        for session in self._sessions.values():
+            if not session.closed:
+                await session.close()
+        self._sessions.clear()
+
+    async def _close_session(self, proxy):
+        session = self._sessions.pop(proxy, None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    def discard(self, proxy):
+        """Close the pooled session for a proxy that is no longer used (e.g. a retired Tor circuit)."""
+        with self._lock:
+            loop = self._loop
+        if loop is not None and proxy:
+            asyncio.run_coroutine_threadsafe(self._close_session(proxy), loop)
+
+    def close(self):
+        """Close pooled connections and stop the loop."""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop, self._thread = None, None
+        if loop is None:
+            return
+        if thread.is_alive():
+            asyncio.run_coroutine_threadsafe(self._close_sessions(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout=10)
+        loop.close()
+
+_async_engine = _AsyncDownloadEngine()
+
+async def _timed_get_async(session, url: str, headers: dict, proxy, reserved: bool = False):
+    """
+    Asyncio version of _timed_get. The caller must release the returned response.
+    "reserved" skips the rate limiter, for callers that already waited for it.
+    """
+    
+    host = _mirror_host(url)
+    if not reserved:
+        await asyncio.sleep(_rate_limiter.reserve(host))
+    started = time.monotonic()
+    r = await session.get(url, headers=headers, proxy=proxy)
+    _rate_limiter.feedback(host, r.status, r.headers.get("Retry-After"))
+    return url, r, started, time.monotonic() - started
+
+def _settle_hedged_failures_async(tasks: list, urls: dict):
+    """Asyncio version of _settle_hedged_failures."""
+    for task in tasks:
+        if task.exception() is not None:
+            _record_hedged_failure(urls[task])
+        else:
+            _record_hedged_failure(urls[task], task.result()[1].status)
+            task.result()[1].release()
+
+async def _hedged_get_async(session, primary: str, backup: str, headers: dict, proxy):
+    """
+    Asyncio version of _hedged_get. The loser is cancelled, or released if it already answered.
+    The deadline is counted from when the rate limiter lets the primary through.
+    """
+    
+    host = _mirror_host(primary)
+    await asyncio.sleep(_rate_limiter.reserve(host))
+    deadline = _mirror_scoreboard.hedge_deadline(host)
+    urls = {asyncio.ensure_future(_timed_get_async(session, primary, headers, proxy, reserved=True)): primary}
+    done, pending = await asyncio.wait(set(urls), timeout=deadline)
+    if not done:
+        log(f"Hedging: {primary} has not responded after {deadline:.2f}s, also requesting {backup}", "debug")
+        task = asyncio.ensure_future(_timed_get_async(session, backup, headers, proxy))
+        urls[task] = backup
+        pending.add(task)
+
+    failed = []
+    while True:
+        for task in done:
+            if task.exception() is None and task.result()[1].status < 400:
+                for other in pending:
+                    other.cancel()
+                _settle_hedged_failures_async(failed, urls)
+                return task.result()
+            failed.append(task)
+        if not pending:
+            break
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+    # Nothing usable, hand back the first failure so the caller's retry handling applies.
+    _settle_hedged_failures_async(failed[1:], urls)
+    return failed[0].result()
+
+async def _download_page_async(gallery, page, urls, path, downloader_session, retries, in_flight, pbar=None, creator=None):
+    """
+    Download a single page on the shared event loop.
+    Tries mirrors in order until one succeeds, with retries per mirror.
+    """
+    
+    proxy = _session_proxy(downloader_session)
+    session = _async_engine.session_for(proxy)
+    request_proxy = proxy if proxy and not proxy.startswith("socks") else None # SOCKS is handled by the connector.
+    headers = dict(getattr(downloader_session, "headers", {}) or {})
+
+    urls = _mirror_scoreboard.rank(urls)
+    for index, url in enumerate(urls):
+        host = _mirror_host(url)
+        for attempt in range(1, retries + 1):
+            if _shutdown_requested():
+                return False
+            if not _circuit_breaker.allow(host):
+                log(f"Gallery {gallery}: Page {page}: Mirror host {host} is unavailable, skipping {url}", "debug")
+                break
+            used_url = url
+            wait = None
+            # The slot is only held for the request itself, not the backoff after a failed attempt.
+            async with in_flight:
+                try:
+                    # Disk work (opening, flushing, renaming into place, the page store) runs on worker threads,
+                    # so one slow disk does not stall every download on the loop.
+                    writer = await asyncio.to_thread(_PageWriter, path)
+                    request_headers = {**headers, **writer.request_headers()}
+                    backup = _hedge_backup(urls, index, attempt)
+                    if backup:
+                        used_url, r, started, ttfb = await _hedged_get_async(session, url, backup, request_headers, request_proxy)
+                    else:
+                        used_url, r, started, ttfb = await _timed_get_async(session, url, request_headers, request_proxy)
+                    used_host = _mirror_host(used_url)
+                    try:
+                        if used_host != host:
+                            _circuit_breaker.release(host) # Hedge won elsewhere, hand back any half-open trial.
+                        if r.status in (429, 503):
+                            # The shared limiter now holds every worker back, so just queue up again.
+                            _circuit_breaker.record_success(used_host) # Throttled, but the host is up.
+                            _mirror_scoreboard.record_failure(used_host)
+                            logger.warning(f"{r.status} rate limit hit for {used_url}, backing off {used_host}")
+                            continue
+                        if r.status == 416:
+                            if not await asyncio.to_thread(writer.settle_unsatisfiable, r.headers):
+                                raise ValueError("Server rejected resume range, restarting page")
+                        else:
+                            r.raise_for_status()
+                            try:
+                                await asyncio.to_thread(writer.begin, r.status, r.headers)
+                                async for chunk in r.content.iter_chunked(PAGE_WRITE_BUFFER_SIZE):
+                                    if writer.buffer(chunk):
+                                        await asyncio.to_thread(writer.flush)
+                                await asyncio.to_thread(writer.commit, used_url)
+                            finally:
+                                await asyncio.to_thread(writer.close)
+                            _mirror_scoreboard.record_success(used_host, ttfb, time.monotonic() - started - ttfb, writer.received)
+                    finally:
+                        r.release()
+
+                    _circuit_breaker.record_success(used_host)
+                    log(f"Downloaded Gallery {gallery}: Page {page} -> {path}", "debug")
+                    if pbar and creator:
+                        pbar.set_postfix_str(f"Creator: {creator}")
+                    return True
+
+                except _InvalidPageError as e:
+                    _mirror_scoreboard.record_failure(_mirror_host(used_url))
+                    _circuit_breaker.record_failure(_mirror_host(used_url))
+                    log_clarification()
+                    logger.warning(f"Gallery {gallery}: Page {page}: Mirror {used_url} sent an invalid page ({e}), trying next mirror")
+                    break
+
+                except Exception as e:
+                    _mirror_scoreboard.record_failure(_mirror_host(used_url))
+                    _circuit_breaker.record_failure(_mirror_host(used_url))
+                    wait = dynamic_sleep("image", attempt=attempt)
+                    log_clarification()
+                    logger.warning(
+                        f"Gallery {gallery}: Page {page}: Mirror {used_url}, attempt {attempt} failed: {e}, retrying in {wait:.2f}s"
+                    )
+            if wait is not None:
+                await asyncio.sleep(wait)
+
+        else:
+            logger.warning(
+                f"Gallery {gallery}: Page {page}: Mirror {url} failed after {retries} attempts, trying next mirror"
+            )
+    return False
+
+async def _download_pages_async(gallery, pages, downloader_session, retries, max_in_flight, pbar=None, creator=None):
+    """
+    Download a list of (page, urls, path) with at most "max_in_flight" requests running at once.
+    """
+    
+    in_flight = asyncio.Semaphore(max(1, max_in_flight))
+    outcomes = await asyncio.gather(*[
+        _download_page_async(gallery, page, urls, path, downloader_session, retries, in_flight, pbar, creator)
+        for page, urls, path in pages
+    ], return_exceptions=True)
+    return {page: outcome is True for (page, _, _), outcome in zip(pages, outcomes)}
+
+def _download_gallery_async(gallery, pages, downloader_session, max_in_flight, pbar=None, creator=None):
+    """
+    Download pages with the asyncio engine, rotating Tor once for any pages that still failed.
+    """
+    
+    results = _async_engine.run(
+        _download_pages_async(gallery, pages, downloader_session, orchestrator.max_retries, max_in_flight, pbar, creator)
+    )
+    failed = [entry for entry in pages if not results.get(entry[0])]
+
+    # If still failed, rebuild Tor session once and retry
+    if failed and orchestrator.use_tor and not _shutdown_requested():
+        logger.warning(
+            f"Gallery {gallery}: {len(failed)} page(s) failed, rotating Tor node and retrying once more..."
+        )
+        rotated = _rotate_tor_session(downloader_session)
+        try:
+            results.update(_async_engine.run(
+                _download_pages_async(gallery, failed, rotated, 1, max_in_flight, pbar, creator)
+            ))
+        finally:
+            _tor_pool.release(rotated)
+
+    for page, urls, _ in pages:
+        if not results.get(page):
+            log_clarification()
+            logger.error(
+                f"Gallery {gallery}: Page {page}: All mirrors failed after Tor rotate too: {urls}"
+            )
+            if pbar and creator:
+                pbar.set_postfix_str(f"Failed Creator: {creator}")
+
+    return results
+
+####################################################################################################################
+# ARCHIVER (thread-safe)
+####################################################################################################################
+
+def _build_archive(gallery_path: str, archive_path: str, compresslevel=None, stored_extensions=()) -> int:
+    """
+    Zip a gallery folder into "archive_path". Runs in an archiver worker process, so it must stay picklable (top level)
+    and must not touch logging. Writes to a temporary file first, so a finished archive is never half written.
+    Files whose extension is in "stored_extensions" (already compressed images) are stored, the rest are deflated.
+    Returns the number of files archived.
+    """
+    
+    import zipfile
+    temp_path = f"{archive_path}.tmp"
+    count = 0
+    try:
+        with zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as archive:
+            for root, _, files in os.walk(gallery_path):
+                for file in sorted(files):
+                    if file.endswith(PART_FILE_SUFFIX):
+                        continue # Unfinished page, never archive it.
+                    file_path = os.path.join(root, file)
+                    stored = os.path.splitext(file)[1].lower() in stored_extensions
+                    archive.write(
+                        file_path, os.path.relpath(file_path, gallery_path),
+                        compress_type=zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED,
+                    )
+                    count += 1
+        os.replace(temp_path, archive_path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return count
+
+class _GalleryArchiver:
+    """
+    Builds gallery archives on a process pool, so downloads keep going while galleries compress on other cores.
+    At most ARCHIVE_QUEUE_SIZE jobs are queued or running; submitting more blocks the caller until a slot frees up.
+    The gallery folder is deleted once its archive has been written.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._slots = None
+        self._jobs = {} # Archive path -> future of its queued job.
+        self._broken = False # Set when worker processes can't be used, archives are then built inline.
+
+    def _ensure_pool(self):
+        with self._lock:
+            if self._broken or ARCHIVE_WORKERS < 1:
+                return None
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=ARCHIVE_WORKERS)
+                self._slots = threading.BoundedSemaphore(max(1, ARCHIVE_QUEUE_SIZE))
+            return self._pool
+
+    def submit(self, gallery_path: str, archive_path: str):
+        """
+        Queue a gallery for archiving. Returns the job's future, or None if it was archived inline.
+        """
+        
+        # Settings are passed along, worker processes may not share this module's runtime state.
+        gallery_format = os.path.splitext(archive_path)[1].lstrip(".").lower()
+        job = (gallery_path, archive_path, ARCHIVE_COMPRESSION_LEVELS.get(gallery_format), tuple(ARCHIVE_STORED_EXTENSIONS))
+        pool = self._ensure_pool()
+        if pool is not None:
+            slots = self._slots
+            slots.acquire()
+            try:
+                future = pool.submit(_build_archive, *job)
+            except Exception as e:
+                slots.release()
+                with self._lock:
+                    self._broken = True
+                logger.warning(f"{EXTENSION_REFERRER}: Archiver pool unavailable ({e}), archiving inline.")
+            else:
+                with self._lock:
+                    self._jobs[archive_path] = future
+                future.add_done_callback(lambda f: self._finish(f, job, slots))
+                log(f"{EXTENSION_REFERRER}: Queued gallery {gallery_path} for archiving", "debug")
+                return future
+
+        try:
+            _build_archive(*job)
+        except Exception as e:
+            logger.error(f"{EXTENSION_REFERRER}: Failed to archive gallery {gallery_path}: {e}")
+            return None
+        self.delete_source(gallery_path, archive_path)
+        return None
+
+    def _finish(self, future, job: tuple, slots):
+        gallery_path, archive_path = job[:2]
+        slots.release()
+        with self._lock:
+            if self._jobs.get(archive_path) is future:
+                del self._jobs[archive_path]
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            if isinstance(error, (BrokenProcessPool, PicklingError)):
+                with self._lock:
+                    self._broken = True
+                logger.warning(f"{EXTENSION_REFERRER}: Archiver pool failed ({error}), archiving {gallery_path} inline.")
+                try:
+                    _build_archive(*job)
+                except Exception as e:
+                    logger.error(f"{EXTENSION_REFERRER}: Failed to archive gallery {gallery_path}: {e}")
+                    return
+            else:
+                logger.error(f"{EXTENSION_REFERRER}: Failed to archive gallery {gallery_path}: {error}")
+                return
+        self.delete_source(gallery_path, archive_path)
+
+    def delete_source(self, gallery_path: str, archive_path: str):
+        """Delete the original gallery folder now that its archive exists."""
+        logger.debug(f"{EXTENSION_REFERRER}: Archived gallery {gallery_path} to {archive_path}")
+        _gallery_index.replace(gallery_path, archive_path)
+        _gallery_links.replace(gallery_path, archive_path)
+        if os.path.isdir(gallery_path) and os.path.exists(archive_path):
+            try:
+                shutil.rmtree(gallery_path)
+                logger.debug(f"Deleted original gallery folder: {gallery_path}")
+            except Exception as e:
+                logger.error(f"Failed to delete gallery folder {gallery_path}: {e}")
+
+    def future_for(self, archive_path: str):
+        """The queued job writing "archive_path", if any."""
+        with self._lock:
+            return self._jobs.get(archive_path)
+
+    def drain(self):
+        """Block until every queued archive is written (and its folder deleted)."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        if jobs:
+            log(f"{EXTENSION_REFERRER}: Waiting for {len(jobs)} archive(s) to finish", "debug")
+            futures_wait(jobs)
+
+    def close(self):
+        self.drain()
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self._broken = False
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+_archiver = _GalleryArchiver()
+
+class _StreamingArchive:
+    """
+    An open "zip" / "cbz" archive that finished pages are appended to directly (ARCHIVE_STREAMING),
+    so the gallery folder is never written to disk. Finalized into place by the post-download hook.
+    A readable temporary archive left by an earlier run is appended to, and pages of an already finished archive
+    count as downloaded and are carried over when it is replaced.
+    """
+    
+    def __init__(self, folder: str, archive_path: str):
+        import zipfile
+        self._zipfile = zipfile
+        self.folder = folder
+        self.archive_path = archive_path
+        self.temp_path = f"{archive_path}.tmp"
+        self.cover = None # (name, bytes) of page 1, kept in memory for cover extraction.
+        self._lock = threading.Lock()
+        self._names = set()
+        self._existing = self._names_in(archive_path) or set() # Pages of a finished archive already in place.
+        os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+        mode = "w"
+        if os.path.exists(self.temp_path):
+            resumed = self._names_in(self.temp_path)
+            if resumed is None:
+                # Never closed (the run died mid-write), there is no central directory to append to.
+                logger.warning(f"{EXTENSION_REFERRER}: Discarding unreadable partial archive {self.temp_path}")
+            else:
+                mode, self._names = "a", resumed
+        gallery_format = os.path.splitext(archive_path)[1].lstrip(".").lower()
+        self._archive = zipfile.ZipFile(
+            self.temp_path, mode, zipfile.ZIP_DEFLATED, compresslevel=ARCHIVE_COMPRESSION_LEVELS.get(gallery_format)
+        )
+        for name in sorted(self._names):
+            if name.startswith("1."):
+                self.cover = (name, self._archive.read(name))
+                break
+
+    def _names_in(self, path: str):
+        """Entry names of the archive at "path", an empty set if there is none, or None if it can't be read."""
+        if not os.path.exists(path):
+            return set()
+        try:
+            with self._zipfile.ZipFile(path) as archive:
+                return set(archive.namelist())
+        except (self._zipfile.BadZipFile, OSError):
+            return None
+
+    def _compress_type(self, name: str):
+        if os.path.splitext(name)[1].lower() in ARCHIVE_STORED_EXTENSIONS:
+            return self._zipfile.ZIP_STORED
+        return self._zipfile.ZIP_DEFLATED
+
+    def has(self, name: str) -> bool:
+        with self._lock:
+            return name in self._names or name in self._existing
+
+    def add(self, name: str, data: bytes):
+        with self._lock:
+            if name in self._names or self._archive is None:
+                return
+            self._archive.writestr(name, data, compress_type=self._compress_type(name))
+            self._names.add(name)
+            if name.startswith("1."):
+                self.cover = (name, bytes(data))
+
+    def finalize(self) -> bool:
+        """
+        Close the archive and move it into place. Files that ended up in the gallery folder anyway
+        (written by something other than the page writer) are added and the folder is removed.
+        """
+        
+        with self._lock:
+            if self._archive is None:
+                return False
+            if os.path.isdir(self.folder):
+                for root, _, files in os.walk(self.folder):
+                    for file in sorted(files):
+                        if file.endswith(PART_FILE_SUFFIX):
+                            continue # Unfinished page, never archive it.
+                        file_path = os.path.join(root, file)
+                        name = os.path.relpath(file_path, self.folder)
+                        if name not in self._names:
+                            self._archive.write(file_path, name, compress_type=self._compress_type(name))
+                            self._names.add(name)
+                            if name.startswith("1.") and self.cover is None:
+                                with open(file_path, "rb") as f:
+                                    self.cover = (name, f.read())
+            if not self._names:
+                self._archive.close()
+                self._archive = None
+                os.unlink(self.temp_path)
+                return False # Nothing new, a finished archive already in place stays as it is.
+            self._carry_over_existing()
+            self._archive.close()
+            self._archive = None
+            os.replace(self.temp_path, self.archive_path)
+        _gallery_index.replace(self.folder, self.archive_path)
+        if os.path.isdir(self.folder):
+            shutil.rmtree(self.folder, ignore_errors=True)
+        return True
+
+    def _carry_over_existing(self):
+        """Copy pages of the finished archive about to be replaced that this archive doesn't have."""
+        missing = self._existing - self._names
+        if not missing:
+            return
+        try:
+            with self._zipfile.ZipFile(self.archive_path) as existing:
+                for name in sorted(missing):
+                    data = existing.read(name)
+                    self._archive.writestr(name, data, compress_type=self._compress_type(name))
+                    self._names.add(name)
+                    if name.startswith("1.") and self.cover is None:
+                        self.cover = (name, data)
+        except (self._zipfile.BadZipFile, OSError, KeyError) as e:
+            logger.warning(f"{EXTENSION_REFERRER}: Could not carry pages over from {self.archive_path}: {e}")
+
+_streaming_archives = {} # Gallery folder -> _StreamingArchive.
+_streaming_archives_lock = threading.Lock()
+
+def _streaming_archive_for(path: str):
+    """
+    Return the open streaming archive a page at "path" belongs in, or None when pages go to the gallery folder.
+    """
+    
+    if not ARCHIVE_STREAMING:
+        return None
+    gallery_format = str(orchestrator.gallery_format).lower()
+    if gallery_format not in {"zip", "cbz"}:
+        return None
+    folder = os.path.dirname(path)
+    with _streaming_archives_lock:
+        archive = _streaming_archives.get(folder)
+        if archive is None:
+            archive = _streaming_archives[folder] = _StreamingArchive(folder, f"{folder}.{gallery_format}")
+        return archive
+
+def _archive_in_progress(archive_path: str) -> bool:
+    """
+    Return True if this process is writing "archive_path": a queued archiver job or an open streaming archive.
+    A "<archive>.tmp" with neither is left over from an interrupted run. It is removed, so the caller rebuilds
+    the archive instead of waiting ARCHIVE_WAIT_SECONDS for a file nobody is writing.
+    """
+    
+    if _archiver.future_for(archive_path) is not None:
+        return True
+    with _streaming_archives_lock:
+        archive = _streaming_archives.get(os.path.splitext(archive_path)[0])
+        if archive is not None and archive.archive_path == archive_path:
+            return True
+    temp_path = f"{archive_path}.tmp"
+    try:
+        os.unlink(temp_path)
+        log(f"{EXTENSION_REFERRER}: Removed stale partial archive {temp_path}", "debug")
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"{EXTENSION_REFERRER}: Could not remove stale partial archive {temp_path}: {e}")
+    return False
+
+def _finalize_streaming_archives(gallery_id=None) -> list:
+    """
+    Finalize open streaming archives, either for one gallery (matched by its "(<id>)" folder prefix) or all of them.
+    Returns the archives that were written.
+    """
+    
+    with _streaming_archives_lock:
+        folders = [
+            folder for folder in _streaming_archives
+            if gallery_id is None or os.path.basename(folder).startswith(f"({gallery_id})")
+        ]
+        archives = [_streaming_archives.pop(folder) for folder in folders]
+    finalized = []
+    for archive in archives:
+        try:
+            if archive.finalize():
+                finalized.append(archive)
+                logger.debug(f"{EXTENSION_REFERRER}: Finalized streamed archive {archive.archive_path}")
+        except Exception as e:
+            logger.error(f"{EXTENSION_REFERRER}: Failed to finalize streamed archive {archive.archive_path}: {e}")
+    return finalized
+
+class _ArchiveWatcher:
+    """
+    Calls back when an archive file appears, without any thread waiting on it.
+    Archives queued on _archiver complete through their job's future. Anything else (streaming archives) is
+    watched with inotify on Linux, or by one shared polling thread elsewhere.
+    Callbacks get True once the archive exists, or False after "timeout" seconds.
+    """
+    
+    _IN_CREATE = 0x100
+    _IN_CLOSE_WRITE = 0x8
+    _IN_MOVED_TO = 0x80
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock) # Notified when the last waiter settles.
+        self._waiters = {} # Archive path -> list of (deadline, callback).
+        self._thread = None
+        self._wake_r = self._wake_w = None
+        self._inotify = None # (libc, fd) when inotify is available.
+        self._watches = {} # Directory -> inotify watch descriptor.
+
+    def when_ready(self, path: str, callback, timeout: float = None, future=None):
+        """
+        Run "callback(ready)" once "path" exists, or with False once "timeout" seconds have passed.
+        "future" is the _archiver job writing "path", when the caller already holds it.
+        """
+        timeout = ARCHIVE_WAIT_SECONDS if timeout is None else timeout
+        future = future or _archiver.future_for(path)
+        if future is not None:
+            future.add_done_callback(lambda _: callback(os.path.exists(path)))
+            return
+        with self._lock:
+            self._ensure_thread()
+            self._add_watch(os.path.dirname(path))
+            self._waiters.setdefault(path, []).append((time.monotonic() + timeout, callback))
+        self._wake() # Re-checks existence after the watch is in place, so nothing is missed.
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        self._wake_r, self._wake_w = os.pipe()
+        self._inotify = self._open_inotify()
+        self._thread = threading.Thread(target=self._run, name=f"{EXTENSION_NAME}-archive-watcher", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _open_inotify():
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        return (libc, fd) if fd >= 0 else None
+
+    def _add_watch(self, directory: str):
+        if self._inotify is None or directory in self._watches:
+            return
+        libc, fd = self._inotify
+        wd = libc.inotify_add_watch(fd, os.fsencode(directory), self._IN_CREATE | self._IN_CLOSE_WRITE | self._IN_MOVED_TO)
+        if wd >= 0:
+            self._watches[directory] = wd
+
+    def _wake(self):
+        if self._wake_w is not None:
+            try:
+                os.write(self._wake_w, b"\0")
+            except OSError:
+                pass
+
+    def _drain_inotify(self):
+        # Events only say "something changed", _settle re-checks the waited-on paths themselves.
+        try:
+            while os.read(self._inotify[1], 65536):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _settle(self) -> float:
+        """Fire callbacks for archives that appeared or timed out. Returns seconds until the next deadline."""
+        now = time.monotonic()
+        fired = []
+        with self._lock:
+            for path in list(self._waiters):
+                exists = os.path.exists(path)
+                pending = []
+                for deadline, callback in self._waiters[path]:
+                    if exists or deadline <= now:
+                        fired.append((callback, exists))
+                    else:
+                        pending.append((deadline, callback))
+                if pending:
+                    self._waiters[path] = pending
+                else:
+                    del self._waiters[path]
+            self._prune_watches()
+            deadlines = [deadline for waiters in self._waiters.values() for deadline, _ in waiters]
+            if not self._waiters:
+                self._idle.notify_all()
+        for callback, exists in fired:
+            try:
+                callback(exists)
+            except Exception as e:
+                logger.error(f"{EXTENSION_REFERRER}: Archive callback failed: {e}")
+        if not deadlines:
+            return None
+        wait = max(0.0, min(deadlines) - now)
+        # Without inotify nothing tells us a file appeared, so poll.
+        return wait if self._inotify is not None else min(wait, ARCHIVE_POLL_INTERVAL)
+
+    def _prune_watches(self):
+        if self._inotify is None:
+            return
+        watched = {os.path.dirname(path) for path in self._waiters}
+        libc, fd = self._inotify
+        for directory in [d for d in self._watches if d not in watched]:
+            libc.inotify_rm_watch(fd, self._watches.pop(directory))
+
+    def _run(self):
+        timeout = None
+        while True:
+            sources = [self._wake_r] + ([self._inotify[1]] if self._inotify is not None else [])
+            readable, _, _ = select.select(sources, [], [], timeout)
+            if self._wake_r in readable:
+                data = os.read(self._wake_r, 4096)
+                if b"\1" in data:
+                    break
+            if self._inotify is not None and self._inotify[1] in readable:
+                self._drain_inotify()
+            try:
+                timeout = self._settle()
+            except Exception as e:
+                logger.error(f"{EXTENSION_REFERRER}: Archive watcher error: {e}")
+                timeout = ARCHIVE_POLL_INTERVAL
+
+    def close(self):
+        """Wait for outstanding archives (up to their timeouts), then stop the watcher thread."""
+        with self._lock:
+            thread = self._thread
+        if thread is None:
+            return
+        with self._idle:
+            self._idle.wait_for(lambda: not self._waiters)
+        os.write(self._wake_w, b"\1")
+        thread.join()
+        with self._lock:
+            if self._inotify is not None:
+                os.close(self._inotify[1])
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._thread = self._inotify = self._wake_r = self._wake_w = None
+            self._watches.clear()
+
+_archive_watcher = _ArchiveWatcher()
+
+def _archived_elsewhere(gallery_id, gallery_path: str, archive_path: str, ready: bool):
+    """
+    _archive_watcher callback for a gallery whose archive is written by another worker.
+    """
+    
+    if not ready:
+        logger.warning(
+            f"Archive not found for Gallery {gallery_id} after {ARCHIVE_WAIT_SECONDS}s: "
+            f"expected {archive_path}; leaving folder undeleted"
+        )
+        logger.info(
+            f"Leaving original folder in place: {gallery_path}"
+        )
+        return
+    _archiver.delete_source(gallery_path, archive_path)
+
+####################################################################################################################
+# LIBRARY INDEX (thread-safe)
+####################################################################################################################
+
+def library_state_path(name: str) -> str:
+    """
+    Where persisted library state called "name" lives: next to the download path, outside the library itself.
+    """
+    
+    parent = os.path.dirname(os.path.normpath(DEDICATED_DOWNLOAD_PATH))
+    return os.path.join(parent, f".{EXTENSION_NAME}_{name}")
+
+def save_json_atomic(path: str, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+_GALLERY_NAME_RE = re.compile(r"^\((\d+)\)")
+
+class _GalleryIndex:
+    """
+    Gallery ID -> gallery folders / archives, so finding a finished gallery does not list every creator folder.
+    Folders are scanned once with os.scandir and rescanned only when their mtime changes. The page writer,
+    archiver and streaming archives keep the index current, and it is persisted between runs.
+    Every hit is checked with one stat, so entries removed behind our back are dropped.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._galleries = None # Gallery ID -> set of paths.
+        self._folders = {} # Scanned folder -> mtime_ns at scan time.
+        self._dirty = False
+
+    @staticmethod
+    def path() -> str:
+        return GALLERY_INDEX_PATH or library_state_path("gallery_index.json")
+
+    @staticmethod
+    def _gallery_id(path: str):
+        match = _GALLERY_NAME_RE.match(os.path.basename(path))
+        return match.group(1) if match else None
+
+    def _ensure_loaded(self):
+        if self._galleries is not None:
+            return
+        self._galleries = {}
+        try:
+            with open(self.path(), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._galleries = {gallery_id: set(paths) for gallery_id, paths in data.get("galleries", {}).items()}
+            self._folders = dict(data.get("folders", {}))
+        except (OSError, ValueError, AttributeError):
+            pass # Missing or unreadable, folders are scanned on first use.
+
+    def _scan(self, folder: str):
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+            entries = list(os.scandir(folder))
+        except OSError:
+            self._folders.pop(folder, None)
+            return
+        for entry in entries:
+            match = _GALLERY_NAME_RE.match(entry.name)
+            if not match:
+                continue
+            if entry.name.endswith((".cbz", ".zip")) or entry.is_dir():
+                self._galleries.setdefault(match.group(1), set()).add(entry.path)
+        self._folders[folder] = mtime
+        self._dirty = True
+
+    def _stale(self, folder: str) -> bool:
+        try:
+            return self._folders.get(folder) != os.stat(folder).st_mtime_ns
+        except OSError:
+            return False
+
+    def find(self, gallery_id, folder: str) -> list:
+        """
+        Sorted names of the gallery folders / archives for "gallery_id" directly inside "folder".
+        """
+        
+        gallery_id = str(gallery_id)
+        folder = os.path.normpath(folder)
+        with self._lock:
+            self._ensure_loaded()
+            if folder not in self._folders:
+                self._scan(folder)
+            for attempt in range(2):
+                paths = self._galleries.get(gallery_id, set())
+                names = []
+                for path in list(paths):
+                    if os.path.dirname(path) != folder:
+                        continue
+                    if os.path.exists(path):
+                        names.append(os.path.basename(path))
+                    else:
+                        paths.discard(path)
+                        self._dirty = True
+                if names or attempt or not self._stale(folder):
+                    return sorted(names)
+                self._scan(folder) # Something was added here behind our back, catch up once.
+        return []
+
+    def add(self, path: str):
+        gallery_id = self._gallery_id(path)
+        if gallery_id is None:
+            return
+        path = os.path.normpath(path)
+        with self._lock:
+            self._ensure_loaded()
+            paths = self._galleries.setdefault(gallery_id, set())
+            if path not in paths:
+                paths.add(path)
+                self._dirty = True
+
+    def replace(self, old_path: str, new_path: str):
+        """Record that a gallery moved, e.g. from its folder into an archive."""
+        old_id, gallery_id = self._gallery_id(old_path), self._gallery_id(new_path)
+        with self._lock:
+            self._ensure_loaded()
+            # Paths are only indexed under the ID in their name, so nothing else can hold old_path.
+            if old_id is not None and old_id in self._galleries:
+                self._galleries[old_id].discard(os.path.normpath(old_path))
+            if gallery_id is not None:
+                self._galleries.setdefault(gallery_id, set()).add(os.path.normpath(new_path))
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or self._galleries is None:
+                return
+            data = {
+                "folders": dict(self._folders),
+                "galleries": {gallery_id: sorted(paths) for gallery_id, paths in self._galleries.items() if paths},
+            }
+            self._dirty = False
+        try:
+            save_json_atomic(self.path(), data)
+        except OSError as e:
+            logger.warning(f"{EXTENSION_REFERRER}: Could not save gallery index: {e}")
+
+_gallery_index = _GalleryIndex()
+
+_FICLONE = 0x40049409 # ioctl request for reflinks (btrfs, XFS, bcachefs).
+
+def _materialize_file(source: str, destination: str, source_persists: bool = False) -> str:
+    """
+    Put a copy of "source" at "destination" as cheaply as the filesystem allows:
+    reflink, then hardlink, then an in-kernel copy_file_range. After that it falls back to a symlink
+    if "source" is going to stay where it is, or a byte copy otherwise.
+    Returns the method used.
+    """
+    
+    try:
+        os.unlink(destination)
+    except FileNotFoundError:
+        pass
+
+    try:
+        import fcntl
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        shutil.copystat(source, destination)
+        return "reflink"
+    except (ImportError, OSError):
+        try:
+            os.unlink(destination)
+        except FileNotFoundError:
+            pass
+
+    try:
+        os.link(source, destination)
+        return "hardlink"
+    except OSError:
+        pass
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining <= 0:
+                shutil.copystat(source, destination)
+                return "copy_file_range"
+        except OSError:
+            pass
+        try:
+            os.unlink(destination)
+        except FileNotFoundError:
+            pass
+
+    if source_persists:
+        os.symlink(os.path.abspath(source), destination)
+        return "symlink"
+    shutil.copy2(source, destination)
+    return "copy"
+
+class _CoverState:
+    """
+    Per creator folder: the gallery ID its cover comes from and the "cover<ext>" link pointing at it.
+    Lets the post-download hook decide whether a gallery's cover is newer in O(1), instead of scanning .covers
+    and the creator folder for every finished gallery. Persisted between runs, and checked with one lstat per lookup.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._creators = None # Creator folder -> {"id": int | None, "link": str | None}.
+        self._dirty = False
+
+    @staticmethod
+    def path() -> str:
+        return COVER_STATE_PATH or library_state_path("cover_state.json")
+
+    def _ensure_loaded(self):
+        if self._creators is not None:
+            return
+        self._creators = {}
+        try:
+            with open(self.path(), "r", encoding="utf-8") as f:
+                self._creators = dict(json.load(f).get("creators", {}))
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def current(self, creator_folder: str):
+        """
+        Return (latest cover gallery ID, current cover link) for a creator. The link is None when unknown.
+        """
+        
+        creator_folder = os.path.normpath(creator_folder)
+        with self._lock:
+            self._ensure_loaded()
+            state = self._creators.get(creator_folder)
+            if state is not None and (state.get("link") is None or os.path.lexists(state["link"])):
+                return state.get("id"), state.get("link")
+        # Unknown (or changed behind our back), fall back to a one-off scan of .covers.
+        covers_folder = os.path.join(creator_folder, ".covers")
+        latest_cover_id = find_latest_cover_id(covers_folder) if os.path.isdir(covers_folder) else None
+        with self._lock:
+            self._creators[creator_folder] = {"id": latest_cover_id, "link": None}
+            self._dirty = True
+        return latest_cover_id, None
+
+    def update(self, creator_folder: str, cover_id, link: str):
+        with self._lock:
+            self._ensure_loaded()
+            self._creators[os.path.normpath(creator_folder)] = {"id": cover_id, "link": link}
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or self._creators is None:
+                return
+            data = {"creators": dict(self._creators)}
+            self._dirty = False
+        try:
+            save_json_atomic(self.path(), data)
+        except OSError as e:
+            logger.warning(f"{EXTENSION_REFERRER}: Could not save cover state: {e}")
+
+_cover_state = _CoverState()
+
+def _build_thumbnail(source: str, destination: str, size: tuple, quality: int) -> str:
+    """
+    Write a downscaled copy of "source" to "destination" in the same image format. Runs in a thumbnailer worker
+    process, so it must stay picklable (top level) and must not touch logging. JPEGs are decoded at reduced
+    scale (draft), everything else is shrunk with reduce() before resampling.
+    """
+    
+    from PIL import Image
+    temp_path = f"{destination}.tmp"
+    with Image.open(source) as image:
+        image_format = image.format or "JPEG"
+        image.draft("RGB", size)
+        image.thumbnail(size, reducing_gap=2.0)
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        options = {"quality": quality, "optimize": True} if image_format in ("JPEG", "WEBP") else {}
+        image.save(temp_path, format=image_format, **options)
+    os.replace(temp_path, destination)
+    return destination
+
+class _CoverThumbnailer:
+    """
+    Builds downscaled creator covers on a process pool (COVER_THUMBNAILS) and points "cover<ext>" at them,
+    so clients don't decode full-size pages to draw a grid. Thumbnails are cached under .covers/.thumbs,
+    keyed on the source cover's size and mtime, so an unchanged cover is never resized twice.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._jobs = set()
+        self._broken = False
+
+    @staticmethod
+    def thumbnail_path(cover_path: str) -> str:
+        stat = os.stat(cover_path)
+        stem, ext = os.path.splitext(os.path.basename(cover_path))
+        width, height = COVER_THUMBNAIL_SIZE
+        name = f"{stem}.{stat.st_size}-{stat.st_mtime_ns}.{width}x{height}{ext}"
+        return os.path.join(os.path.dirname(cover_path), ".thumbs", name)
+
+    def submit(self, cover_path: str, cover_link: str):
+        """Swap "cover_link" (currently pointing at "cover_path") to a thumbnail once it exists."""
+        if Image is None:
+            return
+        try:
+            thumbnail = self.thumbnail_path(cover_path)
+        except OSError:
+            return
+        if os.path.exists(thumbnail):
+            self._relink(cover_path, cover_link, thumbnail)
+            return
+        os.makedirs(os.path.dirname(thumbnail), exist_ok=True)
+        job = (cover_path, thumbnail, tuple(COVER_THUMBNAIL_SIZE), COVER_THUMBNAIL_QUALITY)
+        with self._lock:
+            if self._pool is None and not self._broken and COVER_THUMBNAIL_WORKERS > 0:
+                self._pool = ProcessPoolExecutor(max_workers=COVER_THUMBNAIL_WORKERS)
+            pool = None if self._broken else self._pool
+        if pool is not None:
+            try:
+                future = pool.submit(_build_thumbnail, *job)
+            except Exception as e:
+                with self._lock:
+                    self._broken = True
+                logger.warning(f"{EXTENSION_REFERRER}: Thumbnail pool unavailable ({e}), resizing inline.")
+            else:
+                with self._lock:
+                    self._jobs.add(future)
+                future.add_done_callback(lambda f: self._finish(f, job, cover_link))
+                return
+        self._build_inline(job, cover_link)
+
+    def _build_inline(self, job: tuple, cover_link: str):
+        try:
+            _build_thumbnail(*job)
+        except Exception as e:
+            logger.debug(f"{EXTENSION_REFERRER}: Could not build thumbnail for {job[0]}: {e}")
+            return
+        self._relink(job[0], cover_link, job[1])
+
+    def _finish(self, future, job: tuple, cover_link: str):
+        with self._lock:
+            self._jobs.discard(future)
+        if future.cancelled():
+            return
+        error = future.exception()
+        if isinstance(error, (BrokenProcessPool, PicklingError)):
+            with self._lock:
+                self._broken = True
+            self._build_inline(job, cover_link)
+        elif error is not None:
+            logger.debug(f"{EXTENSION_REFERRER}: Could not build thumbnail for {job[0]}: {error}")
+        else:
+            self._relink(job[0], cover_link, job[1])
+
+    @staticmethod
+    def _relink(cover_path: str, cover_link: str, thumbnail: str):
+        # Only if the creator's cover hasn't moved on to a newer gallery in the meantime.
+        try:
+            if os.readlink(cover_link) != cover_path:
+                return
+            temp_link = f"{cover_link}.tmp"
+            if os.path.lexists(temp_link):
+                os.unlink(temp_link)
+            os.symlink(thumbnail, temp_link)
+            os.replace(temp_link, cover_link)
+            logger.debug(f"Updated cover symlink to thumbnail: {cover_link} -> {thumbnail}")
+        except OSError as e:
+            logger.debug(f"Could not point {cover_link} at thumbnail {thumbnail}: {e}")
+
+    def close(self):
+        with self._lock:
+            jobs = list(self._jobs)
+            pool, self._pool = self._pool, None
+            self._broken = False
+        if jobs:
+            futures_wait(jobs)
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+_thumbnailer = _CoverThumbnailer()
+
+class _GalleryLinks:
+    """
+    Canonical gallery copy -> the other creator folders' hardlinks / symlinks to it (SINGLE_COPY_GALLERIES).
+    Persisted, so cleanup_hook can repair or drop links whose canonical copy moved or disappeared.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._links = None # Canonical path -> set of link paths.
+        self._dirty = False
+
+    @staticmethod
+    def path() -> str:
+        return GALLERY_LINKS_PATH or library_state_path("gallery_links.json")
+
+    def _ensure_loaded(self):
+        if self._links is not None:
+            return
+        self._links = {}
+        try:
+            with open(self.path(), "r", encoding="utf-8") as f:
+                self._links = {canonical: set(links) for canonical, links in json.load(f).get("links", {}).items()}
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def link(self, canonical: str, link_path: str) -> str:
+        """
+        Replace whatever is at "link_path" with a hardlink to "canonical" (a symlink for folders or across
+        filesystems) and record it. Returns "hardlink" or "symlink".
+        """
+        
+        if os.path.isdir(link_path) and not os.path.islink(link_path):
+            shutil.rmtree(link_path)
+        elif os.path.lexists(link_path):
+            os.unlink(link_path)
+        method = "symlink"
+        if not os.path.isdir(canonical):
+            try:
+                os.link(canonical, link_path)
+                method = "hardlink"
+            except OSError:
+                pass
+        if method == "symlink":
+            os.symlink(os.path.abspath(canonical), link_path)
+        with self._lock:
+            self._ensure_loaded()
+            self._links.setdefault(os.path.normpath(canonical), set()).add(os.path.normpath(link_path))
+            self._dirty = True
+        _gallery_index.add(link_path)
+        return method
+
+    def replace(self, old_canonical: str, new_canonical: str):
+        """The canonical copy moved (e.g. its folder was archived)."""
+        with self._lock:
+            self._ensure_loaded()
+            links = self._links.pop(os.path.normpath(old_canonical), None)
+            if links:
+                self._links.setdefault(os.path.normpath(new_canonical), set()).update(links)
+                self._dirty = True
+
+    def reconcile(self):
+        """
+        Drop links that no longer exist, remove symlinks whose canonical copy is gone, and promote a
+        surviving hardlink to canonical when the original was deleted.
+        """
+        
+        with self._lock:
+            self._ensure_loaded()
+            links_by_canonical = {canonical: set(links) for canonical, links in self._links.items()}
+        updated = {}
+        for canonical, links in links_by_canonical.items():
+            links = {link for link in links if os.path.lexists(link)}
+            if not os.path.exists(canonical):
+                for link in [link for link in links if os.path.islink(link)]:
+                    try:
+                        os.unlink(link)
+                        logger.debug(f"Removed link to deleted gallery {canonical}: {link}")
+                    except OSError as e:
+                        logger.debug(f"Could not remove dangling gallery link {link}: {e}")
+                    links.discard(link)
+                if links:
+                    canonical = sorted(links)[0] # Hardlinks are full copies, any of them can take over.
+                    links.discard(canonical)
+            if links:
+                updated[canonical] = links
+        with self._lock:
+            if updated != self._links:
+                self._links = updated
+                self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or self._links is None:
+                return
+            data = {"links": {canonical: sorted(links) for canonical, links in self._links.items()}}
+            self._dirty = False
+        try:
+            save_json_atomic(self.path(), data)
+        except OSError as e:
+            logger.warning(f"{EXTENSION_REFERRER}: Could not save gallery links: {e}")
+
+_gallery_links = _GalleryLinks()
+
+class _MetadataWriteBehind:
+    """
+    Write-behind buffer for scraperdb.update_gallery_metadata. Post-download hooks queue their update and return,
+    and one flusher thread writes the buffer every DB_FLUSH_EVERY galleries or DB_FLUSH_INTERVAL seconds.
+    Repeated updates for one gallery are coalesced. Hooks flush synchronously at the end of each batch and run,
+    the flusher flushes as soon as the downloader asks to shut down, and an atexit handler catches anything left.
+    Callers that read the metadata back from the database pass "on_written", which runs once it has been written.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # One flush at a time, in queue order.
+        self._pending = {} # Gallery ID -> (update_gallery_metadata kwargs, on_written callbacks).
+        self._wake = threading.Event()
+        self._thread = None
+
+    def add(self, on_written=None, **kwargs):
+        """Queue an update_gallery_metadata call. "on_written" is called (no arguments) after it has been written."""
+        callbacks = [on_written] if on_written else []
+        if not DB_WRITE_BEHIND:
+            scraperdb.update_gallery_metadata(**kwargs)
+            self._run_callbacks(callbacks)
+            return
+        with self._lock:
+            previous = self._pending.get(kwargs["gallery_id"])
+            if previous:
+                callbacks = previous[1] + callbacks # Coalesced, but everyone waiting still hears about the write.
+            self._pending[kwargs["gallery_id"]] = (kwargs, callbacks)
+            full = len(self._pending) >= DB_FLUSH_EVERY
+            if self._thread is None:
+                atexit.register(self.flush) # Interrupted or crashed runs still write what is queued.
+                self._thread = threading.Thread(target=self._run, name=f"{EXTENSION_NAME}-db-writer", daemon=True)
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        flush_at = time.monotonic() + DB_FLUSH_INTERVAL
+        while True:
+            # Short waits, so a shutdown request (Ctrl-C) is noticed before the process goes away.
+            woken = self._wake.wait(max(0.0, min(1.0, flush_at - time.monotonic())))
+            if woken or time.monotonic() >= flush_at or _shutdown_requested():
+                self._wake.clear()
+                self.flush()
+                flush_at = time.monotonic() + DB_FLUSH_INTERVAL
+
+    def flush(self):
+        """Write every queued update now."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            log(f"{EXTENSION_REFERRER}: Writing metadata for {len(pending)} galleries to the database", "debug")
+            for gallery_id, (kwargs, _) in pending.items():
+                try:
+                    scraperdb.update_gallery_metadata(**kwargs)
+                except Exception as e:
+                    logger.error(f"Failed to update database metadata for Gallery {gallery_id}: {e}")
+            self._run_callbacks([callback for _, callbacks in pending.values() for callback in callbacks])
+
+    @staticmethod
+    def _run_callbacks(callbacks: list):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"{EXTENSION_REFERRER}: Post-write metadata callback failed: {e}")
+
+_metadata_writer = _MetadataWriteBehind()
+
+def _link_gallery_copy(gallery_id, canonical: str, link_path: str, ready: bool = True, copy_path: str = None):
+    """
+    Point another creator's copy of a gallery at the canonical one, deleting its own copy at "copy_path".
+    Used as an _archive_watcher callback when the canonical archive is still being written.
+    """
+    
+    if not ready:
+        logger.warning(f"Canonical copy of Gallery {gallery_id} never appeared: {canonical}; keeping {copy_path or link_path}")
+        return
+    try:
+        if copy_path and copy_path != link_path:
+            shutil.rmtree(copy_path, ignore_errors=True)
+            _gallery_index.replace(copy_path, link_path)
+        method = _gallery_links.link(canonical, link_path)
+        logger.debug(f"Linked Gallery {gallery_id} ({method}): {link_path} -> {canonical}")
+    except OSError as e:
+        logger.error(f"Failed to link Gallery {gallery_id} copy {link_path} to {canonical}: {e}")
+
+####################################################################################################################
+# HOOK HELPERS (thread-safe)
+####################################################################################################################
+
+def start_run():
+    """
+    Engine side of an extension's pre_run_hook.
+    """
+    
+    if TOR_SESSION_POOL and orchestrator.use_tor:
+        _tor_pool.start() # Warm Tor circuits before the first download needs one.
+
+def download_gallery(gallery, pages, downloader_session, pbar=None, creator=None, max_in_flight=None):
+    """
+    Downloads every page of a gallery. "pages" is a list of (page, urls, path) tuples.
+    Uses the asyncio engine when DOWNLOAD_ENGINE is "asyncio", otherwise downloads pages on a bounded thread pool.
+    Returns a dict of page -> success.
+    """
+    
+    max_in_flight = max_in_flight or ASYNC_MAX_IN_FLIGHT
+    results = {}
+    pending = []
+    for page, urls, path in pages:
+        settled = _check_page_before_download(gallery, page, urls, path, pbar, creator)
+        if settled is None:
+            pending.append((page, urls, path))
+        else:
+            results[page] = settled
+
+    if not pending:
+        return results
+
+    if TOR_SESSION_POOL and orchestrator.use_tor:
+        _tor_pool.start(downloader_session)
+        downloader_session = _tor_pool.checkout(downloader_session)
+
+    try:
+        if _async_engine_usable(downloader_session):
+            results.update(_download_gallery_async(gallery, pending, downloader_session, max_in_flight, pbar, creator))
+        elif len(pending) == 1:
+            page, urls, path = pending[0]
+            results[page] = _download_page_threaded(gallery, page, urls, path, downloader_session, pbar, creator)
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_in_flight, len(pending))) as pool:
+                futures = {
+                    page: pool.submit(_download_page_threaded, gallery, page, urls, path, downloader_session, pbar, creator)
+                    for page, urls, path in pending
+                }
+                results.update({page: future.result() for page, future in futures.items()})
+    finally:
+        _tor_pool.release(downloader_session) # No-op unless it was checked out of the Tor pool.
+
+    return results
+
+def process_completed_gallery(meta: dict, gallery_id, on_written=None):
+    """
+    Engine side of after_completed_gallery_download_hook: queues the gallery's metadata for the database, extracts
+    the creator covers and archives (or links) the gallery folders.
+    "on_written" is called once the metadata is in the database, for extensions that read it back.
+    """
+    
+    # Extract cover and delete original gallery folder after archiving
+    try:
+        gallery_format = str(orchestrator.gallery_format).lower() # Check if gallery format is valid, if not, treat as "directory" for safety
+        valid_formats = {"directory", "zip", "cbz"}
+        if gallery_format not in valid_formats:
+            logger.warning(
+                f"{EXTENSION_REFERRER}: Unknown GALLERY_FORMAT '{orchestrator.gallery_format}', "
+                "treating as 'directory' for safety."
+            )
+            gallery_format = "directory"
+
+        gallery_meta = build_gallery_metadata_summary(meta, EXTENSION_REFERRER)
+        creators = [sanitise_string(c) for c in gallery_meta.get("creator", [])]
+        tags = gallery_meta.get("tags", [])
+        languages = gallery_meta.get("languages", [])
+
+        # --- Consolidated database update call (queued, written in batches) ---
+        _metadata_writer.add(
+            on_written=on_written,
+            gallery_id=gallery_id,
+            raw_title=gallery_meta.get("raw_title"),
+            clean_title=gallery_meta.get("clean_title"),
+            language=languages,
+            tags=tags,
+            cover_path=gallery_meta.get("cover_path"),
+            creator_name=creators,
+            download_path=gallery_meta.get("download_path"),
+            extension_used=gallery_meta.get("extension_used"),
+            num_pages=gallery_meta.get("num_pages")
+        )
+
+        cover_source = None
+        cover_bytes = None # Page 1 of a streamed archive, used instead of cover_source.
+        cover_gallery_name = None
+        cover_ext = None
+        gallery_paths = {}
+        cover_gallery_id = None
+
+        # Close any archive this gallery's pages were streamed into, taking the cover from page 1 in memory.
+        for archive in _finalize_streaming_archives(gallery_id):
+            if archive.cover is not None and cover_bytes is None:
+                cover_name, cover_bytes = archive.cover
+                cover_gallery_name = os.path.basename(archive.folder)
+                cover_ext = os.path.splitext(cover_name)[1]
+                cover_gallery_id = parse_gallery_id(cover_gallery_name)
+
+        temp_root = "/opt/manga-scraper/mangascraper/core/data/archive_temp/"
+        for creator_name in creators:
+            creator_folder = os.path.join(DEDICATED_DOWNLOAD_PATH, creator_name)
+            temp_creator_folder = os.path.join(temp_root, creator_name)
+
+            search_folders = []
+            if os.path.isdir(creator_folder):
+                search_folders.append(creator_folder)
+            if os.path.isdir(temp_creator_folder):
+                search_folders.append(temp_creator_folder)
+            if not search_folders:
+                continue
+
+            for search_folder in search_folders:
+                # Look for both directories and .cbz/.zip files (from the gallery index, no directory listing)
+                gallery_items = _gallery_index.find(gallery_id, search_folder)
+                if not gallery_items:
+                    continue
+                gallery_items.sort()
+                gallery_path = os.path.join(search_folder, gallery_items[0])
+                if os.path.isdir(gallery_path):
+                    gallery_paths[creator_name] = gallery_path
+
+                    if cover_source is None and cover_bytes is None:
+                        candidates = [
+                            f for f in os.listdir(gallery_path)
+                            if f.startswith("1.") and not f.endswith(PART_FILE_SUFFIX)
+                        ]
+                        if candidates:
+                            page1_file = os.path.join(gallery_path, candidates[0])
+                            _, ext = os.path.splitext(page1_file)
+                            cover_source = page1_file
+                            cover_gallery_name = gallery_items[0]
+                            cover_ext = ext
+                            cover_gallery_id = parse_gallery_id(cover_gallery_name)
+                elif gallery_items[0].endswith('.cbz') or gallery_items[0].endswith('.zip'):
+                    # If it's an archive, set the path for later use
+                    gallery_paths[creator_name] = gallery_path
+                else:
+                    logger.debug(f"Gallery {gallery_items[0]} is already archived or not a directory, skipping")
+
+        cover_generated = {}
+        archive_jobs = [] # Submitted once every creator has its cover, since the archiver deletes the source folders.
+        for creator_name in creators:
+            creator_folder = os.path.join(DEDICATED_DOWNLOAD_PATH, creator_name)
+            if not os.path.isdir(creator_folder):
+                continue
+
+            # Extract cover from the downloaded gallery and store in hidden covers subfolder
+            if (cover_source or cover_bytes) and cover_gallery_name and cover_ext:
+                covers_folder = os.path.join(creator_folder, ".covers")
+                try:
+                    latest_cover_id, current_cover_link = _cover_state.current(creator_folder)
+                    if cover_gallery_id is not None and latest_cover_id is not None:
+                        if cover_gallery_id <= latest_cover_id:
+                            gallery_path = gallery_paths.get(creator_name)
+                            if gallery_format == "directory" or not gallery_path:
+                                if gallery_format == "directory" and gallery_path:
+                                    logger.debug(
+                                        f"Gallery format is 'directory'; keeping original gallery folder: {gallery_path}"
+                                    )
+                                continue
+                            # The creator already shows a newer gallery's cover. Keep it, the gallery can still be archived.
+                            logger.debug(f"Keeping newer cover for {creator_name} (Gallery {latest_cover_id})")
+                            cover_generated[creator_name] = True
+
+                    if not cover_generated.get(creator_name):
+                        os.makedirs(covers_folder, exist_ok=True)
+                        cover_in_subfolder = os.path.join(covers_folder, f"{cover_gallery_name}{cover_ext}")
+                        if cover_source:
+                            # Only a "directory" gallery keeps its pages, anything else is archived and deleted.
+                            method = _materialize_file(cover_source, cover_in_subfolder, source_persists=gallery_format == "directory")
+                            if method != "symlink":
+                                cover_source = cover_in_subfolder # Later creators link to this cover instead of the page.
+                        else:
+                            with open(cover_in_subfolder, "wb") as f:
+                                f.write(cover_bytes)
+                            cover_source, method = cover_in_subfolder, "write"
+                        logger.debug(f"Extracted cover for {creator_name} ({method}): {cover_in_subfolder}")
+
+                        # Remove the previous cover link, or (when it isn't known yet) any existing cover files regardless of extension
+                        if current_cover_link:
+                            old_covers = [current_cover_link]
+                        else:
+                            old_covers = [
+                                os.path.join(creator_folder, f) for f in os.listdir(creator_folder)
+                                if f.startswith("cover") and f != "covers" and f != ".covers"
+                            ]
+                        for old_cover in old_covers:
+                            try:
+                                os.unlink(old_cover)
+                            except FileNotFoundError:
+                                pass
+                            except Exception as e:
+                                logger.debug(f"Could not remove old cover file {old_cover}: {e}")
+
+                        # Symlink cover into creator root
+                        cover_link = os.path.join(creator_folder, f"cover{cover_ext}")
+                        os.symlink(cover_in_subfolder, cover_link)
+                        logger.debug(f"Updated cover symlink for {creator_name}: {cover_link} -> {cover_in_subfolder}")
+                        _cover_state.update(creator_folder, cover_gallery_id, cover_link)
+                        if COVER_THUMBNAILS:
+                            _thumbnailer.submit(cover_in_subfolder, cover_link)
+                        cover_generated[creator_name] = True
+                except Exception as e:
+                    logger.debug(f"Could not extract cover for Gallery {gallery_id}: {e}")
+
+            if not cover_generated.get(creator_name):
+                logger.debug(
+                    f"Skipping delete for {creator_name}; cover not generated for gallery {gallery_id}."
+                )
+                continue
+
+            gallery_path = gallery_paths.get(creator_name)
+            if gallery_format == "directory" or not gallery_path:
+                if gallery_format == "directory" and gallery_path:
+                    logger.debug(
+                        f"Gallery format is 'directory'; keeping original gallery folder: {gallery_path}"
+                    )
+                continue
+
+            if os.path.isfile(gallery_path):
+                continue # Already an archive (e.g. streamed straight into it), nothing to archive or delete.
+
+            archive_ext = ".cbz" if gallery_format == "cbz" else ".zip"
+            gallery_name = os.path.basename(gallery_path)
+            expected_archive = os.path.join(creator_folder, f"{gallery_name}{archive_ext}")
+            
+            # Archive the gallery if it's a directory and not already archived.
+            # The archiver pool deletes the original folder once the archive is written.
+            if gallery_format in {"cbz", "zip"} and os.path.isdir(gallery_path):
+                if _archive_in_progress(expected_archive):
+                    # Already being written by another worker, delete the folder once it lands.
+                    _archive_watcher.when_ready(
+                        expected_archive,
+                        lambda ready, path=gallery_path, archive=expected_archive: _archived_elsewhere(gallery_id, path, archive, ready),
+                    )
+                else:
+                    archive_jobs.append((gallery_path, expected_archive))
+
+        # Multi-creator galleries keep one canonical copy, the other creator folders link to it.
+        copies = []
+        if SINGLE_COPY_GALLERIES and len(archive_jobs) > 1:
+            (canonical_path, canonical_archive), *copies = archive_jobs
+            archive_jobs = archive_jobs[:1]
+        elif SINGLE_COPY_GALLERIES and gallery_format == "directory":
+            folders = [path for path in gallery_paths.values() if os.path.isdir(path) and not os.path.islink(path)]
+            for gallery_path in folders[1:]:
+                _link_gallery_copy(gallery_id, folders[0], gallery_path)
+
+        futures = {archive_path: _archiver.submit(gallery_path, archive_path) for gallery_path, archive_path in archive_jobs}
+
+        # Copies are linked once the canonical archive's job is done, submitted above so its future exists.
+        for gallery_path, archive_path in copies:
+            link_copy = (
+                lambda ready, canonical=canonical_archive, link=archive_path, copy=gallery_path:
+                    _link_gallery_copy(gallery_id, canonical, link, ready, copy)
+            )
+            future = futures.get(canonical_archive)
+            if future is None:
+                link_copy(os.path.exists(canonical_archive)) # Archived inline, already settled.
+            else:
+                _archive_watcher.when_ready(canonical_archive, link_copy, future=future)
+    
+    except Exception as e:
+        logger.error(f"Failed in post-download processing for Gallery {gallery_id}: {e}")
+
+def reconcile_links():
+    """
+    Engine side of an extension's cleanup_hook.
+    """
+    
+    _gallery_links.reconcile()
+    _gallery_links.save()
+
+def save_state():
+    """
+    Writes queued metadata and the persisted library state. Called every batch so an interrupted run loses little.
+    """
+    
+    _metadata_writer.flush()
+    _gallery_index.save()
+    _cover_state.save()
+    _gallery_links.save()
+
+def shutdown():
+    """
+    Engine side of an extension's post_run_hook: waits for background archiving and thumbnailing, saves state,
+    sweeps unreferenced page store blobs and releases pooled connections and sessions.
+    """
+    
+    _finalize_streaming_archives() # Galleries whose post-download hook never ran.
+    _archiver.close() # Wait for queued archives, so cleanup sees the final tree.
+    _archive_watcher.close()
+    _thumbnailer.close()
+    save_state()
+    _async_engine.close() # Downloads are finished, release pooled connections.
+    _tor_pool.close()
+    if PAGE_STORE:
+        _page_store.sweep() # Drop blobs whose pages were archived or deleted.
+    _page_store.close()
@@ -16,6 +16,7 @@ from mangascraper.extensions.extension_manager import (
     parse_gallery_id,
     repair_covers_hook,
 )
+from mangascraper.extensions.skeleton import engine
 
 # This is a skeleton/example extension for manga-scraper. It is also used as the default extension if none is specified.
 
@@ -32,6 +33,7 @@ EXTENSION_REFERRER = f"{EXTENSION_NAME_CAPITALISED} Extension" # Used for printi
 EXTENSION_INSTALL_PATH = "/opt/manga-scraper/downloads/" # Use this if extension installs external programs (like Suwayomi-Server)
 
 DEDICATED_DOWNLOAD_PATH = calculate_extension_download_path(EXTENSION_NAME)
+engine.configure(EXTENSION_NAME, EXTENSION_REFERRER, DEDICATED_DOWNLOAD_PATH) # Download engine, archiver and library state settings live in skeleton/engine.py
 
 SUBFOLDER_STRUCTURE = ["creator", "title"] # SUBDIR_1, SUBDIR_2, etc
 
@@ -41,9 +43,6 @@ MAX_X_BATCHES = 1000
 EVERY_X_BATCHES = 5
 RUNS_PER_X_BATCHES = 2
 
-ARCHIVE_WAIT_SECONDS = 120
-ARCHIVE_POLL_INTERVAL = 0.5
-
 ####################################################################
 # CUSTOM VARIABLES
 ####################################################################
@@ -67,6 +66,7 @@ def pre_run_hook():
     orchestrator.refresh_globals()
     DEDICATED_DOWNLOAD_PATH = calculate_extension_download_path(EXTENSION_NAME)
     update_env("EXTENSION_DOWNLOAD_PATH", DEDICATED_DOWNLOAD_PATH) # Update download path in env
+    engine.configure(EXTENSION_NAME, EXTENSION_REFERRER, DEDICATED_DOWNLOAD_PATH)
     
     if orchestrator.dry_run:
         logger.info(f"[DRY RUN] Would ensure download path exists: {DEDICATED_DOWNLOAD_PATH}")
@@ -76,6 +76,8 @@ def pre_run_hook():
         logger.debug(f"{EXTENSION_REFERRER}: Download path ready at '{DEDICATED_DOWNLOAD_PATH}'.")
     except Exception as e:
         logger.error(f"{EXTENSION_REFERRER}: Failed to create download path '{DEDICATED_DOWNLOAD_PATH}': {e}")
+    
+    engine.start_run()
 
 def install_extension():
     """
@@ -86,6 +88,7 @@ def install_extension():
     
     orchestrator.refresh_globals()
     DEDICATED_DOWNLOAD_PATH = calculate_extension_download_path(EXTENSION_NAME)
+    engine.configure(EXTENSION_NAME, EXTENSION_REFERRER, DEDICATED_DOWNLOAD_PATH)
     
     if orchestrator.dry_run:
         logger.info(f"[DRY RUN] Would install extension and create paths: {EXTENSION_INSTALL_PATH}, {DEDICATED_DOWNLOAD_PATH}")
@@ -148,103 +151,28 @@ def test_hook():
 # CORE HOOKS (Please add to the functions, try not to change or remove anything)
 ####################################################################################################################
 
-# Hook for downloading images. Use active_extension.download_images_hook(ARGS) in downloader.
-def download_images_hook(gallery, page, urls, path, downloader_session, pbar=None, creator=None):
+# Hook for downloading a whole gallery. Use active_extension.download_gallery_hook(ARGS) in downloader.
+def download_gallery_hook(gallery, pages, downloader_session, pbar=None, creator=None, max_in_flight=None):
     """
-    Downloads an image from one of the provided URLs to the given path.
-    Tries mirrors in order until one succeeds, with retries per mirror.
-    Updates tqdm progress bar with current creator.
+    Downloads every page of a gallery. "pages" is a list of (page, urls, path) tuples.
+    Uses the asyncio engine when engine.DOWNLOAD_ENGINE is "asyncio", otherwise downloads pages on a bounded thread pool.
+    Returns a dict of page -> success.
     """
 
     orchestrator.refresh_globals()
     
-    # Abort early if shutdown requested
-    try:
-        from mangascraper.core.downloader import _shutdown_event
-    except ImportError:
-        _shutdown_event = None
-    if _shutdown_event and _shutdown_event.is_set():
-        logger.warning("Shutdown event detected, aborting image download.")
-        return False
-
-    if not urls:
-        logger.warning(f"Gallery {gallery}: Page {page}: No URLs, skipping")
-        if pbar and creator:
-            pbar.set_postfix_str(f"Skipped Creator: {creator}")
-        return False
-
-    if os.path.exists(path):
-        log(f"Already exists, skipping: {path}", "debug")
-        if pbar and creator:
-            pbar.set_postfix_str(f"Creator: {creator}")
-        return True
-
-    if orchestrator.dry_run:
-        logger.info(f"[DRY RUN] Gallery {gallery}: Would download {urls[0]} -> {path}")
-        if pbar and creator:
-            pbar.set_postfix_str(f"Creator: {creator}")
-        return True
-
-    if not isinstance(downloader_session, requests.Session):
-        downloader_session = requests.Session()
-
-    def try_download(session, mirrors, retries, tor_rotate=False):
-        """Try downloading with a given session and retry count."""
-        for url in mirrors:
-            for attempt in range(1, retries + 1):
-                try:
-                    r = session.get(url, timeout=(60, 60), stream=True)
-                    if r.status_code == 429:
-                        wait = 2 ** attempt
-                        logger.warning(f"429 rate limit hit for {url}, waiting {wait}s")
-                        time.sleep(wait)
-                        continue
-                    r.raise_for_status()
+    return engine.download_gallery(gallery, pages, downloader_session, pbar, creator, max_in_flight)
 
-                    os.makedirs(os.path.dirname(path), exist_ok=True)
-                    with open(path, "wb") as f:
-                        for chunk in r.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-
-                    log(f"Downloaded Gallery {gallery}: Page {page} -> {path}", "debug")
-                    if pbar and creator:
-                        pbar.set_postfix_str(f"Creator: {creator}")
-                    return True
-
-                except Exception as e:
-                    wait = dynamic_sleep("image", attempt=attempt)
-                    log_clarification()
-                    logger.warning(
-                        f"Gallery {gallery}: Page {page}: Mirror {url}, attempt {attempt} failed: {e}, retrying in {wait:.2f}s"
-                    )
-                    time.sleep(wait)
-
-            logger.warning(
-                f"Gallery {gallery}: Page {page}: Mirror {url} failed after {retries} attempts, trying next mirror"
-            )
-        return False
-
-    # First attempt: normal retries
-    success = try_download(downloader_session, urls, orchestrator.max_retries)
-
-    # If still failed, rebuild Tor session once and retry
-    if not success and orchestrator.use_tor:
-        logger.warning(
-            f"Gallery {gallery}: Page {page}: All retries failed, rotating Tor node and retrying once more..."
-        )
-        downloader_session = APIGet.session(referrer=f"{EXTENSION_NAME}", status="rebuild")
-        success = try_download(downloader_session, urls, 1, tor_rotate=True)
-
-    if not success:
-        log_clarification()
-        logger.error(
-            f"Gallery {gallery}: Page {page}: All mirrors failed after Tor rotate too: {urls}"
-        )
-        if pbar and creator:
-            pbar.set_postfix_str(f"Failed Creator: {creator}")
+# Hook for downloading images. Use active_extension.download_images_hook(ARGS) in downloader.
+def download_images_hook(gallery, page, urls, path, downloader_session, pbar=None, creator=None):
+    """
+    Downloads an image from one of the provided URLs to the given path.
+    Thin per-page wrapper around download_gallery_hook, kept for downloaders that call it once per page.
+    Updates tqdm progress bar with current creator.
+    """
 
-    return success
+    results = download_gallery_hook(gallery, [(page, urls, path)], downloader_session, pbar=pbar, creator=creator)
+    return results.get(page, False)
 
 # Hook for pre-batch functionality. Use active_extension.pre_batch_hook(ARGS) in downloader.
 def pre_batch_hook(gallery_list):
@@ -300,187 +228,11 @@ def after_completed_gallery_download_hook(meta: dict, gallery_id):
     log_clarification("debug")
     log(f"{EXTENSION_REFERRER}: Post-Completed Gallery Download Hook Called: Gallery: {meta['id']}: Downloaded.", "debug")
     
-    # Extract cover and delete original gallery folder after archiving
-    try:
-        gallery_format = str(orchestrator.gallery_format).lower() # Check if gallery format is valid, if not, treat as "directory" for safety
-        valid_formats = {"directory", "zip", "cbz"}
-        if gallery_format not in valid_formats:
-            logger.warning(
-                f"{EXTENSION_REFERRER}: Unknown GALLERY_FORMAT '{orchestrator.gallery_format}', "
-                "treating as 'directory' for safety."
-            )
-            gallery_format = "directory"
-
-        gallery_meta = build_gallery_metadata_summary(meta, EXTENSION_REFERRER)
-        creators = [sanitise_string(c) for c in gallery_meta.get("creator", [])]
-        tags = gallery_meta.get("tags", [])
-        languages = gallery_meta.get("languages", [])
-
-        # --- Consolidated database update call ---
-        scraperdb.update_gallery_metadata(
-            gallery_id=gallery_id,
-            raw_title=gallery_meta.get("raw_title"),
-            clean_title=gallery_meta.get("clean_title"),
-            language=languages,
-            tags=tags,
-            cover_path=gallery_meta.get("cover_path"),
-            creator_name=creators,
-            download_path=gallery_meta.get("download_path"),
-            extension_used=gallery_meta.get("extension_used"),
-            num_pages=gallery_meta.get("num_pages")
-        )
-
-        cover_source = None
-        cover_gallery_name = None
-        cover_ext = None
-        gallery_paths = {}
-        cover_gallery_id = None
-
-        temp_root = "/opt/manga-scraper/mangascraper/core/data/archive_temp/"
-        for creator_name in creators:
-            creator_folder = os.path.join(DEDICATED_DOWNLOAD_PATH, creator_name)
-            temp_creator_folder = os.path.join(temp_root, creator_name)
-
-            search_folders = []
-            if os.path.isdir(creator_folder):
-                search_folders.append(creator_folder)
-            if os.path.isdir(temp_creator_folder):
-                search_folders.append(temp_creator_folder)
-            if not search_folders:
-                continue
-
-            gallery_prefix = f"({gallery_id})"
-            for search_folder in search_folders:
-                # Look for both directories and .cbz/.zip files
-                gallery_items = [
-                    f for f in os.listdir(search_folder)
-                    if (os.path.isdir(os.path.join(search_folder, f)) or f.endswith('.cbz') or f.endswith('.zip'))
-                    and f.startswith(gallery_prefix)
-                ]
-                if not gallery_items:
-                    continue
-                gallery_items.sort()
-                gallery_path = os.path.join(search_folder, gallery_items[0])
-                if os.path.isdir(gallery_path):
-                    gallery_paths[creator_name] = gallery_path
-
-                    if cover_source is None:
-                        candidates = [f for f in os.listdir(gallery_path) if f.startswith("1.")]
-                        if candidates:
-                            page1_file = os.path.join(gallery_path, candidates[0])
-                            _, ext = os.path.splitext(page1_file)
-                            cover_source = page1_file
-                            cover_gallery_name = gallery_items[0]
-                            cover_ext = ext
-                            cover_gallery_id = parse_gallery_id(cover_gallery_name)
-                elif gallery_items[0].endswith('.cbz') or gallery_items[0].endswith('.zip'):
-                    # If it's an archive, set the path for later use
-                    gallery_paths[creator_name] = gallery_path
-                else:
-                    logger.debug(f"Gallery {gallery_items[0]} is already archived or not a directory, skipping")
-
-        cover_generated = {}
-        for creator_name in creators:
-            creator_folder = os.path.join(DEDICATED_DOWNLOAD_PATH, creator_name)
-            if not os.path.isdir(creator_folder):
-                continue
-
-            # Extract cover from the downloaded gallery and store in hidden covers subfolder
-            if cover_source and cover_gallery_name and cover_ext:
-                covers_folder = os.path.join(creator_folder, ".covers")
-                try:
-                    os.makedirs(covers_folder, exist_ok=True)
-                    latest_cover_id = find_latest_cover_id(covers_folder)
-                    if cover_gallery_id is not None and latest_cover_id is not None:
-                        if cover_gallery_id <= latest_cover_id:
-                            gallery_path = gallery_paths.get(creator_name)
-                            if gallery_format == "directory" or not gallery_path:
-                                if gallery_format == "directory" and gallery_path:
-                                    logger.debug(
-                                        f"Gallery format is 'directory'; keeping original gallery folder: {gallery_path}"
-                                    )
-                                continue
-
-                    cover_in_subfolder = os.path.join(covers_folder, f"{cover_gallery_name}{cover_ext}")
-                    shutil.copy2(cover_source, cover_in_subfolder)
-                    logger.debug(f"Extracted cover for {creator_name}: {cover_in_subfolder}")
-
-                    # Remove any existing cover files (regardless of extension)
-                    for f in os.listdir(creator_folder):
-                        if f.startswith("cover") and f != "covers" and f != ".covers":
-                            try:
-                                os.unlink(os.path.join(creator_folder, f))
-                            except Exception as e:
-                                logger.debug(f"Could not remove old cover file {f}: {e}")
-
-                    # Symlink cover into creator root
-                    cover_link = os.path.join(creator_folder, f"cover{cover_ext}")
-                    os.symlink(cover_in_subfolder, cover_link)
-                    logger.debug(f"Updated cover symlink for {creator_name}: {cover_link} -> {cover_in_subfolder}")
-                    cover_generated[creator_name] = True
-                except Exception as e:
-                    logger.debug(f"Could not extract cover for Gallery {gallery_id}: {e}")
-
-            if not cover_generated.get(creator_name):
-                logger.debug(
-                    f"Skipping delete for {creator_name}; cover not generated for gallery {gallery_id}."
-                )
-                continue
-
-            gallery_path = gallery_paths.get(creator_name)
-            if gallery_format == "directory" or not gallery_path:
-                if gallery_format == "directory" and gallery_path:
-                    logger.debug(
-                        f"Gallery format is 'directory'; keeping original gallery folder: {gallery_path}"
-                    )
-                continue
-
-            archive_ext = ".cbz" if gallery_format == "cbz" else ".zip"
-            gallery_name = os.path.basename(gallery_path)
-            expected_archive = os.path.join(creator_folder, f"{gallery_name}{archive_ext}")
-            
-            # Archive the gallery if it's a directory and not already archived
-            if gallery_format in {"cbz", "zip"} and os.path.isdir(gallery_path):
-                import zipfile
-                archive_path = os.path.join(creator_folder, f"{gallery_name}{archive_ext}")
-                with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
-                    for root, _, files in os.walk(gallery_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            arcname = os.path.relpath(file_path, gallery_path)
-                            archive.write(file_path, arcname)
-                logger.debug(f"{EXTENSION_REFERRER}: Archived gallery {gallery_path} to {archive_path}")
-            
-            # Wait for the archive to exist
-            if not os.path.exists(expected_archive):
-                max_checks = max(1, int(ARCHIVE_WAIT_SECONDS / ARCHIVE_POLL_INTERVAL))
-                for _ in range(max_checks):
-                    time.sleep(ARCHIVE_POLL_INTERVAL)
-                    if os.path.exists(expected_archive):
-                        break
-                if not os.path.exists(expected_archive):
-                    logger.warning(
-                        f"Archive not found for Gallery {gallery_id} after {ARCHIVE_WAIT_SECONDS}s: "
-                        f"expected {expected_archive}; leaving folder undeleted"
-                    )
-                    logger.info(
-                        f"Leaving original folder in place: {gallery_path}"
-                    )
-                    continue
-
-            # Delete original gallery folder if it was archived
-            if os.path.isdir(gallery_path) and os.path.exists(expected_archive):
-                try:
-                    shutil.rmtree(gallery_path)
-                    logger.debug(f"Deleted original gallery folder: {gallery_path}")
-                except Exception as e:
-                    logger.error(f"Failed to delete gallery folder {gallery_path}: {e}")
-    
-    except Exception as e:
-        logger.error(f"Failed in post-download processing for Gallery {gallery_id}: {e}")
+    engine.process_completed_gallery(meta, gallery_id) # Database write, covers and archiving
 
 # Hook for cleaning after downloads
 def cleanup_hook():
+    engine.reconcile_links()
     repair_covers_hook(DEDICATED_DOWNLOAD_PATH, referrer=EXTENSION_REFERRER)
     cleanup_download_tree(DEDICATED_DOWNLOAD_PATH, remove_empty_artist_folder=True)
 
@@ -512,6 +264,8 @@ def post_batch_hook(current_batch_number: int, total_batch_numbers: int):
             and (current_batch_number % interval == 0) # If current batch hits interval
         )
     
+    engine.save_state() # Keep the persisted library state close to current in case the run is interrupted.
+    
     if _should_run_post_batch():
         cleanup_hook() # Call the cleanup hook
     
@@ -529,6 +283,8 @@ def post_run_hook():
     log_clarification("debug")
     log(f"{EXTENSION_REFERRER}: Post-run Hook Called.", "debug")
     
+    engine.shutdown() # Wait for archiving, save library state and release connections.
+    
     if orchestrator.skip_post_run:
         log_clarification("debug")
         log(f"{EXTENSION_REFERRER}: Post-run Hook Skipped.", "debug")
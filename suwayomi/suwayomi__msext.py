@@ -2,9 +2,17 @@
 # mangascraper/extensions/suwayomi/suwayomi__msext.py
 
 import os, time, json, requests, threading, subprocess, shutil, tarfile, math, re, sqlite3
+from urllib.parse import urlsplit, urlunsplit
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.exceptions import ConnectTimeoutError
 from tqdm import tqdm
 
+try:
+    import websocket # Optional (websocket-client), lets populate_suwayomi follow library updates over a subscription.
+except ImportError:
+    websocket = None
+
 from mangascraper.core import orchestrator
 from mangascraper.core.orchestrator import *
 from mangascraper.core.api import *
@@ -18,6 +26,7 @@ from mangascraper.extensions.extension_manager import (
     parse_gallery_id,
     repair_covers_hook,
 )
+from mangascraper.extensions.suwayomi import engine
 
 ####################################################################################################################
 # Global variables
@@ -30,6 +39,7 @@ EXTENSION_REFERRER = f"{EXTENSION_NAME_CAPITALISED} Extension" # Used for printi
 EXTENSION_INSTALL_PATH = "/opt/suwayomi-server/" # Use this if extension installs external programs (like Suwayomi-Server)
 
 DEDICATED_DOWNLOAD_PATH = calculate_extension_download_path(EXTENSION_NAME)
+engine.configure(EXTENSION_NAME, EXTENSION_REFERRER, DEDICATED_DOWNLOAD_PATH) # Download engine, archiver and library state settings live in suwayomi/engine.py
 
 SUBFOLDER_STRUCTURE = ["creator", "title"] # SUBDIR_1, SUBDIR_2, etc
 
@@ -39,9 +49,6 @@ MAX_X_BATCHES = 50
 EVERY_X_BATCHES = 10
 RUNS_PER_X_BATCHES = 1
 
-ARCHIVE_WAIT_SECONDS = 120
-ARCHIVE_POLL_INTERVAL = 0.5
-
 ####################################################################
 # CUSTOM VARIABLES
 ####################################################################
@@ -53,6 +60,16 @@ SUWAYOMI_CATEGORY_NAME = "ScrapedMangas"
 CATEGORY_ID = None
 SUWAYOMI_POPULATION_TIME = 2 # Suwayomi update ticks every ~2 secs.
 
+# Follow library updates through Suwayomi's GraphQL subscription over a websocket (needs websocket-client),
+# instead of polling libraryUpdateStatus. Falls back to polling if the subscription cannot be opened or drops.
+SUWAYOMI_STATUS_SUBSCRIPTION = True
+SUWAYOMI_SUBSCRIPTION_TIMEOUT = 30 # Seconds without an update before checking the status with a query.
+
+# Opt-in: only refresh the mangas of creators that got new galleries (aliased fetchManga + fetchChapters mutations),
+# instead of rescanning the whole category with updateLibrary.
+SUWAYOMI_TARGETED_REFRESH = False
+SUWAYOMI_REFRESH_BATCH_SIZE = 50 # Mangas refreshed per GraphQL request.
+
 # NOTE: TEST
 AUTH_USERNAME = config.get("BASIC_AUTH_USERNAME", None) # Must be manually set for now.
 AUTH_PASSWORD = config.get("BASIC_AUTH_PASSWORD", None) # Must be manually set for now.
@@ -62,8 +79,19 @@ MAX_GENRES_STORED = 50
 # Max number of genres parsed from a gallery and stored in a creator's "genre_count" field in creators_metadata.json.
 MAX_GENRES_PARSED = 1000
 
-# Keep a persistent session for cookie-based login
-graphql_session = None
+# One keep-alive session shared by every GraphQL call (and holding the login cookie for new_graphql_request).
+GRAPHQL_POOL_SIZE = 8 # Connections kept open to the Suwayomi server. Raise it if many worker threads query at once.
+GRAPHQL_CONNECT_TIMEOUT = 5 # Seconds to open a connection.
+GRAPHQL_READ_TIMEOUT = 60 # Seconds to wait for the server between bytes of a response.
+GRAPHQL_DEADLINE = 120 # Seconds per call overall, including retries of dropped connections.
+GRAPHQL_RETRIES = 2 # Retries when a pooled connection fails to connect or is dropped by the server. Mutations only retry failed connects.
+GRAPHQL_LOOKUP_BATCH_SIZE = 200 # Creator titles looked up per GraphQL request.
+
+# Creator title -> Suwayomi manga ID, inLibrary and categories, persisted between runs. Filled once from a paginated
+# listing of the Local Source; misses are looked up again, and IDs a mutation does not recognise are dropped.
+# Defaults to ".suwayomi_suwayomi_mangas.json" next to the download path. Delete it to force a full refill.
+SUWAYOMI_MANGA_CACHE_PATH = None
+SUWAYOMI_MANGA_PAGE_SIZE = 1000 # Mangas per page of the Local Source listing.
 
 # Thread locks for file operations
 _gallery_meta_lock = threading.Lock()
@@ -90,6 +118,8 @@ def load_creators_metadata() -> dict:
 
 def save_creators_metadata(metadata: dict):
     with _creators_metadata_lock:
+        if _touched_creators.loaded():
+            metadata["touched_creators"] = _touched_creators.names() # The in-memory set is the current one.
         try:
             os.makedirs(os.path.dirname(creators_metadata_file), exist_ok=True)
             with open(creators_metadata_file, "w", encoding="utf-8") as f:
@@ -97,6 +127,64 @@ def save_creators_metadata(metadata: dict):
         except Exception as e:
             logger.warning(f"Could not save creators_metadata.json: {e}")
 
+class _TouchedCreators:
+    """
+    Creators that got new galleries since their Suwayomi manga was last refreshed ("touched_creators" in
+    creators_metadata.json). Kept in memory so concurrent post-download hooks don't overwrite each other's additions,
+    and written back with every creators_metadata.json save and at the end of each batch.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = None
+        self._added = set() # Added since the last snapshot, kept by discard.
+        self._dirty = False
+
+    def loaded(self) -> bool:
+        return self._names is not None
+
+    def _ensure_loaded(self):
+        if self._names is not None:
+            return
+        names = set(load_creators_metadata().get("touched_creators", [])) # Outside our lock, it takes the file lock.
+        with self._lock:
+            if self._names is None:
+                self._names = names
+
+    def names(self) -> list:
+        with self._lock:
+            return sorted(self._names or ())
+
+    def snapshot(self) -> set:
+        """The creators to refresh. Ones added again before the matching discard are kept for the next refresh."""
+        self._ensure_loaded()
+        with self._lock:
+            self._added = set()
+            return set(self._names)
+
+    def add(self, names):
+        self._ensure_loaded()
+        with self._lock:
+            self._dirty |= not self._names.issuperset(names)
+            self._names.update(names)
+            self._added.update(names)
+
+    def discard(self, names):
+        self._ensure_loaded()
+        with self._lock:
+            names = set(names) - self._added
+            self._dirty |= not self._names.isdisjoint(names)
+            self._names.difference_update(names)
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+        save_creators_metadata(load_creators_metadata()) # Writes the current set.
+
+_touched_creators = _TouchedCreators()
+
 ####################################################################################################################
 # CORE
 ####################################################################################################################
@@ -115,6 +203,7 @@ def pre_run_hook():
     DEDICATED_DOWNLOAD_PATH = calculate_extension_download_path(EXTENSION_NAME)
     creators_metadata_file = os.path.join(DEDICATED_DOWNLOAD_PATH, "creators_metadata.json")
     update_env("EXTENSION_DOWNLOAD_PATH", DEDICATED_DOWNLOAD_PATH) # Update download path in env
+    engine.configure(EXTENSION_NAME, EXTENSION_REFERRER, DEDICATED_DOWNLOAD_PATH)
     
     if orchestrator.dry_run:
         logger.info(f"[DRY RUN] Would ensure download path exists: {DEDICATED_DOWNLOAD_PATH}")
@@ -124,6 +213,8 @@ def pre_run_hook():
         logger.debug(f"{EXTENSION_REFERRER}: Download path ready at '{DEDICATED_DOWNLOAD_PATH}'.")
     except Exception as e:
         logger.error(f"{EXTENSION_REFERRER}: Failed to create download path '{DEDICATED_DOWNLOAD_PATH}': {e}")
+    
+    engine.start_run()
 
 SUWAYOMI_TARBALL_URL = "https://github.com/Suwayomi/Suwayomi-Server/releases/download/v2.1.1867/Suwayomi-Server-v2.1.1867-linux-x64.tar.gz"
 TARBALL_FILENAME = SUWAYOMI_TARBALL_URL.split("/")[-1]
@@ -133,6 +224,7 @@ def install_extension():
     
     orchestrator.refresh_globals()
     DEDICATED_DOWNLOAD_PATH = calculate_extension_download_path(EXTENSION_NAME)
+    engine.configure(EXTENSION_NAME, EXTENSION_REFERRER, DEDICATED_DOWNLOAD_PATH)
 
     if orchestrator.dry_run:
         logger.info(f"[DRY RUN] Would install extension and create paths: {EXTENSION_INSTALL_PATH}, {DEDICATED_DOWNLOAD_PATH}")
@@ -269,6 +361,122 @@ def test_hook():
 #    except Exception:
 #        return None
 
+class _GraphQLClient:
+    """
+    Thread-safe pooled client for the Suwayomi GraphQL endpoint.
+    Connections are kept alive between calls, and each call is bounded by GRAPHQL_DEADLINE.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self._logged_in = False
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GRAPHQL_POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update({"Content-Type": "application/json", "Connection": "keep-alive"})
+                self._session = session
+                self._logged_in = False
+            return self._session
+
+    @staticmethod
+    def _timeout(deadline: float):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.Timeout(f"GraphQL: Call exceeded its {GRAPHQL_DEADLINE}s deadline.")
+        return (min(GRAPHQL_CONNECT_TIMEOUT, remaining), min(GRAPHQL_READ_TIMEOUT, remaining))
+
+    @staticmethod
+    def _never_sent(e: requests.ConnectionError) -> bool:
+        """True if the request failed while connecting, so the server cannot have seen it."""
+        if isinstance(e, requests.ConnectTimeout):
+            return True
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return isinstance(reason, ConnectTimeoutError) # NewConnectionError (refused, DNS) is a subclass.
+
+    def _post(self, url: str, body: bytes, deadline: float, idempotent: bool = True):
+        """
+        POST with retries on dropped connections, reading the body under the deadline.
+        Non-idempotent requests (mutations) are only retried if they failed while connecting, so they are never applied twice.
+        """
+        
+        session = self._get_session()
+        for attempt in range(GRAPHQL_RETRIES + 1):
+            try:
+                response = session.post(url, data=body, timeout=self._timeout(deadline), stream=True)
+                try:
+                    chunks = []
+                    for chunk in response.iter_content(64 * 1024):
+                        chunks.append(chunk)
+                        self._timeout(deadline)
+                    # Hand back a normal response, already read (.json() / .text work as usual).
+                    response._content = b"".join(chunks)
+                    response._content_consumed = True
+                finally:
+                    response.close() # Returns the connection to the pool, or drops it if the body was cut short.
+                return response
+            except requests.ConnectionError as e:
+                if attempt >= GRAPHQL_RETRIES or not (idempotent or self._never_sent(e)):
+                    raise
+                log(f"GraphQL: Connection dropped ({e}), retrying.", "debug")
+                time.sleep(min(0.5 * (attempt + 1), max(0, deadline - time.monotonic())))
+
+    def _login(self, deadline: float):
+        with self._lock:
+            if self._logged_in:
+                return
+        login_url = GRAPHQL_URL.replace("/graphql", "/auth/login")
+        login_payload = json.dumps({"username": AUTH_USERNAME, "password": AUTH_PASSWORD}).encode("utf-8")
+        resp = self._post(login_url, login_payload, deadline)
+        resp.raise_for_status()
+        with self._lock:
+            self._logged_in = True
+        logger.info("GraphQL: Successfully logged in and obtained session cookie.")
+
+    def request(self, payload_json: str, authenticate: bool = False, idempotent: bool = True):
+        """
+        Send a serialised GraphQL payload and return the raw response. Raises requests.RequestException.
+        Pass idempotent=False for mutations, see _post.
+        """
+        
+        deadline = time.monotonic() + GRAPHQL_DEADLINE
+        body = payload_json.encode("utf-8")
+        if authenticate:
+            self._login(deadline)
+        response = self._post(GRAPHQL_URL, body, deadline, idempotent)
+        if authenticate and response.status_code == 401:
+            # Session cookie expired, log in again once.
+            with self._lock:
+                self._logged_in = False
+            self._login(deadline)
+            response = self._post(GRAPHQL_URL, body, deadline, idempotent)
+        return response
+
+    def cookie_header(self) -> str:
+        """The session's cookies (login included) as a Cookie header value, for connections made outside requests."""
+        with self._lock:
+            session = self._session
+        if session is None:
+            return ""
+        return "; ".join(f"{cookie.name}={cookie.value}" for cookie in session.cookies)
+
+    def close(self):
+        with self._lock:
+            session, self._session = self._session, None
+            self._logged_in = False
+        if session is not None:
+            session.close()
+
+_graphql_client = _GraphQLClient()
+
+def _is_mutation(request: str) -> bool:
+    return request.lstrip().startswith("mutation")
+
 def graphql_request(request: str, variables: dict = None, gql_debugging: bool = False):
     """
     Framework for making requests to GraphQL
@@ -284,8 +492,8 @@ def graphql_request(request: str, variables: dict = None, gql_debugging: bool =
     # Forcefully enable or disable detailed debug logs
     #debug = True
     
-    headers = {"Content-Type": "application/json"}
     payload = {"query": request, "variables": variables or {}}
+    response = None
 
     if orchestrator.dry_run:
         logger.info(f"[DRY RUN] GraphQL: Would make request: {request} with variables {variables}")
@@ -299,7 +507,7 @@ def graphql_request(request: str, variables: dict = None, gql_debugging: bool =
             log_clarification("debug")
             log(f"GraphQL Request Payload:\n{json.dumps(payload, indent=2)}", "debug") # NOTE: DEBUGGING
         
-        response = requests.post(GRAPHQL_URL, headers=headers, data=payload_json)
+        response = _graphql_client.request(payload_json, idempotent=not _is_mutation(request))
         response.raise_for_status()
         result = response.json()
         
@@ -321,8 +529,6 @@ def new_graphql_request(request: str, variables: dict = None, gql_debugging: boo
     New framework for making requests to GraphQL. Allows for authentication with the server.
     """
     
-    global graphql_session, AUTH_USERNAME, AUTH_PASSWORD
-    
     orchestrator.refresh_globals()
     
     if gql_debugging:
@@ -333,42 +539,20 @@ def new_graphql_request(request: str, variables: dict = None, gql_debugging: boo
     # Forcefully enable or disable detailed debug logs
     #debug = True
     
-    headers = {"Content-Type": "application/json"}
     payload = {"query": request, "variables": variables or {}}
+    response = None
 
     if orchestrator.dry_run:
         logger.info(f"[DRY RUN] GraphQL: Would make request: {request} with variables {variables}")
         return None
 
     try:
-        if graphql_session is None:
-            # Initialise session and login once
-            graphql_session = requests.Session()
-            login_payload = {
-                "username": AUTH_USERNAME,
-                "password": AUTH_PASSWORD,
-            }
-            
-            login_url = GRAPHQL_URL.replace("/graphql", "/auth/login")
-            
-            resp = graphql_session.post(login_url, json=login_payload, headers={"Content-Type": "application/json"})
-            resp.raise_for_status()
-            if resp.status_code != 200:
-                logger.error(f"GraphQL: Login failed with status {resp.status_code}: {resp.text}")
-                return None
-            
-            logger.info("GraphQL: Successfully logged in and obtained session cookie.")
-
         if debug == True:
             log_clarification("debug")
             log(f"GraphQL Request Payload: {json.dumps(payload, indent=2)}", "debug") # NOTE: DEBUGGING
         
-        # Use json parameter (requests serialises internally, no manual serialisation needed)
-        response = graphql_session.post(
-            GRAPHQL_URL,
-            headers=headers,
-            json=payload
-        )
+        # Logs in once on the shared session, then reuses its cookie
+        response = _graphql_client.request(json.dumps(payload), authenticate=True, idempotent=not _is_mutation(request))
         response.raise_for_status()
         result = response.json()
         
@@ -584,6 +768,198 @@ def update_suwayomi(operation: str, category_id, update_suwayomi_debugging: bool
         result = graphql_request(query, gql_debugging=update_suwayomi_debugging)
         return result
 
+_STATUS_SUBSCRIPTION_QUERY = """
+subscription LibraryUpdateStatusChanged {
+  libraryUpdateStatusChanged(input: {}) {
+    jobsInfo {
+      isRunning
+      totalJobs
+      finishedJobs
+      skippedCategoriesCount
+      skippedMangasCount
+    }
+  }
+}
+"""
+
+def _jobs_progress(jobs_info):
+    """
+    (is_running, finished, total) from a jobsInfo payload, which is either a single dict or a list of jobs.
+    None when the format is unexpected.
+    """
+    
+    # If it's a list of jobs, sum them
+    if isinstance(jobs_info, list):
+        is_running = any(job.get("isRunning", False) for job in jobs_info)
+        finished = sum(job.get("finishedJobs", 0) for job in jobs_info)
+        total = sum(job.get("totalJobs", 0) for job in jobs_info)
+        return is_running, finished, total
+    
+    # If it's a single dict
+    if isinstance(jobs_info, dict):
+        return jobs_info.get("isRunning", False), jobs_info.get("finishedJobs", 0), jobs_info.get("totalJobs", 0)
+    
+    return None
+
+def _open_status_subscription():
+    """
+    Subscribe to library update status over a graphql-transport-ws websocket.
+    Returns the open connection, or None when subscriptions are off, websocket-client is missing or the server refuses.
+    """
+    
+    if not SUWAYOMI_STATUS_SUBSCRIPTION or websocket is None or orchestrator.dry_run:
+        return None
+    
+    parts = urlsplit(GRAPHQL_URL)
+    url = urlunsplit(("wss" if parts.scheme == "https" else "ws", parts.netloc, parts.path, parts.query, ""))
+    ws = None
+    try:
+        ws = websocket.create_connection(
+            url,
+            subprotocols=["graphql-transport-ws"],
+            cookie=_graphql_client.cookie_header() or None,
+            timeout=SUWAYOMI_SUBSCRIPTION_TIMEOUT,
+        )
+        ws.send(json.dumps({"type": "connection_init", "payload": {}}))
+        while True:
+            message = json.loads(ws.recv())
+            if message.get("type") == "connection_ack":
+                break
+            if message.get("type") == "ping":
+                ws.send(json.dumps({"type": "pong"}))
+                continue
+            raise ValueError(f"unexpected {message.get('type')} message before connection_ack")
+        ws.send(json.dumps({"id": "status", "type": "subscribe", "payload": {"query": _STATUS_SUBSCRIPTION_QUERY}}))
+        log(f"GraphQL: Subscribed to library update status at {url}.", "debug")
+        return ws
+    
+    except Exception as e:
+        logger.warning(f"GraphQL: Update status subscription unavailable ({e}), polling instead.")
+        if ws is not None:
+            ws.close()
+        return None
+
+def _next_status_update(ws):
+    """
+    Block until the subscription delivers the next jobsInfo. None if nothing arrived within SUWAYOMI_SUBSCRIPTION_TIMEOUT.
+    Raises when the subscription errors out or the connection closes.
+    """
+    
+    while True:
+        try:
+            raw = ws.recv()
+        except websocket.WebSocketTimeoutException:
+            return None
+        if not raw:
+            raise ConnectionError("subscription connection closed")
+        message = json.loads(raw)
+        kind = message.get("type")
+        if kind == "ping":
+            ws.send(json.dumps({"type": "pong"}))
+        elif kind == "next":
+            payload = message.get("payload") or {}
+            if payload.get("errors"):
+                raise ValueError(payload["errors"])
+            return ((payload.get("data") or {}).get("libraryUpdateStatusChanged") or {}).get("jobsInfo")
+        elif kind in ("error", "complete"):
+            raise ValueError(f"subscription ended ({kind}): {message.get('payload')}")
+
+def _follow_status_subscription(ws, pbar, category_id, update_library: bool) -> bool:
+    """
+    Drive the progress bar from subscription updates as they arrive. Returns True once the update has finished.
+    """
+    
+    # Until the triggered update is seen running, an idle status may predate it.
+    seen_running = not update_library
+    while True:
+        jobs_info = _next_status_update(ws)
+        confirmed = False
+        if jobs_info is None:
+            # Quiet for a while: ask directly, so an update that never reported (or already ended) is not waited on forever
+            result = update_suwayomi("status", category_id)
+            jobs_info = ((result or {}).get("data") or {}).get("libraryUpdateStatus", {}).get("jobsInfo")
+            confirmed = True
+        
+        progress = _jobs_progress(jobs_info)
+        if progress is None:
+            continue
+        is_running, finished, total = progress
+        
+        if total > 0 and pbar.total != total:
+            pbar.total = total
+            pbar.refresh()
+        if finished > pbar.n:
+            pbar.update(finished - pbar.n)
+        
+        if is_running:
+            seen_running = True
+            continue
+        if seen_running or confirmed:
+            if pbar.total:
+                pbar.n = pbar.total
+                pbar.refresh()
+            logger.info(f"Suwayomi library update for Category ID {category_id} completed.")
+            return True
+
+def refresh_mangas(manga_ids) -> set:
+    """
+    Rescan specific mangas, SUWAYOMI_REFRESH_BATCH_SIZE per request. Each gets an aliased fetchManga mutation (details.json,
+    cover) and a fetchChapters mutation.
+    Returns the IDs that were refreshed. IDs Suwayomi reports errors for are dropped from the manga cache.
+    """
+    
+    manga_ids = sorted(set(manga_ids))
+    refreshed = set()
+    pbar = tqdm(total=len(manga_ids), desc="Suwayomi Refresh", unit="manga", dynamic_ncols=True)
+    for start in range(0, len(manga_ids), SUWAYOMI_REFRESH_BATCH_SIZE):
+        batch = manga_ids[start:start + SUWAYOMI_REFRESH_BATCH_SIZE]
+        params = ", ".join(f"$m{i}: Int!" for i in range(len(batch)))
+        fields = "\n".join(
+            f"  m{i}: fetchManga(input: {{ id: $m{i} }}) {{ clientMutationId }}\n"
+            f"  c{i}: fetchChapters(input: {{ mangaId: $m{i} }}) {{ clientMutationId }}"
+            for i in range(len(batch))
+        )
+        mutation = f"mutation RefreshMangas({params}) {{\n{fields}\n}}"
+        result = graphql_request(mutation, variables={f"m{i}": manga_id for i, manga_id in enumerate(batch)})
+        if result:
+            data = result.get("data") or {}
+            failed = {error["path"][0] for error in result.get("errors") or [] if error.get("path")}
+            unknown_ids = set()
+            for i, manga_id in enumerate(batch):
+                if {f"m{i}", f"c{i}"} & failed or data.get(f"m{i}") is None or data.get(f"c{i}") is None:
+                    unknown_ids.add(manga_id)
+                else:
+                    refreshed.add(manga_id)
+            if unknown_ids:
+                logger.warning(f"GraphQL: Could not refresh manga IDs {sorted(unknown_ids)}.")
+                _manga_cache.invalidate(unknown_ids)
+        pbar.update(len(batch))
+    pbar.close()
+    return refreshed
+
+def refresh_touched_creator_mangas():
+    """
+    Refresh the mangas of the creators that got new galleries ("touched_creators" in creators_metadata.json).
+    Creators without a Suwayomi manga yet stay recorded until one exists, creators whose folder is gone are dropped.
+    """
+    
+    names = _touched_creators.snapshot()
+    touched = {name for name in names if os.path.isdir(os.path.join(DEDICATED_DOWNLOAD_PATH, name))}
+    stale = names - touched
+    
+    manga_ids = {}
+    if touched:
+        manga_ids = {name: entry["id"] for name, entry in _manga_cache.lookup(touched).items()}
+    done = set(stale)
+    if manga_ids:
+        log_clarification()
+        logger.info(f"GraphQL: Refreshing {len(manga_ids)} creator mangas...")
+        refreshed = refresh_mangas(manga_ids.values())
+        done.update(name for name, manga_id in manga_ids.items() if manga_id in refreshed)
+    
+    _touched_creators.discard(done)
+    _touched_creators.save()
+
 def populate_suwayomi(category_id: int, attempt: int, update_library: bool = True):
     log_clarification()
     log(f"Suwayomi Update Triggered. Waiting for completion...")
@@ -594,17 +970,37 @@ def populate_suwayomi(category_id: int, attempt: int, update_library: bool = Tru
         # Load category data
         update_suwayomi("category browse", category_id, update_suwayomi_debugging=False)
         
+        # With SUWAYOMI_TARGETED_REFRESH only the creators that got new galleries are rescanned
+        if update_library and SUWAYOMI_TARGETED_REFRESH:
+            refresh_touched_creator_mangas()
+            return
+        
+        # Subscribe before triggering the update, so none of its progress is missed
+        subscription = _open_status_subscription()
+        
         # Trigger the global update
         if update_library:
             update_suwayomi("category", category_id, update_suwayomi_debugging=False)
 
         # Initialise progress bar
         pbar = tqdm(total=0, desc=f"Suwayomi Update (Attempt {attempt}/{orchestrator.max_retries})", unit="job", dynamic_ncols=True)
-        last_finished = 0
-        total_jobs = None
+        
+        if subscription is not None:
+            try:
+                if _follow_status_subscription(subscription, pbar, category_id, update_library):
+                    pbar.close()
+                    return
+            except Exception as e:
+                logger.warning(f"GraphQL: Update status subscription dropped ({e}), polling instead.")
+            finally:
+                subscription.close()
+        
+        # Polling fallback, picking up from wherever the subscription left the progress bar
+        last_finished = pbar.n
+        total_jobs = pbar.total or None
 
         while True:
-            result = update_suwayomi("status", category_id, update_suwayomi_debugging=True) # NOTE: DEBUGGING
+            result = update_suwayomi("status", category_id, update_suwayomi_debugging=False)
             
             # Wait BEFORE checking status to avoid exiting early.
             time.sleep(wait_time)
@@ -616,23 +1012,12 @@ def populate_suwayomi(category_id: int, attempt: int, update_library: bool = Tru
 
             try:
                 jobs_info = result.get("data", {}).get("libraryUpdateStatus", {}).get("jobsInfo", {})
-
-                # If it's a list of jobs, keep current logic
-                if isinstance(jobs_info, list):
-                    is_running = any(job.get("isRunning", False) for job in jobs_info)
-                    finished = sum(job.get("finishedJobs", 0) for job in jobs_info)
-                    total = sum(job.get("totalJobs", 0) for job in jobs_info)
-
-                # If it's a single dict
-                elif isinstance(jobs_info, dict):
-                    is_running = jobs_info.get("isRunning", False)
-                    finished = jobs_info.get("finishedJobs", 0)
-                    total = jobs_info.get("totalJobs", 0)
-
-                else:
+                progress = _jobs_progress(jobs_info)
+                if progress is None:
                     logger.warning("Unexpected jobsInfo format, retrying...")
                     time.sleep(wait_time)
                     continue
+                is_running, finished, total = progress
             
             except (KeyError, TypeError):
                 logger.warning("Unexpected status response format, retrying...")
@@ -670,9 +1055,14 @@ def populate_suwayomi(category_id: int, attempt: int, update_library: bool = Tru
     except Exception as e:
         logger.warning(f"Failed during Suwayomi update for category {category_id}: {e}")
 
-def add_mangas_to_suwayomi(ids: list[int], category_id: int):
+def add_mangas_to_suwayomi(ids: list[int], category_id: int) -> set:
+    """
+    Mark mangas as in library and add them to a category.
+    Returns the IDs that could not be confirmed (request failed, or Suwayomi does not know them).
+    """
+    
     if not ids:
-        return
+        return set()
     
     log(f"GraphQL: Updating mangas {ids} as 'In Library'", "debug")
     mutation = """
@@ -698,35 +1088,247 @@ def add_mangas_to_suwayomi(ids: list[int], category_id: int):
     """
     result = graphql_request(mutation, variables={"ids": ids, "categoryId": category_id})
     #log(f"GraphQL: updateMangasCategories result: {result}", "debug")
-    logger.debug(f"GraphQL: Added {len(ids)} mangas to category {category_id}.")
+    if orchestrator.dry_run:
+        return set()
+    if not result:
+        return set(ids)
     
-def fetch_creators_suwayomi_metadata(creator_name: str):
+    # Mangas missing from the response are unknown to Suwayomi, so their cached IDs are stale
+    updated = ((result.get("data") or {}).get("updateMangasCategories") or {}).get("mangas") or []
+    updated_ids = {int(manga["id"]) for manga in updated}
+    unknown_ids = set(ids) - updated_ids
+    if unknown_ids:
+        logger.warning(f"GraphQL: Suwayomi did not recognise manga IDs {sorted(unknown_ids)}.")
+        _manga_cache.invalidate(unknown_ids)
+    _manga_cache.mark_added(updated_ids, category_id)
+    logger.debug(f"GraphQL: Added {len(updated_ids)} mangas to category {category_id}.")
+    return unknown_ids
+    
+def fetch_creators_suwayomi_mangas(creator_names) -> dict:
     """
-    Retrieve metadata for a creator from Suwayomi's Local Source by exact title match.
-    Returns the list of nodes (id, title, chapters, etc).
+    Look up several creators' mangas in Suwayomi's Local Source by exact title, GRAPHQL_LOOKUP_BATCH_SIZE titles per request.
+    Returns {title: node} with id, title, inLibrary and category ids. Creators without a manga are left out.
     """
     
     query = """
-    query FetchMangaMetadataFromLocalSource($title: String!) {
+    query FetchMangasFromLocalSource($titles: [String!]!) {
       mangas(
-        filter: { sourceId: { equalTo: "0" }, title: { equalTo: $title } }
+        filter: { sourceId: { equalTo: "0" }, title: { in: $titles } }
       ) {
         nodes {
           id
           title
-          chapters {
+          inLibrary
+          categories {
             nodes {
-              name
+              id
             }
           }
         }
       }
     }
     """
-    result = graphql_request(query, variables={"title": creator_name})
-    if not result:
-        return []
-    return result.get("data", {}).get("mangas", {}).get("nodes", [])
+    titles = sorted(set(creator_names))
+    mangas = {}
+    for start in range(0, len(titles), GRAPHQL_LOOKUP_BATCH_SIZE):
+        batch = titles[start:start + GRAPHQL_LOOKUP_BATCH_SIZE]
+        result = graphql_request(query, variables={"titles": batch})
+        nodes = ((result or {}).get("data") or {}).get("mangas", {}).get("nodes", [])
+        for node in nodes:
+            mangas.setdefault(node["title"], node) # title is unique per creator
+    return mangas
+
+class _SuwayomiMangaCache:
+    """
+    Creator title -> {"id", "inLibrary", "categories"} for Suwayomi's Local Source, where manga IDs are stable once created.
+    Filled in bulk with one paginated listing when no cache exists yet, then persisted between runs.
+    Titles that miss are looked up in batches, and IDs a mutation reports as unknown are dropped.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filling = threading.Lock()
+        self._mangas = None # Title -> entry.
+        self._filled = False
+        self._dirty = False
+
+    @staticmethod
+    def path() -> str:
+        return SUWAYOMI_MANGA_CACHE_PATH or engine.library_state_path("suwayomi_mangas.json")
+
+    @staticmethod
+    def _entry(node: dict) -> dict:
+        return {
+            "id": int(node["id"]),
+            "inLibrary": bool(node.get("inLibrary")),
+            "categories": [int(c["id"]) for c in (node.get("categories") or {}).get("nodes", [])],
+        }
+
+    def _ensure_loaded(self):
+        if self._mangas is not None:
+            return
+        self._mangas = {}
+        try:
+            with open(self.path(), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._mangas = dict(data.get("mangas", {}))
+            self._filled = bool(data.get("filled"))
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def _list_local_source(self):
+        """Every manga in the Local Source, SUWAYOMI_MANGA_PAGE_SIZE per request. None if the listing failed."""
+        query = """
+        query ListLocalSourceMangas($first: Int!, $offset: Int!) {
+          mangas(filter: { sourceId: { equalTo: "0" } }, orderBy: ID, first: $first, offset: $offset) {
+            nodes {
+              id
+              title
+              inLibrary
+              categories {
+                nodes {
+                  id
+                }
+              }
+            }
+            pageInfo {
+              hasNextPage
+            }
+          }
+        }
+        """
+        mangas = {}
+        offset = 0
+        while True:
+            result = graphql_request(query, variables={"first": SUWAYOMI_MANGA_PAGE_SIZE, "offset": offset})
+            page = ((result or {}).get("data") or {}).get("mangas")
+            if not page:
+                return None
+            nodes = page.get("nodes", [])
+            for node in nodes:
+                mangas.setdefault(node["title"], self._entry(node))
+            if not nodes or not (page.get("pageInfo") or {}).get("hasNextPage"):
+                return mangas
+            offset += len(nodes)
+
+    def _fill(self):
+        with self._filling:
+            with self._lock:
+                self._ensure_loaded()
+                if self._filled:
+                    return
+            mangas = self._list_local_source()
+            if mangas is None:
+                return # Try again on the next lookup.
+            with self._lock:
+                self._mangas = mangas
+                self._filled = True
+                self._dirty = True
+            logger.info(f"GraphQL: Cached {len(mangas)} Local Source mangas.")
+
+    def lookup(self, titles) -> dict:
+        """
+        Return {title: entry} for the titles Suwayomi has a Local Source manga for.
+        """
+        
+        titles = set(titles)
+        if not titles or orchestrator.dry_run:
+            return {}
+        with self._lock:
+            self._ensure_loaded()
+            filled = self._filled
+        if not filled:
+            self._fill()
+        with self._lock:
+            found = {title: dict(self._mangas[title]) for title in titles if title in self._mangas}
+        misses = titles - found.keys()
+        if misses:
+            # Mangas created since the cache was filled
+            fetched = {title: self._entry(node) for title, node in fetch_creators_suwayomi_mangas(misses).items()}
+            if fetched:
+                with self._lock:
+                    self._mangas.update(fetched)
+                    self._dirty = True
+                found.update((title, dict(entry)) for title, entry in fetched.items())
+        return found
+
+    def refresh_state(self, ids):
+        """
+        Re-read the library and category state of manga IDs from Suwayomi, GRAPHQL_LOOKUP_BATCH_SIZE IDs per request,
+        since the cached state may be out of date. Returns {id: entry}, or None if a request failed.
+        IDs Suwayomi no longer knows are dropped from the cache and left out.
+        """
+        
+        query = """
+        query FetchMangaLibraryState($ids: [Int!]!) {
+          mangas(filter: { id: { in: $ids } }) {
+            nodes {
+              id
+              inLibrary
+              categories {
+                nodes {
+                  id
+                }
+              }
+            }
+          }
+        }
+        """
+        ids = sorted(set(ids))
+        states = {}
+        for start in range(0, len(ids), GRAPHQL_LOOKUP_BATCH_SIZE):
+            batch = ids[start:start + GRAPHQL_LOOKUP_BATCH_SIZE]
+            result = graphql_request(query, variables={"ids": batch})
+            page = ((result or {}).get("data") or {}).get("mangas")
+            if not page:
+                return None
+            for node in page.get("nodes", []):
+                entry = self._entry(node)
+                states[entry["id"]] = entry
+        with self._lock:
+            self._ensure_loaded()
+            for entry in self._mangas.values():
+                state = states.get(entry["id"])
+                if state is not None and (state["inLibrary"], state["categories"]) != (entry["inLibrary"], entry["categories"]):
+                    entry["inLibrary"], entry["categories"] = state["inLibrary"], list(state["categories"])
+                    self._dirty = True
+        self.invalidate(set(ids) - states.keys())
+        return states
+
+    def mark_added(self, ids, category_id):
+        ids = set(ids)
+        if not ids:
+            return
+        with self._lock:
+            self._ensure_loaded()
+            for entry in self._mangas.values():
+                if entry["id"] in ids:
+                    entry["inLibrary"] = True
+                    if category_id is not None and category_id not in entry["categories"]:
+                        entry["categories"].append(category_id)
+                    self._dirty = True
+
+    def invalidate(self, ids):
+        ids = set(ids)
+        with self._lock:
+            self._ensure_loaded()
+            stale = [title for title, entry in self._mangas.items() if entry["id"] in ids]
+            for title in stale:
+                del self._mangas[title]
+            self._dirty = self._dirty or bool(stale)
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or self._mangas is None:
+                return
+            data = {"filled": self._filled, "mangas": dict(self._mangas)}
+            self._dirty = False
+        try:
+            engine.save_json_atomic(self.path(), data)
+        except OSError as e:
+            logger.warning(f"{EXTENSION_REFERRER}: Could not save Suwayomi manga cache: {e}")
+
+_manga_cache = _SuwayomiMangaCache()
 
 def remove_from_deferred(creator_name: str, metadata: dict = None):
     """
@@ -749,6 +1351,33 @@ def remove_from_deferred(creator_name: str, metadata: dict = None):
 # ------------------------------------------------------------
 # Update creator mangas and ensure they are added to Suwayomi
 # ------------------------------------------------------------
+def fetch_creators_top_genres(creator_names: list) -> dict:
+    """
+    Look up most_popular_tags (top genres) for several creators in one database connection and two queries.
+    Returns {creator_name: [genre names]}. Creators without tags are left out.
+    """
+    
+    genres = {}
+    if not creator_names:
+        return genres
+    try:
+        with scraperdb.lock, scraperdb._connect() as conn:
+            cursor = conn.cursor()
+            qmarks = ",".join(["?"] * len(creator_names))
+            cursor.execute(f"SELECT name, most_popular_tags FROM Creators WHERE name IN ({qmarks})", list(creator_names))
+            tag_ids_by_creator = {name: json.loads(tags) for name, tags in cursor.fetchall() if tags}
+            all_tag_ids = sorted({tag_id for tag_ids in tag_ids_by_creator.values() for tag_id in tag_ids})
+            if all_tag_ids:
+                # Resolve tag names from tag ids
+                qmarks = ",".join(["?"] * len(all_tag_ids))
+                cursor.execute(f"SELECT id, name FROM Tags WHERE id IN ({qmarks})", all_tag_ids)
+                tag_names = {tag_id: name for tag_id, name in cursor.fetchall() if name}
+                for name, tag_ids in tag_ids_by_creator.items():
+                    genres[name] = [tag_names[tag_id] for tag_id in tag_ids if tag_id in tag_names]
+    except Exception as e:
+        logger.warning(f"Could not fetch top genres from database for {', '.join(creator_names)}: {e}")
+    return genres
+
 def update_creator_manga(meta):
     """
     Update a creator's details.json and genre metadata based on a downloaded gallery.
@@ -783,28 +1412,31 @@ def update_creator_manga(meta):
     if "creators" not in metadata:
         metadata["creators"] = {}
 
-    for creator_name in creators:
-        # --- Try to retrieve manga metadata from Suwayomi ---
-        nodes = fetch_creators_suwayomi_metadata(creator_name)
-        suwayomi_id = int(nodes[0]["id"]) if nodes else None
+    creator_genres = fetch_creators_top_genres(creators)
 
-        if suwayomi_id is not None:
-            collected_ids.add(suwayomi_id)
-            try:
-                add_mangas_to_suwayomi([suwayomi_id], CATEGORY_ID)
-                collected_ids.discard(suwayomi_id)
+    # --- Retrieve every creator's manga from the cache, asking Suwayomi only for misses ---
+    cached_mangas = _manga_cache.lookup(creators)
+    suwayomi_ids = {name: cached_mangas[name]["id"] for name in creators if name in cached_mangas}
 
+    # No existing manga found, mark creator as deferred
+    deferred_creators.update(name for name in creators if name not in suwayomi_ids)
+
+    if suwayomi_ids:
+        try:
+            failed_ids = add_mangas_to_suwayomi(sorted(set(suwayomi_ids.values())), CATEGORY_ID)
+            for creator_name, suwayomi_id in suwayomi_ids.items():
+                if suwayomi_id in failed_ids:
+                    deferred_creators.add(creator_name)
+                    continue
                 # Pass metadata to avoid redundant I/O
                 metadata = remove_from_deferred(creator_name, metadata)
+                deferred_creators.discard(creator_name)
 
-            except Exception as e:
-                logger.warning(f"Failed to update manga {suwayomi_id} for {creator_name}: {e}")
-                collected_ids.discard(suwayomi_id)
-                deferred_creators.add(creator_name)
-        else:
-            # No existing manga found, mark creator as deferred
-            deferred_creators.add(creator_name)
+        except Exception as e:
+            logger.warning(f"Failed to update mangas {sorted(suwayomi_ids.values())} for {', '.join(suwayomi_ids)}: {e}")
+            deferred_creators.update(suwayomi_ids)
 
+    for creator_name in creators:
         # --- Update details.json using top genres from database ---
         creator_folder = os.path.join(DEDICATED_DOWNLOAD_PATH, creator_name)
         os.makedirs(creator_folder, exist_ok=True)
@@ -816,26 +1448,8 @@ def update_creator_manga(meta):
         else:
             description = f"Latest Doujin: {latest_name}"
 
-        # Query database for most_popular_tags (top genres) for this creator
-        genre_names = []
-        try:
-            with scraperdb.lock, scraperdb._connect() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT id FROM Creators WHERE name=?", (creator_name,))
-                row = cursor.fetchone()
-                if row:
-                    creator_id = row[0]
-                    cursor.execute("SELECT most_popular_tags FROM Creators WHERE id=?", (creator_id,))
-                    tag_ids_json = cursor.fetchone()
-                    if tag_ids_json and tag_ids_json[0]:
-                        tag_ids = json.loads(tag_ids_json[0])
-                        if tag_ids:
-                            # Resolve tag names from tag ids
-                            qmarks = ",".join(["?"] * len(tag_ids))
-                            cursor.execute(f"SELECT name FROM Tags WHERE id IN ({qmarks})", tag_ids)
-                            genre_names = [r[0] for r in cursor.fetchall() if r and r[0]]
-        except Exception as e:
-            logger.warning(f"Could not fetch top genres from database for {creator_name}: {e}")
+        # Top genres for this creator, looked up for every creator at once above
+        genre_names = creator_genres.get(creator_name, [])
 
         details = {
             "title": creator_name,
@@ -853,6 +1467,8 @@ def update_creator_manga(meta):
     # --- Save all metadata at once ---
     metadata["collected_manga_ids"] = sorted(collected_ids)
     metadata["deferred_creators"] = sorted(deferred_creators)
+    if SUWAYOMI_TARGETED_REFRESH:
+        _touched_creators.add(creators) # Refreshed in populate_suwayomi
     save_creators_metadata(metadata)
 
 def process_deferred_creators(populate: bool = True):
@@ -907,6 +1523,8 @@ def process_deferred_creators(populate: bool = True):
             if new_ids:
                 logger.info(f"GraphQL: Adding {len(new_ids)} mangas to library and category.")
                 add_mangas_to_suwayomi(new_ids, CATEGORY_ID)
+                if populate and SUWAYOMI_TARGETED_REFRESH:
+                    refresh_touched_creator_mangas() # Newly added mangas have no chapters until refreshed
 
         # ----------------------------
         # Process deferred creators
@@ -922,46 +1540,40 @@ def process_deferred_creators(populate: bool = True):
             return
 
         logger.info(f"GraphQL: Processing {len(deferred_creators)} deferred creators...")
-
-        query = """
-        query FindMangaMetadataFromLocalSource($creatorName: String!) {
-        mangas(
-            filter: { sourceId: { equalTo: "0" }, title: { equalTo: $creatorName } }
-        ) {
-            nodes {
-            id
-            title
-            inLibrary
-            categories {
-                nodes {
-                id
-                }
-            }
-            }
-        }
-        }
-        """
         
         new_ids = set()
         processed_creators = set()
+        still_deferred = set()
 
+        lookup = []
         for creator_name in sorted(deferred_creators):
             creator_folder = os.path.join(DEDICATED_DOWNLOAD_PATH, creator_name)
             if not os.path.exists(creator_folder):
                 logger.warning(f"Skipping deferred creator '{creator_name}': folder does not exist.")
                 still_deferred.add(creator_name)
                 continue
+            lookup.append(creator_name)
 
-            result = graphql_request(query, variables={"creatorName": creator_name})
-            mangas = result.get("data", {}).get("mangas", {}).get("nodes", []) if result else []
+        # Look up every remaining creator's manga ID in the cache, misses in GRAPHQL_LOOKUP_BATCH_SIZE chunks
+        cached_mangas = _manga_cache.lookup(lookup)
+        # The cached library / category state may be stale, so re-read it before dropping anyone from the deferred list.
+        # If that fails, everyone is queued again; adding a manga that is already in the library is harmless.
+        states = _manga_cache.refresh_state(entry["id"] for entry in cached_mangas.values()) if cached_mangas else {}
 
-            if not mangas:
+        for creator_name in lookup:
+            manga_info = cached_mangas.get(creator_name)
+            if manga_info is None:
                 logger.warning(f"Creator manga '{creator_name}' not found in Suwayomi local source.")
                 still_deferred.add(creator_name)
                 continue
+            
+            state = states.get(manga_info["id"]) if states is not None else None
+            if states is not None and state is None:
+                logger.warning(f"Creator manga '{creator_name}' (ID {manga_info['id']}) no longer exists in Suwayomi.")
+                still_deferred.add(creator_name) # Looked up again next attempt
+                continue
 
-            manga_info = mangas[0]  # title is unique per creator
-            if manga_info.get("inLibrary") and CATEGORY_ID in [c["id"] for c in manga_info.get("categories", {}).get("nodes", [])]:
+            if state and state["inLibrary"] and CATEGORY_ID in state["categories"]:
                 logger.info(f"Creator manga '{creator_name}' already in library and category. Removing from deferred list.")
                 remove_from_deferred(creator_name)
                 continue
@@ -971,9 +1583,14 @@ def process_deferred_creators(populate: bool = True):
             logger.info(f"Queued manga ID {manga_info['id']} for '{creator_name}'.")
 
         if new_ids:
-            add_mangas_to_suwayomi(list(new_ids), CATEGORY_ID)
+            failed_ids = add_mangas_to_suwayomi(list(new_ids), CATEGORY_ID)
             for creator_name in processed_creators:
+                if cached_mangas[creator_name]["id"] in failed_ids:
+                    still_deferred.add(creator_name) # Stale ID, dropped from the cache and looked up again next attempt
+                    continue
                 remove_from_deferred(creator_name)
+            if populate and SUWAYOMI_TARGETED_REFRESH:
+                refresh_touched_creator_mangas()
         
         # If no creators remain, we're done early
         if not still_deferred:
@@ -994,103 +1611,28 @@ def process_deferred_creators(populate: bool = True):
 # CORE HOOKS (thread-safe)
 ####################################################################################################################
 
-# Hook for downloading images. Use active_extension.download_images_hook(ARGS) in downloader.
-def download_images_hook(gallery, page, urls, path, downloader_session, pbar=None, creator=None):
+# Hook for downloading a whole gallery. Use active_extension.download_gallery_hook(ARGS) in downloader.
+def download_gallery_hook(gallery, pages, downloader_session, pbar=None, creator=None, max_in_flight=None):
     """
-    Downloads an image from one of the provided URLs to the given path.
-    Tries mirrors in order until one succeeds, with retries per mirror.
-    Updates tqdm progress bar with current creator.
+    Downloads every page of a gallery. "pages" is a list of (page, urls, path) tuples.
+    Uses the asyncio engine when engine.DOWNLOAD_ENGINE is "asyncio", otherwise downloads pages on a bounded thread pool.
+    Returns a dict of page -> success.
     """
 
     orchestrator.refresh_globals()
     
-    # Abort early if shutdown requested
-    try:
-        from mangascraper.core.downloader import _shutdown_event
-    except ImportError:
-        _shutdown_event = None
-    if _shutdown_event and _shutdown_event.is_set():
-        logger.warning("Shutdown event detected, aborting image download.")
-        return False
-
-    if not urls:
-        logger.warning(f"Gallery {gallery}: Page {page}: No URLs, skipping")
-        if pbar and creator:
-            pbar.set_postfix_str(f"Skipped Creator: {creator}")
-        return False
-
-    if os.path.exists(path):
-        log(f"Already exists, skipping: {path}", "debug")
-        if pbar and creator:
-            pbar.set_postfix_str(f"Creator: {creator}")
-        return True
+    return engine.download_gallery(gallery, pages, downloader_session, pbar, creator, max_in_flight)
 
-    if orchestrator.dry_run:
-        logger.info(f"[DRY RUN] Gallery {gallery}: Would download {urls[0]} -> {path}")
-        if pbar and creator:
-            pbar.set_postfix_str(f"Creator: {creator}")
-        return True
-
-    if not isinstance(downloader_session, requests.Session):
-        downloader_session = requests.Session()
-
-    def try_download(session, mirrors, retries, tor_rotate=False):
-        """Try downloading with a given session and retry count."""
-        for url in mirrors:
-            for attempt in range(1, retries + 1):
-                try:
-                    r = session.get(url, timeout=(60, 60), stream=True)
-                    if r.status_code == 429:
-                        wait = 2 ** attempt
-                        logger.warning(f"429 rate limit hit for {url}, waiting {wait}s")
-                        time.sleep(wait)
-                        continue
-                    r.raise_for_status()
-
-                    os.makedirs(os.path.dirname(path), exist_ok=True)
-                    with open(path, "wb") as f:
-                        for chunk in r.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-
-                    log(f"Downloaded Gallery {gallery}: Page {page} -> {path}", "debug")
-                    if pbar and creator:
-                        pbar.set_postfix_str(f"Creator: {creator}")
-                    return True
-
-                except Exception as e:
-                    wait = dynamic_sleep("image", attempt=attempt)
-                    log_clarification()
-                    logger.warning(
-                        f"Gallery {gallery}: Page {page}: Mirror {url}, attempt {attempt} failed: {e}, retrying in {wait:.2f}s"
-                    )
-                    time.sleep(wait)
-
-            logger.warning(
-                f"Gallery {gallery}: Page {page}: Mirror {url} failed after {retries} attempts, trying next mirror"
-            )
-        return False
-
-    # First attempt: normal retries
-    success = try_download(downloader_session, urls, orchestrator.max_retries)
-
-    # If still failed, rebuild Tor session once and retry
-    if not success and orchestrator.use_tor:
-        logger.warning(
-            f"Gallery {gallery}: Page {page}: All retries failed, rotating Tor node and retrying once more..."
-        )
-        downloader_session = APIGet.session(referrer=f"{EXTENSION_NAME}", status="rebuild")
-        success = try_download(downloader_session, urls, 1, tor_rotate=True)
-
-    if not success:
-        log_clarification()
-        logger.error(
-            f"Gallery {gallery}: Page {page}: All mirrors failed after Tor rotate too: {urls}"
-        )
-        if pbar and creator:
-            pbar.set_postfix_str(f"Failed Creator: {creator}")
+# Hook for downloading images. Use active_extension.download_images_hook(ARGS) in downloader.
+def download_images_hook(gallery, page, urls, path, downloader_session, pbar=None, creator=None):
+    """
+    Downloads an image from one of the provided URLs to the given path.
+    Thin per-page wrapper around download_gallery_hook, kept for downloaders that call it once per page.
+    Updates tqdm progress bar with current creator.
+    """
 
-    return success
+    results = download_gallery_hook(gallery, [(page, urls, path)], downloader_session, pbar=pbar, creator=creator)
+    return results.get(page, False)
 
 # Hook for pre-batch functionality. Use active_extension.pre_batch_hook(ARGS) in downloader.
 def pre_batch_hook(gallery_list):
@@ -1147,190 +1689,13 @@ def after_completed_gallery_download_hook(meta: dict, gallery_id):
     with _gallery_meta_lock:
         _collected_gallery_metas.append(meta)
     
-    # Update creator's popular genres
-    update_creator_manga(meta)
-    
-    # Extract cover and delete original gallery folder after archiving
-    try:
-        gallery_format = str(orchestrator.gallery_format).lower() # Check if gallery format is valid, if not, treat as "directory" for safety
-        valid_formats = {"directory", "zip", "cbz"}
-        if gallery_format not in valid_formats:
-            logger.warning(
-                f"{EXTENSION_REFERRER}: Unknown GALLERY_FORMAT '{orchestrator.gallery_format}', "
-                "treating as 'directory' for safety."
-            )
-            gallery_format = "directory"
-
-        gallery_meta = build_gallery_metadata_summary(meta, EXTENSION_REFERRER)
-        creators = [sanitise_string(c) for c in gallery_meta.get("creator", [])]
-        tags = gallery_meta.get("tags", [])
-        languages = gallery_meta.get("languages", [])
-
-        # --- Consolidated database update call ---
-        scraperdb.update_gallery_metadata(
-            gallery_id=gallery_id,
-            raw_title=gallery_meta.get("raw_title"),
-            clean_title=gallery_meta.get("clean_title"),
-            language=languages,
-            tags=tags,
-            cover_path=gallery_meta.get("cover_path"),
-            creator_name=creators,
-            download_path=gallery_meta.get("download_path"),
-            extension_used=gallery_meta.get("extension_used"),
-            num_pages=gallery_meta.get("num_pages")
-        )
-
-        cover_source = None
-        cover_gallery_name = None
-        cover_ext = None
-        gallery_paths = {}
-        cover_gallery_id = None
-        
-        temp_root = "/opt/manga-scraper/mangascraper/core/data/archive_temp/"
-        for creator_name in creators:
-            creator_folder = os.path.join(DEDICATED_DOWNLOAD_PATH, creator_name)
-            temp_creator_folder = os.path.join(temp_root, creator_name)
-
-            search_folders = []
-            if os.path.isdir(creator_folder):
-                search_folders.append(creator_folder)
-            if os.path.isdir(temp_creator_folder):
-                search_folders.append(temp_creator_folder)
-            if not search_folders:
-                continue
-
-            gallery_prefix = f"({gallery_id})"
-            for search_folder in search_folders:
-                # Look for both directories and .cbz/.zip files
-                gallery_items = [
-                    f for f in os.listdir(search_folder)
-                    if (os.path.isdir(os.path.join(search_folder, f)) or f.endswith('.cbz') or f.endswith('.zip'))
-                    and f.startswith(gallery_prefix)
-                ]
-                if not gallery_items:
-                    continue
-                gallery_items.sort()
-                gallery_path = os.path.join(search_folder, gallery_items[0])
-                if os.path.isdir(gallery_path):
-                    gallery_paths[creator_name] = gallery_path
-
-                    if cover_source is None:
-                        candidates = [f for f in os.listdir(gallery_path) if f.startswith("1.")]
-                        if candidates:
-                            page1_file = os.path.join(gallery_path, candidates[0])
-                            _, ext = os.path.splitext(page1_file)
-                            cover_source = page1_file
-                            cover_gallery_name = gallery_items[0]
-                            cover_ext = ext
-                            cover_gallery_id = parse_gallery_id(cover_gallery_name)
-                elif gallery_items[0].endswith('.cbz') or gallery_items[0].endswith('.zip'):
-                    # If it's an archive, set the path for later use
-                    gallery_paths[creator_name] = gallery_path
-                else:
-                    logger.debug(f"Gallery {gallery_items[0]} is already archived or not a directory, skipping")
-
-        cover_generated = {}
-        for creator_name in creators:
-            creator_folder = os.path.join(DEDICATED_DOWNLOAD_PATH, creator_name)
-            if not os.path.isdir(creator_folder):
-                continue
-
-            # Extract cover from the downloaded gallery and store in hidden covers subfolder
-            if cover_source and cover_gallery_name and cover_ext:
-                covers_folder = os.path.join(creator_folder, ".covers")
-                try:
-                    os.makedirs(covers_folder, exist_ok=True)
-                    latest_cover_id = find_latest_cover_id(covers_folder)
-                    if cover_gallery_id is not None and latest_cover_id is not None:
-                        if cover_gallery_id <= latest_cover_id:
-                            gallery_path = gallery_paths.get(creator_name)
-                            if gallery_format == "directory" or not gallery_path:
-                                if gallery_format == "directory" and gallery_path:
-                                    logger.debug(
-                                        f"Gallery format is 'directory'; keeping original gallery folder: {gallery_path}"
-                                    )
-                                continue
-
-                    cover_in_subfolder = os.path.join(covers_folder, f"{cover_gallery_name}{cover_ext}")
-                    shutil.copy2(cover_source, cover_in_subfolder)
-                    logger.debug(f"Extracted cover for {creator_name}: {cover_in_subfolder}")
-
-                    # Remove any existing cover files (regardless of extension)
-                    for f in os.listdir(creator_folder):
-                        if f.startswith("cover") and f != "covers" and f != ".covers":
-                            try:
-                                os.unlink(os.path.join(creator_folder, f))
-                            except Exception as e:
-                                logger.debug(f"Could not remove old cover file {f}: {e}")
-
-                    # Symlink cover into creator root
-                    cover_link = os.path.join(creator_folder, f"cover{cover_ext}")
-                    os.symlink(cover_in_subfolder, cover_link)
-                    logger.debug(f"Updated cover symlink for {creator_name}: {cover_link} -> {cover_in_subfolder}")
-                    cover_generated[creator_name] = True
-                except Exception as e:
-                    logger.debug(f"Could not extract cover for Gallery {gallery_id}: {e}")
-
-            if not cover_generated.get(creator_name):
-                logger.debug(
-                    f"Skipping delete for {creator_name}; cover not generated for gallery {gallery_id}."
-                )
-                continue
-
-            gallery_path = gallery_paths.get(creator_name)
-            if gallery_format == "directory" or not gallery_path:
-                if gallery_format == "directory" and gallery_path:
-                    logger.debug(
-                        f"Gallery format is 'directory'; keeping original gallery folder: {gallery_path}"
-                    )
-                continue
-
-            archive_ext = ".cbz" if gallery_format == "cbz" else ".zip"
-            gallery_name = os.path.basename(gallery_path)
-            expected_archive = os.path.join(creator_folder, f"{gallery_name}{archive_ext}")
-            
-            # Archive the gallery if it's a directory and not already archived
-            if gallery_format in {"cbz", "zip"} and os.path.isdir(gallery_path):
-                import zipfile
-                archive_path = os.path.join(creator_folder, f"{gallery_name}{archive_ext}")
-                with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
-                    for root, _, files in os.walk(gallery_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            arcname = os.path.relpath(file_path, gallery_path)
-                            archive.write(file_path, arcname)
-                logger.debug(f"{EXTENSION_REFERRER}: Archived gallery {gallery_path} to {archive_path}")
-            
-            # Wait for the archive to exist
-            if not os.path.exists(expected_archive):
-                max_checks = max(1, int(ARCHIVE_WAIT_SECONDS / ARCHIVE_POLL_INTERVAL))
-                for _ in range(max_checks):
-                    time.sleep(ARCHIVE_POLL_INTERVAL)
-                    if os.path.exists(expected_archive):
-                        break
-                if not os.path.exists(expected_archive):
-                    logger.warning(
-                        f"Archive not found for Gallery {gallery_id} after {ARCHIVE_WAIT_SECONDS}s: "
-                        f"expected {expected_archive}; leaving folder undeleted"
-                    )
-                    logger.info(
-                        f"Leaving original folder in place: {gallery_path}"
-                    )
-                    continue
-
-            # Delete original gallery folder if it was archived
-            if os.path.isdir(gallery_path) and os.path.exists(expected_archive):
-                try:
-                    shutil.rmtree(gallery_path)
-                    logger.debug(f"Deleted original gallery folder: {gallery_path}")
-                except Exception as e:
-                    logger.error(f"Failed to delete gallery folder {gallery_path}: {e}")
-    
-    except Exception as e:
-        logger.error(f"Failed in post-download processing for Gallery {gallery_id}: {e}")
+    # Database write (queued), covers and archiving. The creator's popular genres are updated once the metadata has
+    # been written, because update_creator_manga reads them back from the database.
+    engine.process_completed_gallery(meta, gallery_id, on_written=lambda: update_creator_manga(meta))
 
 # Hook for cleaning after downloads
 def cleanup_hook():
+    engine.reconcile_links()
     repair_covers_hook(DEDICATED_DOWNLOAD_PATH, referrer=EXTENSION_REFERRER)
     cleanup_download_tree(DEDICATED_DOWNLOAD_PATH, remove_empty_artist_folder=True, log_scan_summary=True)
 
@@ -1362,6 +1727,10 @@ def post_batch_hook(current_batch_number: int, total_batch_numbers: int):
             and (current_batch_number % interval == 0) # If current batch hits interval
         )
     
+    engine.save_state() # Keep the persisted library state close to current in case the run is interrupted.
+    _manga_cache.save()
+    _touched_creators.save()
+    
     if _should_run_post_batch():
         cleanup_hook() # Call the cleanup hook
         
@@ -1379,6 +1748,8 @@ def post_run_hook():
     log_clarification("debug")
     log(f"{EXTENSION_REFERRER}: Post-run Hook Called.", "debug")
     
+    engine.shutdown() # Wait for archiving, save library state and release connections.
+    
     if orchestrator.skip_post_run:
         log_clarification("debug")
         log(f"{EXTENSION_REFERRER}: Post-run Hook Skipped.", "debug")
@@ -1390,4 +1761,8 @@ def post_run_hook():
                 
         # Update Suwayomi category at end
         log_clarification()
-        log("Please update the library manually and / or run a small download to reflect any changes.")
\ No newline at end of file
+        log("Please update the library manually and / or run a small download to reflect any changes.")
+    
+    _manga_cache.save()
+    _touched_creators.save()
+    _graphql_client.close()
\ No newline at end of file
@@ -0,0 +1,126 @@
+# mangascraper/extensions/tests/conftest.py
+
+"""
+Shared fixtures. The extensions import mangascraper.core and mangascraper.extensions.extension_manager. In a
+manga-scraper install (this repo as its extensions folder) the real modules are used. Anywhere else, minimal stand-ins
+are installed below, so the tests that do not need a database or a server still run.
+"""
+
+import os
+import re
+import sys
+import types
+import logging
+import tempfile
+import threading
+import importlib
+import pytest
+import requests
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _module(name: str, path: list = None, **attrs) -> types.ModuleType:
+    module = types.ModuleType(name)
+    if path is not None:
+        module.__path__ = path # A package, so submodules are found.
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+def _install_core_stubs():
+    """Stand-ins for the parts of manga-scraper the extensions import, with dry run and Tor off."""
+    logger = logging.getLogger("mangascraper")
+
+    _module("mangascraper", path=[])
+    _module("mangascraper.core", path=[])
+    _module(
+        "mangascraper.core.orchestrator",
+        __all__=["logger", "log", "log_clarification", "update_env", "dynamic_sleep", "sanitise_string", "config"],
+        logger=logger,
+        config={},
+        dry_run=False,
+        use_tor=False,
+        debug=False,
+        archiving=False,
+        skip_post_batch=False,
+        skip_post_run=False,
+        max_retries=3,
+        gallery_format="directory",
+        refresh_globals=lambda: None,
+        log=lambda message, level="info": logger.debug(message),
+        log_clarification=lambda level=None: None,
+        update_env=lambda key, value: None,
+        dynamic_sleep=lambda kind, attempt=1: 0.0,
+        sanitise_string=lambda text: re.sub(r"[/\\]", "_", text),
+    )
+    _module(
+        "mangascraper.core.api",
+        __all__=["APIGet"],
+        APIGet=types.SimpleNamespace(session=lambda referrer=None, status=None: requests.Session()),
+    )
+
+    def no_database():
+        raise RuntimeError("No manga-scraper database in the test stand-ins.")
+
+    _module(
+        "mangascraper.core.database",
+        lock=threading.Lock(),
+        _connect=no_database,
+        update_gallery_metadata=lambda **kwargs: None,
+    )
+
+    def parse_gallery_id(name):
+        match = re.match(r"^\((\d+)\)", name or "")
+        return int(match.group(1)) if match else None
+
+    _module("mangascraper.extensions", path=[REPO_ROOT])
+    _module(
+        "mangascraper.extensions.extension_manager",
+        build_gallery_metadata_summary=lambda meta, referrer: {},
+        calculate_extension_download_path=lambda name: os.path.join(tempfile.gettempdir(), "msext_tests", name) + "/",
+        cleanup_download_tree=lambda *args, **kwargs: None,
+        find_latest_cover_id=lambda folder: None,
+        find_latest_gallery_entry=lambda folder: (None, None, None),
+        parse_gallery_id=parse_gallery_id,
+        repair_covers_hook=lambda *args, **kwargs: None,
+    )
+    for name in ("mangascraper", "mangascraper.core", "mangascraper.extensions"):
+        parent, _, child = name.rpartition(".")
+        if parent:
+            setattr(sys.modules[parent], child, sys.modules[name])
+    for name in ("orchestrator", "api", "database"):
+        setattr(sys.modules["mangascraper.core"], name, sys.modules[f"mangascraper.core.{name}"])
+
+try:
+    import mangascraper.core.orchestrator
+except ImportError:
+    _install_core_stubs()
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """A freshly loaded download engine (skeleton's copy: clean rate limiter, scoreboards, indexes) at tmp_path."""
+    from mangascraper.extensions.skeleton import engine
+    engine = importlib.reload(engine)
+    engine.configure("test", "Test Extension", f"{tmp_path / 'downloads'}/")
+    monkeypatch.setattr(engine, "GALLERY_INDEX_PATH", str(tmp_path / "gallery_index.json"))
+    monkeypatch.setattr(engine, "ARCHIVE_STREAMING", False)
+    monkeypatch.setattr(engine, "PAGE_STORE", False)
+    return engine
+
+class FakeClock:
+    """Stands in for the engine's time module, so rate limiter tests do not depend on wall time."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+@pytest.fixture
+def clock(engine, monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(engine, "time", fake)
+    return fake
@@ -0,0 +1,203 @@
+# mangascraper/extensions/tests/test_engine.py
+
+import os
+import glob
+import random
+import pytest
+
+HOST = "mirror.test"
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def jpeg(size: int) -> bytes:
+    """JPEG-shaped body (magic bytes and end marker) of "size" bytes."""
+    return b"\xff\xd8\xff\xe0" + random.Random(size).randbytes(size - 6) + b"\xff\xd9"
+
+####################################################################################################################
+# Engine copies
+####################################################################################################################
+
+def test_extension_engines_match_skeleton():
+    def body(path: str) -> list:
+        with open(path, encoding="utf-8") as f:
+            return f.readlines()[2:] # Past the shebang and path comment.
+
+    template = body(os.path.join(REPO_ROOT, "skeleton", "engine.py"))
+    copies = glob.glob(os.path.join(REPO_ROOT, "*", "engine.py"))
+    assert len(copies) > 1
+    for path in copies:
+        assert body(path) == template, f"{os.path.relpath(path, REPO_ROOT)} differs from skeleton/engine.py"
+
+####################################################################################################################
+# Rate limiter (AIMD)
+####################################################################################################################
+
+def test_rate_limiter_burst_then_waits_for_tokens(engine, clock):
+    limiter = engine._HostRateLimiter()
+    for _ in range(engine.RATE_LIMIT_BURST):
+        assert limiter.reserve(HOST) == 0.0
+    assert limiter.reserve(HOST) == pytest.approx(1 / engine.RATE_LIMIT_INITIAL_RATE)
+
+def test_rate_limiter_increases_additively_on_success(engine, clock):
+    limiter = engine._HostRateLimiter()
+    rate = engine.RATE_LIMIT_INITIAL_RATE
+    for _ in range(3):
+        limiter.feedback(HOST, 200)
+        rate += engine.RATE_LIMIT_INCREASE / rate
+    assert limiter._hosts[HOST]["rate"] == pytest.approx(rate)
+
+def test_rate_limiter_caps_at_max_rate(engine, clock, monkeypatch):
+    monkeypatch.setattr(engine, "RATE_LIMIT_MAX_RATE", 5.05)
+    limiter = engine._HostRateLimiter()
+    for _ in range(10):
+        limiter.feedback(HOST, 200)
+    assert limiter._hosts[HOST]["rate"] == 5.05
+
+def test_rate_limiter_decreases_once_per_window(engine, clock):
+    limiter = engine._HostRateLimiter()
+    limiter.feedback(HOST, 429)
+    limiter.feedback(HOST, 503) # Same burst, one congestion signal.
+    rate = engine.RATE_LIMIT_INITIAL_RATE * engine.RATE_LIMIT_DECREASE
+    assert limiter._hosts[HOST]["rate"] == pytest.approx(rate)
+
+    clock.advance(1 / rate + 0.01)
+    limiter.feedback(HOST, 429)
+    assert limiter._hosts[HOST]["rate"] == pytest.approx(rate * engine.RATE_LIMIT_DECREASE)
+
+def test_rate_limiter_never_drops_below_min_rate(engine, clock):
+    limiter = engine._HostRateLimiter()
+    for _ in range(50):
+        limiter.feedback(HOST, 429)
+        clock.advance(60)
+    assert limiter._hosts[HOST]["rate"] == engine.RATE_LIMIT_MIN_RATE
+
+def test_rate_limiter_retry_after_pauses_the_host(engine, clock):
+    limiter = engine._HostRateLimiter()
+    limiter.feedback(HOST, 429, "7")
+    assert limiter.reserve(HOST) == pytest.approx(7.0)
+    assert limiter.reserve("other.test") == 0.0
+
+    clock.advance(7)
+    assert limiter.reserve(HOST) < 7.0
+
+def test_rate_limiter_caps_retry_after(engine, clock, monkeypatch):
+    monkeypatch.setattr(engine, "RATE_LIMIT_MAX_RETRY_AFTER", 30)
+    limiter = engine._HostRateLimiter()
+    limiter.feedback(HOST, 503, "86400")
+    assert limiter.reserve(HOST) == pytest.approx(30.0)
+
+####################################################################################################################
+# Mirror scoreboard
+####################################################################################################################
+
+def test_hedge_deadline_defaults_until_enough_samples(engine, monkeypatch):
+    monkeypatch.setattr(engine, "HEDGE_MIN_SAMPLES", 20)
+    scoreboard = engine._MirrorScoreboard()
+    assert scoreboard.hedge_deadline(HOST) == engine.HEDGE_DEFAULT_DEADLINE
+    for ttfb in range(19):
+        scoreboard.record_success(HOST, ttfb, 0.1, 1000)
+    assert scoreboard.hedge_deadline(HOST) == engine.HEDGE_DEFAULT_DEADLINE
+
+def test_hedge_deadline_is_p95_times_multiplier(engine, monkeypatch):
+    monkeypatch.setattr(engine, "HEDGE_MIN_SAMPLES", 20)
+    monkeypatch.setattr(engine, "HEDGE_DEADLINE_MULTIPLIER", 2.0)
+    scoreboard = engine._MirrorScoreboard()
+    samples = [i / 100 for i in range(1, 101)]
+    random.Random(0).shuffle(samples)
+    for ttfb in samples:
+        scoreboard.record_success(HOST, ttfb, 0.1, 1000)
+    assert scoreboard.hedge_deadline(HOST) == pytest.approx(0.96 * 2.0)
+
+def test_hedge_deadline_only_uses_recent_samples(engine, monkeypatch):
+    monkeypatch.setattr(engine, "HEDGE_MIN_SAMPLES", 1)
+    monkeypatch.setattr(engine, "MIRROR_LATENCY_SAMPLES", 10)
+    scoreboard = engine._MirrorScoreboard()
+    for _ in range(10):
+        scoreboard.record_success(HOST, 30.0, 0.1, 1000)
+    for _ in range(10):
+        scoreboard.record_success(HOST, 0.5, 0.1, 1000)
+    assert scoreboard.hedge_deadline(HOST) == pytest.approx(0.5)
+
+def test_scoreboard_ranks_fast_healthy_mirrors_first(engine):
+    scoreboard = engine._MirrorScoreboard()
+    urls = ["http://slow.test/1.jpg", "http://fast.test/1.jpg", "http://broken.test/1.jpg", "http://new.test/1.jpg"]
+    scoreboard.record_success("slow.test", 2.0, 1.0, 100_000)
+    scoreboard.record_success("fast.test", 0.1, 0.1, 100_000)
+    scoreboard.record_failure("broken.test")
+    assert scoreboard.rank(urls) == [
+        "http://new.test/1.jpg", # Never tried, explored first.
+        "http://fast.test/1.jpg",
+        "http://slow.test/1.jpg",
+        "http://broken.test/1.jpg",
+    ]
+
+####################################################################################################################
+# Page writer resume
+####################################################################################################################
+
+@pytest.fixture
+def page_path(tmp_path):
+    return str(tmp_path / "downloads" / "creator" / "(123) Title" / "001.jpg")
+
+def write_part(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.part", "wb") as f:
+        f.write(data)
+
+def test_page_writer_resumes_part_file_with_range(engine, page_path):
+    body = jpeg(4096)
+    write_part(page_path, body[:1000])
+
+    writer = engine._PageWriter(page_path)
+    assert writer.offset == 1000
+    assert writer.request_headers() == {"Range": "bytes=1000-"}
+
+    writer.begin(206, {"Content-Range": "bytes 1000-4095/4096", "Content-Length": "3096", "Content-Type": "image/jpeg"})
+    writer.write(body[1000:])
+    writer.commit()
+
+    with open(page_path, "rb") as f:
+        assert f.read() == body
+    assert not os.path.exists(f"{page_path}.part")
+    assert writer.received == 3096
+
+def test_page_writer_restarts_when_range_is_ignored(engine, page_path):
+    body = jpeg(4096)
+    write_part(page_path, b"stale bytes")
+
+    writer = engine._PageWriter(page_path)
+    writer.begin(200, {"Content-Length": "4096", "Content-Type": "image/jpeg"})
+    writer.write(body)
+    writer.commit()
+
+    with open(page_path, "rb") as f:
+        assert f.read() == body
+
+def test_page_writer_rejects_mismatched_content_range(engine, page_path):
+    write_part(page_path, jpeg(4096)[:1000])
+
+    writer = engine._PageWriter(page_path)
+    with pytest.raises(ValueError):
+        writer.begin(206, {"Content-Range": "bytes 0-4095/4096", "Content-Length": "4096"})
+    assert not os.path.exists(f"{page_path}.part")
+    assert writer.request_headers() == {}
+
+def test_page_writer_keeps_short_page_for_resume(engine, page_path):
+    body = jpeg(4096)
+
+    writer = engine._PageWriter(page_path)
+    writer.begin(200, {"Content-Length": "4096", "Content-Type": "image/jpeg"})
+    writer.write(body[:2500])
+    with pytest.raises(ValueError):
+        writer.commit()
+
+    assert not os.path.exists(page_path)
+    assert engine._PageWriter(page_path).request_headers() == {"Range": "bytes=2500-"}
+
+def test_page_writer_settles_complete_part_on_416(engine, page_path):
+    body = jpeg(4096)
+    write_part(page_path, body)
+
+    writer = engine._PageWriter(page_path)
+    assert writer.settle_unsatisfiable({"Content-Range": "bytes */4096"})
+    with open(page_path, "rb") as f:
+        assert f.read() == body
@@ -0,0 +1,88 @@
+# mangascraper/extensions/tests/test_suwayomi_graphql.py
+
+import pytest
+
+@pytest.fixture
+def suwayomi(engine, monkeypatch):
+    from mangascraper.extensions.suwayomi import suwayomi__msext as suwayomi
+
+    class QuietBar:
+        def __init__(self, *args, **kwargs):
+            pass
+        def update(self, n=1):
+            pass
+        def close(self):
+            pass
+
+    monkeypatch.setattr(suwayomi, "tqdm", QuietBar)
+    monkeypatch.setattr(suwayomi, "_manga_cache", suwayomi._SuwayomiMangaCache())
+    return suwayomi
+
+class RecordedGraphQL:
+    """Stands in for graphql_request, recording every call and answering through "respond"."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.calls = []
+
+    def __call__(self, request, variables=None, gql_debugging=False):
+        self.calls.append((request, variables))
+        return self.respond(request, variables)
+
+def test_refresh_mangas_batches_aliased_mutations(suwayomi, monkeypatch):
+    monkeypatch.setattr(suwayomi, "SUWAYOMI_REFRESH_BATCH_SIZE", 2)
+    graphql = RecordedGraphQL(lambda request, variables: {
+        "data": {alias: {"clientMutationId": None} for i in range(len(variables)) for alias in (f"m{i}", f"c{i}")}
+    })
+    monkeypatch.setattr(suwayomi, "graphql_request", graphql)
+
+    assert suwayomi.refresh_mangas([5, 3, 9, 3, 1]) == {1, 3, 5, 9}
+    assert [variables for _, variables in graphql.calls] == [{"m0": 1, "m1": 3}, {"m0": 5, "m1": 9}]
+    mutation = graphql.calls[0][0]
+    assert mutation.startswith("mutation RefreshMangas($m0: Int!, $m1: Int!)")
+    assert "m1: fetchManga(input: { id: $m1 })" in mutation
+    assert "c1: fetchChapters(input: { mangaId: $m1 })" in mutation
+
+def test_refresh_mangas_drops_ids_with_errors(suwayomi, monkeypatch):
+    graphql = RecordedGraphQL(lambda request, variables: {
+        "data": {"m0": {}, "c0": {}, "m1": {}, "c1": None},
+        "errors": [{"message": "No manga with id 8", "path": ["c1"]}],
+    })
+    monkeypatch.setattr(suwayomi, "graphql_request", graphql)
+    invalidated = []
+    monkeypatch.setattr(suwayomi._manga_cache, "invalidate", invalidated.extend)
+
+    assert suwayomi.refresh_mangas([7, 8]) == {7}
+    assert invalidated == [8]
+
+def test_creator_lookup_batches_titles(suwayomi, monkeypatch):
+    monkeypatch.setattr(suwayomi, "GRAPHQL_LOOKUP_BATCH_SIZE", 2)
+    graphql = RecordedGraphQL(lambda request, variables: {"data": {"mangas": {"nodes": [
+        {"id": str(ord(title[0])), "title": title, "inLibrary": False, "categories": {"nodes": []}}
+        for title in variables["titles"] if title != "Missing"
+    ]}}})
+    monkeypatch.setattr(suwayomi, "graphql_request", graphql)
+
+    mangas = suwayomi.fetch_creators_suwayomi_mangas(["Carol", "Alice", "Missing", "Bob", "Alice"])
+    assert [variables["titles"] for _, variables in graphql.calls] == [["Alice", "Bob"], ["Carol", "Missing"]]
+    assert sorted(mangas) == ["Alice", "Bob", "Carol"]
+
+def test_refresh_state_rereads_library_state_in_one_query(suwayomi, monkeypatch):
+    cache = suwayomi._manga_cache
+    cache._mangas = {
+        "Alice": {"id": 1, "inLibrary": True, "categories": [4]},
+        "Bob": {"id": 2, "inLibrary": True, "categories": [4]},
+    }
+    graphql = RecordedGraphQL(lambda request, variables: {"data": {"mangas": {"nodes": [
+        {"id": "1", "inLibrary": False, "categories": {"nodes": []}},
+    ]}}})
+    monkeypatch.setattr(suwayomi, "graphql_request", graphql)
+
+    states = cache.refresh_state([2, 1])
+    assert [variables for _, variables in graphql.calls] == [{"ids": [1, 2]}]
+    assert states == {1: {"id": 1, "inLibrary": False, "categories": []}}
+    assert cache._mangas == {"Alice": {"id": 1, "inLibrary": False, "categories": []}} # Bob's manga is gone.
+
+def test_refresh_state_reports_failed_requests(suwayomi, monkeypatch):
+    monkeypatch.setattr(suwayomi, "graphql_request", RecordedGraphQL(lambda request, variables: None))
+    assert suwayomi._manga_cache.refresh_state([1]) is None